@@ -6,6 +6,7 @@ from flask_login import LoginManager
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
+from urllib.parse import urlsplit
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
@@ -13,6 +14,8 @@ from flask_babel import Babel, _, lazy_gettext as _l
 from elasticsearch import Elasticsearch
 from redis import Redis
 import rq
+from app.local_redis import LocalRedis
+from app.local_search import LocalElasticsearch
 
 
 db = SQLAlchemy()
@@ -32,11 +35,7 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     # app配置config
     app.config.from_object(config_class)
-
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
-
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    _init_services(app)
     # 扩展初始化
     db.init_app(app)
     migrate.init_app(app, db)
@@ -59,44 +58,101 @@ def create_app(config_class=Config):
     app.register_blueprint(bp_api, url_prefix='/api')
 
     if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if Config.MAIL_USERNAME or Config.MAIL_PASSWORD:
-                auth = (Config.MAIL_USERNAME, Config.MAIL_PASSWORD)
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-
-            mail_handler = SMTPHandler(
-                mailhost=(Config.MAIL_SERVER, Config.MAIL_PORT),
-                fromaddr='no-reply@{}'.format(Config.MAIL_SERVER),
-                toaddrs=Config.ADMINS,
-                subject='microblog failure',
-                credentials=auth,
-                secure=secure)
-
-            mail_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        # 记录日志文件
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler(
-            'logs/microblog.log', maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
+        _init_logging(app)
         app.logger.info('microblog startup')
 
     return app
 
 
+def create_worker_app(config_class=Config):
+    '''
+    rq worker 用的 app（见 app/tasks.py 和 worker.py）：任务只用到数据库、邮件和 redis/elasticsearch 等客户端，
+    不初始化登录、页面相关的扩展，也不注册 auth、api 蓝图。main 蓝图只是为了邮件里的 url_for
+    '''
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+    # worker 里没有请求，url_for(..., _external=True) 按 BASE_URL 生成链接
+    base_url = urlsplit(app.config['BASE_URL'])
+    if not app.config['SERVER_NAME']:
+        app.config['SERVER_NAME'] = base_url.netloc
+        app.config['PREFERRED_URL_SCHEME'] = base_url.scheme or 'http'
+        app.config['APPLICATION_ROOT'] = base_url.path or '/'
+    _init_services(app)
+    db.init_app(app)
+    mail.init_app(app)
+    from app.main import bp as bp_main
+    app.register_blueprint(bp_main)
+
+    if not app.debug and not app.testing:
+        _init_logging(app)
+        app.logger.info('microblog worker startup')
+
+    return app
+
+
+def _init_services(app):
+    # 客户端对象创建时不连接，第一次执行命令时才连接
+    if app.config['REDIS_URL'].startswith('local://'):
+        app.redis = LocalRedis.from_url(app.config['REDIS_URL'])
+    else:
+        app.redis = Redis.from_url(app.config['REDIS_URL'])
+    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+
+    from app.follows import create_cache
+    app.follow_cache = create_cache(app)
+    from app import mutuals
+    app.id_cache = mutuals.create_cache(app)
+
+    if not app.config['ELASTICSEARCH_URL']:
+        # 没有 elasticsearch 时用内置的进程内搜索，见 app/local_search.py
+        from app.search import load_index
+        app.elasticsearch = LocalElasticsearch(loader=load_index)
+    elif app.config['ELASTICSEARCH_URL'].startswith('local://'):
+        app.elasticsearch = LocalElasticsearch.from_url(app.config['ELASTICSEARCH_URL'])
+    else:
+        app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+    from app.search import create_cache as create_search_cache
+    app.search_cache = create_search_cache(app)
+    from app.typeahead import create_typeahead
+    app.typeahead = create_typeahead(app)
+
+
+def _init_logging(app):
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if Config.MAIL_USERNAME or Config.MAIL_PASSWORD:
+            auth = (Config.MAIL_USERNAME, Config.MAIL_PASSWORD)
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+
+        mail_handler = SMTPHandler(
+            mailhost=(Config.MAIL_SERVER, Config.MAIL_PORT),
+            fromaddr='no-reply@{}'.format(Config.MAIL_SERVER),
+            toaddrs=Config.ADMINS,
+            subject='microblog failure',
+            credentials=auth,
+            secure=secure)
+
+        mail_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+
+        mail_handler.setLevel(logging.ERROR)
+        app.logger.addHandler(mail_handler)
+
+    # 记录日志文件
+    if not os.path.exists('logs'):
+        os.mkdir('logs')
+    file_handler = RotatingFileHandler(
+        'logs/microblog.log', maxBytes=10240, backupCount=10)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+    file_handler.setLevel(logging.INFO)
+    app.logger.addHandler(file_handler)
+
+    app.logger.setLevel(logging.INFO)
+
+
 @babel.localeselector
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
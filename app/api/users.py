@@ -1,8 +1,9 @@
 from app.api import bp
-from flask import jsonify, request, url_for, g, abort
+from flask import jsonify, request, url_for, g, abort, current_app
+from sqlalchemy.exc import IntegrityError
 from app.models import User
-from app import db
-from app.api.errors import bad_request
+from app import db, counts
+from app.api.errors import bad_request, error_response
 from flask_babel import _
 from app.api.auth import token_auth
 
@@ -23,6 +24,26 @@ def _get_meta():
     return (page, per_page)
 
 
+def _get_cursor():
+    # 带了 cursor 参数（第一页可以为空）时使用游标分页
+    return request.args.get('cursor') if 'cursor' in request.args else None
+
+
+def _collection(query, endpoint, get_total, **kwargs):
+    # get_total 返回 (total, exact)，只有按页分页时才调用，游标分页不需要总数
+    page, per_page = _get_meta()
+    cursor = _get_cursor()
+    if cursor is not None:
+        data = User.to_cursor_collection_dict(query, [User.id], cursor, per_page, endpoint, **kwargs)
+    else:
+        data = User.to_collection_dict(query, page, per_page, endpoint, total=get_total(), **kwargs)
+    # 当前用户是否关注了列表里的用户，整页只查一次
+    following = g.current_user.is_following_many([x['id'] for x in data['items']])
+    for item in data['items']:
+        item['is_following'] = item['id'] in following
+    return data
+
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
@@ -32,8 +53,8 @@ def get_user(id):
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page, per_page = _get_meta()
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
+    data = _collection(User.query, 'api.get_users',
+                       lambda: counts.get_total('user', User.query, table='user'))
     return jsonify(data)
 
 
@@ -41,9 +62,7 @@ def get_users():
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page, per_page = _get_meta()
-    data = User.to_collection_dict(
-        user.followers, page, per_page, 'api.get_followers', id=id)
+    data = _collection(user.followers, 'api.get_followers', lambda: (user.follower_count, True), id=id)
     return jsonify(data)
 
 
@@ -51,12 +70,83 @@ def get_followers(id):
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page, per_page = _get_meta()
-    data = User.to_collection_dict(
-        user.followed, page, per_page, 'api.get_followed', id=id)
+    data = _collection(user.followed, 'api.get_followed', lambda: (user.followed_count, True), id=id)
     return jsonify(data)
 
 
+def _get_target_ids():
+    data = request.get_json() or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not all(isinstance(x, int) and not isinstance(x, bool) for x in ids):
+        return None
+    return ids
+
+
+@bp.route('/users/<int:id>/followed', methods=['POST', 'DELETE'])
+@token_auth.login_required
+def update_followed(id):
+    ''' 批量关注/取关，请求体是 {"ids": [...]}，一个事务完成 '''
+    if g.current_user.id != id:
+        abort(403)
+    ids = _get_target_ids()
+    if ids is None:
+        return bad_request(_('必须包含 ids 字段，值是用户 id 列表'))
+    if len(ids) > current_app.config['BULK_FOLLOW_MAX']:
+        return bad_request(_('一次最多 %(max)d 个用户', max=current_app.config['BULK_FOLLOW_MAX']))
+    user = g.current_user
+    try:
+        if request.method == 'POST':
+            changed = user.follow_many(ids)
+        else:
+            changed = user.unfollow_many(ids)
+        db.session.commit()
+    except IntegrityError:
+        # 并发请求先写入了同样的关注关系
+        db.session.rollback()
+        return error_response(409, _('关注关系已经被修改，请重试'))
+    return jsonify({
+        'changed': changed,
+        'unchanged': sorted(set(ids) - set(changed)),
+        'followed_count': user.followed_count,
+    })
+
+
+@bp.route('/users/<int:id>/mutuals', methods=['GET'])
+@token_auth.login_required
+def get_mutuals(id):
+    # 当前用户关注的人里也关注了 id 的
+    user = User.query.get_or_404(id)
+    count, users = g.current_user.mutual_followers(user, min(_get_per_page(), 100))
+    return jsonify({
+        'items': [x.to_dict() for x in users],
+        '_meta': {
+            'total_items': count,
+        },
+        '_links': {
+            'self': url_for('api.get_mutuals', id=id),
+        }
+    })
+
+
+@bp.route('/users/<int:id>/suggestions', methods=['GET'])
+@token_auth.login_required
+def get_suggestions(id):
+    if g.current_user.id != id:
+        abort(403)
+    user = User.query.get_or_404(id)
+    items = []
+    for x, overlap in user.suggested_users(min(_get_per_page(), 100)):
+        item = x.to_dict()
+        item['mutual_count'] = overlap
+        items.append(item)
+    return jsonify({
+        'items': items,
+        '_links': {
+            'self': url_for('api.get_suggestions', id=id),
+        }
+    })
+
+
 @bp.route('/users', methods=['POST'])
 def create_user():
     data = request.get_json() or {}
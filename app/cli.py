@@ -35,4 +35,110 @@ def register(app):
     def compile():
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
-            raise RuntimeError('compile command failed')
\ No newline at end of file
+            raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def counters():
+        """ 用户冗余计数的维护命令 """
+        pass
+
+    @counters.command()
+    @click.option('--batch-size', default=1000, help='每批处理的用户数')
+    def reconcile(batch_size):
+        """Recompute post/follower/followed/unread message counters and fix drift."""
+        from app.models import User
+        fixed = User.reconcile_counters(batch_size)
+        click.echo('{} users fixed'.format(fixed))
+
+    @app.cli.group()
+    def suggestions():
+        """ 推荐关注的计算命令 """
+        pass
+
+    @suggestions.command()
+    @click.option('--full', is_flag=True, help='重新计算所有用户')
+    @click.option('--enqueue', is_flag=True, help='放到 rq 队列里由 worker 执行')
+    def compute(full, enqueue):
+        """Compute friends-of-friends follow suggestions."""
+        if enqueue:
+            job = app.task_queue.enqueue('app.tasks.compute_suggestions', full)
+            click.echo('job {} queued'.format(job.get_id()))
+            return
+        from app.suggestions import refresh
+        count = refresh(full)
+        click.echo('{} users computed'.format(count))
+
+    @app.cli.group()
+    def search():
+        """ 搜索索引的维护命令 """
+        pass
+
+    @search.command()
+    @click.argument('model', default='Post')
+    @click.option('--workers', default=1, help='并行写入的进程数')
+    @click.option('--chunk-size', default=10000, help='每块的 id 范围')
+    @click.option('--user', help='作为这个用户的后台任务运行，进度显示在页面上')
+    def reindex(model, workers, chunk_size, user):
+        """Rebuild a search index and swap its alias."""
+        from app import db
+        from app.models import User
+        import app.models as models
+        if user:
+            user = User.query.filter_by(username=user).first()
+            if user is None:
+                raise click.BadParameter('user not found')
+            task = user.add_task('reindex', 'Rebuilding {} index...'.format(model),
+                                 model, workers, chunk_size)
+            db.session.commit()
+            click.echo('task {} queued'.format(task.id))
+            return
+
+        def progress(percent, done, rate):
+            click.echo('{:3d}% {} documents {:.0f}/s'.format(percent, done, rate))
+
+        index, count = getattr(models, model).reindex(workers=workers, chunk_size=chunk_size,
+                                                      progress=progress)
+        click.echo('{} documents indexed into {}'.format(count, index))
+
+    @app.cli.group()
+    def typeahead():
+        """ 搜索框自动补全的维护命令 """
+        pass
+
+    @typeahead.command()
+    @click.option('--enqueue', is_flag=True, help='放到 rq 队列里由 worker 执行')
+    def build(enqueue):
+        """Rebuild typeahead usernames and post terms."""
+        if enqueue:
+            job = app.task_queue.enqueue('app.tasks.build_typeahead')
+            click.echo('job {} queued'.format(job.get_id()))
+            return
+        from app.typeahead import build as build_typeahead
+        users, terms = build_typeahead()
+        click.echo('{} users and {} terms'.format(users, terms))
+
+    @app.cli.group()
+    def notifications():
+        """ 通知相关的命令 """
+        pass
+
+    @notifications.command()
+    def stats():
+        """Show the conditional polling hit ratio."""
+        from app.notify import poll_stats
+        hits, misses = poll_stats()
+        total = hits + misses
+        click.echo('{} polls, {} not modified ({:.1%})'.format(total, hits, hits / total if total else 0))
+
+    @notifications.command()
+    @click.option('--enqueue', is_flag=True, help='放到 rq 队列里由 worker 执行')
+    def prune(enqueue):
+        """Delete read and stale notifications in batches."""
+        if enqueue:
+            job = app.task_queue.enqueue('app.tasks.prune_notifications')
+            click.echo('job {} queued'.format(job.get_id()))
+            return
+        from app.models import Notification
+        count = Notification.prune(app.config['NOTIFICATION_READ_RETENTION'],
+                                   app.config['NOTIFICATION_RETENTION'])
+        click.echo('{} notifications pruned'.format(count))
@@ -0,0 +1,144 @@
+'''
+分页总数，避免每次翻页都 COUNT(*)
+get_total 返回 (total, exact)，exact 表示总数是否精确，有四种模式：
+    exact     直接 COUNT
+    cached    COUNT 的结果在 redis 里缓存 COUNT_CACHE_TTL 秒，命中缓存时可能已经过时，不算精确
+    counter   redis 计数器，由 Post/Message/User 的写入增量维护，没有时用 COUNT 初始化，
+              初始化期间有增量时这次返回不精确的 COUNT，下次再初始化
+用户自己的博客数、粉丝数和关注数直接用 User 上的冗余字段
+    estimate  数据库的统计信息，只能用于整张表
+每个 endpoint 用哪种模式在 COUNT_MODES 里配置，没有配置的是 exact
+'''
+from collections import Counter
+from flask import current_app, request
+import redis
+from app import db
+
+
+def _cache_key(name):
+    return 'count:cache:{}'.format(name)
+
+
+def _counter_key(name):
+    return 'count:counter:{}'.format(name)
+
+
+def _epoch_key(name):
+    # 每次 apply 加一，初始化计数器时用来判断 COUNT 期间有没有增量
+    return 'count:epoch:{}'.format(name)
+
+
+def _log_error():
+    current_app.logger.warning('count cache unavailable', exc_info=True)
+
+
+def get_total(name, query, mode=None, table=None):
+    '''
+    name 是计数的名字，比如 post:user:1，table 是 estimate 模式下估算的表
+    mode 为 None 时按当前请求的 endpoint 读取配置
+    '''
+    if mode is None:
+        mode = current_app.config['COUNT_MODES'].get(request.endpoint, 'exact')
+    if mode == 'estimate' and table is not None:
+        total = estimate(table)
+        if total is not None:
+            return total, False
+        mode = 'cached'
+    try:
+        if mode == 'cached':
+            return _cached(name, query)
+        if mode == 'counter':
+            return _counter(name, query)
+    except redis.exceptions.RedisError:
+        _log_error()
+    return query.order_by(None).count(), True
+
+
+def _cached(name, query):
+    total = current_app.redis.get(_cache_key(name))
+    if total is not None:
+        return int(total), False
+    total = query.order_by(None).count()
+    current_app.redis.set(_cache_key(name), total, ex=current_app.config['COUNT_CACHE_TTL'])
+    return total, True
+
+
+def _expiring(ttl):
+    # redis-py 对没有过期时间和不存在的 key 返回 None（新版本是 -1、-2）
+    return ttl is not None and ttl >= 0
+
+
+def _counter(name, query):
+    pipe = current_app.redis.pipeline(transaction=False)
+    pipe.get(_counter_key(name))
+    pipe.ttl(_counter_key(name))
+    pipe.get(_epoch_key(name))
+    cached, ttl, epoch = pipe.execute()
+    if cached is not None and _expiring(ttl):
+        return max(int(cached), 0), True
+    total = query.order_by(None).count()
+    # 没有过期时间的是 apply 留下的不完整计数器，直接覆盖；不存在时用 nx，别的请求可能已经初始化了
+    # SET 和读取 epoch 在同一个事务里：epoch 变了说明 COUNT 和 SET 之间有增量，可能已经丢了，
+    # 删掉计数器下次重新 COUNT，这次的总数也不算精确
+    pipe = current_app.redis.pipeline()
+    pipe.set(_counter_key(name), total, ex=current_app.config['COUNT_COUNTER_TTL'], nx=cached is None)
+    pipe.get(_epoch_key(name))
+    if pipe.execute()[1] != epoch:
+        current_app.redis.delete(_counter_key(name))
+        return total, False
+    return total, True
+
+
+def estimate(table):
+    ''' 从数据库的统计信息估算表的行数，拿不到时返回 None '''
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES ' \
+              'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table'
+    elif dialect == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = :table'
+    elif dialect == 'sqlite':
+        # 没有删除的话 max(rowid) 就是行数，只需要读一次 B 树
+        sql = 'SELECT max(rowid) FROM {}'.format(
+            db.engine.dialect.identifier_preparer.quote(table))
+    else:
+        return None
+    total = db.session.execute(db.text(sql), {'table': table}).scalar()
+    if total is None or total < 0:
+        return None if dialect == 'postgresql' else 0
+    return int(total)
+
+
+def record(session, name, delta=1):
+    ''' 记录计数的变化，事务提交之后再写入 redis '''
+    session.info.setdefault('count_deltas', Counter())[name] += delta
+
+
+def apply(session):
+    deltas = session.info.pop('count_deltas', None)
+    if not deltas:
+        return
+    try:
+        # 只更新已经初始化过的计数器，没有初始化的等读取时再 COUNT
+        # INCRBY 和 TTL 在同一个事务（MULTI）里：没有过期时间说明计数器已经过期或者没有初始化，
+        # INCRBY 新建了一个只有增量的计数器，马上删掉。_counter 也不认没有过期时间的计数器
+        names = [name for name, delta in deltas.items() if delta]
+        if not names:
+            return
+        ttl = current_app.config['COUNT_COUNTER_TTL']
+        pipe = current_app.redis.pipeline()
+        for name in names:
+            pipe.incrby(_counter_key(name), deltas[name])
+            pipe.ttl(_counter_key(name))
+            pipe.incr(_epoch_key(name))
+            pipe.expire(_epoch_key(name), ttl)
+        ttls = pipe.execute()[1::4]
+        partial = [_counter_key(name) for name, ttl in zip(names, ttls) if not _expiring(ttl)]
+        if partial:
+            current_app.redis.delete(*partial)
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def discard(session):
+    session.info.pop('count_deltas', None)
@@ -0,0 +1,56 @@
+'''
+导出用户的博客
+按 (timestamp, id) 分块读取（keyset，每块一次查询，只取需要的列），每条博客一行 JSON（NDJSON），
+边读边写进 gzip 文件，内存占用和博客数量无关。先写临时文件，写完再改名，下载时不会拿到一半的文件
+文件保存在 EXPORT_DIR/<task_id>.ndjson.gz，通过 main.download_export 下载
+'''
+import gzip
+import json
+import os
+from flask import current_app
+from app import db
+from app.pagination import _beyond
+
+
+def path(task_id):
+    return os.path.join(current_app.config['EXPORT_DIR'], '{}.ndjson.gz'.format(task_id))
+
+
+def iter_posts(user_id, chunk_size=1000):
+    ''' 按时间顺序返回用户的博客 (id, body, timestamp) '''
+    from app.models import Post
+    columns = [Post.timestamp, Post.id]
+    last = None
+    while True:
+        query = db.session.query(Post.id, Post.body, Post.timestamp).filter(Post.user_id == user_id)
+        if last is not None:
+            query = query.filter(_beyond(columns, last, True))
+        rows = query.order_by(Post.timestamp.asc(), Post.id.asc()).limit(chunk_size).all()
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = [rows[-1].timestamp, rows[-1].id]
+
+
+def export_posts(user_id, filename, progress=None):
+    ''' 写入 filename，返回导出的博客数，每写一条调用一次 progress(已导出的数量) '''
+    config = current_app.config
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = filename + '.tmp'
+    count = 0
+    try:
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            for id, body, timestamp in iter_posts(user_id, config['EXPORT_CHUNK_SIZE']):
+                f.write(json.dumps({'body': body, 'timestamp': timestamp.isoformat() + 'Z'},
+                                   ensure_ascii=False))
+                f.write('\n')
+                count += 1
+                if progress is not None:
+                    progress(count)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return count
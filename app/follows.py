@@ -0,0 +1,184 @@
+'''
+关注关系缓存，User.is_following 不再每次查询 followers 表
+FOLLOW_CACHE 配置缓存的位置：
+    redis  集合 following:<user_id> 保存关注的用户 id，另外放一个 0 作为缓存已经建立的标记
+    local  单机模式，进程内按用户保存排好序的 array，二分查找判断，超过数量按 LRU 淘汰
+is_following_many 一次往返判断多个用户。follow/unfollow 先记在 session 里，
+提交之后写入缓存，回滚时让相关用户的缓存失效
+'''
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import threading
+from flask import current_app
+import redis
+from app import db
+
+# 用户 id 从 1 开始，0 用来标记缓存已经建立
+_MARKER = 0
+
+
+class RedisFollowCache(object):
+    def __init__(self, client, ttl):
+        self.redis = client
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(user_id):
+        return 'following:{}'.format(user_id)
+
+    def get_many(self, user_id, target_ids):
+        ''' 返回 target_ids 里关注了的 id 集合，缓存没有建立时返回 None '''
+        key = self._key(user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        # 只相信有标记的集合，不完整的集合（见 update）当作没有缓存
+        pipe.sismember(key, _MARKER)
+        for target_id in target_ids:
+            pipe.sismember(key, target_id)
+        result = pipe.execute()
+        if not result[0]:
+            return None
+        return {t for t, found in zip(target_ids, result[1:]) if found}
+
+    def load(self, user_id, followed_ids):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.sadd(key, _MARKER, *followed_ids)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def update(self, changes):
+        '''
+        changes 是 (user_id, target_id, is_follow) 列表，只更新已经建立的缓存
+        写入和检查标记在同一个事务（MULTI）里：没有标记说明缓存已经过期，SADD 新建了一个
+        没有过期时间的不完整集合，马上删掉。get_many 只认有标记的集合，删掉之前也不会读到
+        '''
+        pipe = self.redis.pipeline()
+        for user_id, target_id, is_follow in changes:
+            if is_follow:
+                pipe.sadd(self._key(user_id), target_id)
+            else:
+                pipe.srem(self._key(user_id), target_id)
+            pipe.sismember(self._key(user_id), _MARKER)
+        marked = pipe.execute()[1::2]
+        partial = {self._key(c[0]) for c, found in zip(changes, marked) if not found}
+        if partial:
+            self.redis.delete(*partial)
+
+    def invalidate(self, user_ids):
+        if user_ids:
+            self.redis.delete(*[self._key(x) for x in user_ids])
+
+
+class LocalFollowCache(object):
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _contains(ids, target_id):
+        i = bisect_left(ids, target_id)
+        return i < len(ids) and ids[i] == target_id
+
+    def get_many(self, user_id, target_ids):
+        with self.lock:
+            ids = self.users.get(user_id)
+            if ids is None:
+                return None
+            self.users.move_to_end(user_id)
+            return {t for t in target_ids if self._contains(ids, t)}
+
+    def load(self, user_id, followed_ids):
+        with self.lock:
+            self.users[user_id] = array('l', sorted(set(followed_ids)))
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def update(self, changes):
+        with self.lock:
+            for user_id, target_id, is_follow in changes:
+                ids = self.users.get(user_id)
+                if ids is None:
+                    continue
+                found = self._contains(ids, target_id)
+                if is_follow and not found:
+                    insort(ids, target_id)
+                elif not is_follow and found:
+                    ids.remove(target_id)
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.users.pop(user_id, None)
+
+
+def create_cache(app):
+    if app.config['FOLLOW_CACHE'] == 'local':
+        return LocalFollowCache(app.config['FOLLOW_CACHE_LOCAL_USERS'])
+    return RedisFollowCache(app.redis, app.config['FOLLOW_CACHE_TTL'])
+
+
+def _log_error():
+    current_app.logger.warning('follow cache unavailable', exc_info=True)
+
+
+def _query_followed(user_id, target_ids=None):
+    from app.models import followers
+    query = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id)
+    if target_ids is not None:
+        query = query.filter(followers.c.followed_id.in_(target_ids))
+    return [id for id, in query]
+
+
+def is_following_many(user_id, target_ids):
+    ''' 返回 target_ids 里 user_id 关注了的 id 集合 '''
+    target_ids = sorted(set(target_ids))
+    if not target_ids:
+        return set()
+    cache = current_app.follow_cache
+    try:
+        result = cache.get_many(user_id, target_ids)
+        if result is None:
+            followed_ids = _query_followed(user_id)
+            cache.load(user_id, followed_ids)
+            result = set(followed_ids).intersection(target_ids)
+    except redis.exceptions.RedisError:
+        _log_error()
+        result = set(_query_followed(user_id, target_ids))
+
+    # 还没有提交的 follow/unfollow
+    for follower_id, target_id, is_follow in db.session.info.get('follow_changes', []):
+        if follower_id == user_id and target_id in target_ids:
+            if is_follow:
+                result.add(target_id)
+            else:
+                result.discard(target_id)
+    return result
+
+
+def record(session, user_id, target_id, is_follow):
+    session.info.setdefault('follow_changes', []).append((user_id, target_id, is_follow))
+
+
+def apply(session):
+    changes = session.info.pop('follow_changes', None)
+    if not changes:
+        return
+    try:
+        current_app.follow_cache.update(changes)
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def discard(session):
+    # 事务里加载的缓存可能包含回滚掉的关注，直接失效
+    changes = session.info.pop('follow_changes', None)
+    if not changes:
+        return
+    try:
+        current_app.follow_cache.invalidate({x[0] for x in changes})
+    except redis.exceptions.RedisError:
+        _log_error()
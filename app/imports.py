@@ -0,0 +1,120 @@
+'''
+导入博客（从其它平台迁移），格式和 app/exports.py 导出的一样：每行一个 JSON {"body": ..., "timestamp": "...Z"}，
+可以是 gzip 压缩的。timestamp 可以省略，body 为空或者超过 140 个字符的行跳过
+按 IMPORT_BATCH_SIZE 条一批：检测语言，一个事务写入（见 insert_batch），然后一次 _bulk 写入搜索索引，
+一次 pipeline 推送到时间线（内置搜索不能跨进程写入，导入完成后用 request_reload 让各进程重新建立索引）。Core 的 INSERT 不经过 ORM 的 flush 事件，post_count、计数缓存、搜索索引和时间线在这里更新，
+自动补全的词等下一次 flask typeahead build
+'''
+from datetime import datetime
+import gzip
+import json
+from flask import current_app
+from elasticsearch.exceptions import ElasticsearchException
+from app import db, counts, timeline
+from app.search import bulk, is_local, request_reload
+from app.translate import detect_language
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _parse_timestamp(value):
+    if not value:
+        return datetime.utcnow()
+    value = value.rstrip('Z')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def parse(line):
+    ''' 一行转成 (body, timestamp)，格式不对的返回 None '''
+    try:
+        data = json.loads(line)
+        body = data['body'].strip()
+        timestamp = _parse_timestamp(data.get('timestamp'))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    if not body or len(body) > 140:
+        return None
+    return body, timestamp
+
+
+def _follower_ids(user):
+    # 和发表博客时一样，大V不推送给粉丝
+    from app.models import followers
+    if user.follower_count >= current_app.config['TIMELINE_CELEBRITY_THRESHOLD']:
+        return None
+    return [id for id, in db.session.query(followers.c.follower_id).filter(followers.c.followed_id == user.id)]
+
+
+def insert_batch(user_id, rows):
+    '''
+    rows 是 (body, timestamp) 列表，一个事务写入，返回新博客的 (id, body, timestamp)
+    PostgreSQL 用一条多行的 INSERT ... RETURNING 拿到 id；其它数据库的多行 INSERT 拿不到每一行的 id，
+    在同一个事务里逐行 INSERT，同一个作者同时发表的博客不会被当成导入的
+    '''
+    from app.models import User, Post
+    post, user = Post.__table__, User.__table__
+    values = [{'body': body, 'timestamp': timestamp, 'user_id': user_id, 'language': detect_language(body)}
+              for body, timestamp in rows]
+    if db.engine.dialect.name == 'postgresql':
+        inserted = [tuple(x) for x in db.session.execute(post.insert().values(values).returning(
+            post.c.id, post.c.body, post.c.timestamp))]
+    else:
+        inserted = [(db.session.execute(post.insert().values(x)).inserted_primary_key[0],
+                     x['body'], x['timestamp']) for x in values]
+    db.session.execute(user.update().where(user.c.id == user_id).values(
+        post_count=user.c.post_count + len(rows)))
+    counts.record(db.session, 'post', len(rows))
+    db.session.commit()
+    return sorted(inserted)
+
+
+def _index(inserted):
+    if is_local():
+        # 内置搜索写不到 web 进程的索引，导入完成后一起重新建立
+        return
+    try:
+        bulk([('post', id, {'body': body}) for id, body, _ in inserted], wait=True)
+    except ElasticsearchException:
+        # 数据库已经提交了，索引失败只记录，之后可以 reindex
+        current_app.logger.error('bulk index failed', exc_info=True)
+
+
+def import_posts(user, filename, progress=None):
+    '''
+    逐行读取 filename 写入，返回 (导入的条数, 跳过的行数)
+    progress(已读取的字节数) 每批调用一次，压缩文件按压缩后的位置计算
+    '''
+    batch_size = current_app.config['IMPORT_BATCH_SIZE']
+    user_id = user.id
+    follower_ids = _follower_ids(user)
+    imported = skipped = 0
+    rows = []
+
+    def flush():
+        inserted = insert_batch(user_id, rows)
+        _index(inserted)
+        timeline.push_many(user_id, [(id, timestamp) for id, _, timestamp in inserted], follower_ids)
+        if progress is not None:
+            progress(raw.tell())
+        count = len(rows)
+        del rows[:]
+        return count
+
+    with open(filename, 'rb') as raw:
+        lines = gzip.GzipFile(fileobj=raw) if raw.peek(2)[:2] == _GZIP_MAGIC else raw
+        for line in lines:
+            if not line.strip():
+                continue
+            row = parse(line.decode('utf-8', 'replace'))
+            if row is None:
+                skipped += 1
+                continue
+            rows.append(row)
+            if len(rows) >= batch_size:
+                imported += flush()
+        if rows:
+            imported += flush()
+    if imported and is_local():
+        # 导入在 rq worker 里运行，让 web 进程从数据库重新建立内置搜索的索引
+        request_reload('post')
+    return imported, skipped
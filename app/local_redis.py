@@ -0,0 +1,378 @@
+'''
+进程内的 Redis 替身，实现了项目里用到的一小部分 redis-py 接口
+REDIS_URL 配置为 local:// 时使用，主要用于测试和单机调试，多进程之间不共享数据
+返回值和 redis-py 一样是 bytes，round_trips 记录了和"服务器"交互的次数
+发布订阅只在同一个进程的线程之间传递消息
+'''
+import bisect
+import fnmatch
+import queue
+import threading
+import time
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+def _parse_bound(value):
+    # 支持 '-inf' '+inf' 以及 '(1.5' 这种开区间写法
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        exclusive = value.startswith('(')
+        if exclusive:
+            value = value[1:]
+        return float(value), exclusive
+    return float(value), False
+
+
+class LocalPipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self.client, '_' + name, None)
+        if method is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.client.lock:
+            self.client.round_trips += 1
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class LocalPubSub(object):
+    def __init__(self, client, ignore_subscribe_messages=False):
+        self.client = client
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self.client.lock:
+            for channel in channels:
+                channel = _to_bytes(channel)
+                self.channels.add(channel)
+                self.client.subscribers.setdefault(channel, set()).add(self)
+                self._put('subscribe', channel, len(self.channels))
+
+    def unsubscribe(self, *channels):
+        with self.client.lock:
+            for channel in [_to_bytes(x) for x in channels] or list(self.channels):
+                self.channels.discard(channel)
+                subscribers = self.client.subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(self)
+                    if not subscribers:
+                        del self.client.subscribers[channel]
+                self._put('unsubscribe', channel, len(self.channels))
+
+    def _put(self, type, channel, data):
+        self.messages.put({'type': type, 'pattern': None, 'channel': channel, 'data': data})
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            message = self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+        except queue.Empty:
+            return None
+        if message['type'] != 'message' and (ignore_subscribe_messages or self.ignore_subscribe_messages):
+            return None
+        return message
+
+    def close(self):
+        self.unsubscribe()
+
+
+class LocalRedis(object):
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}
+        self.round_trips = 0
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls()
+
+    def __getattr__(self, name):
+        # 单条命令也算一次往返
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(type(self), '_' + name, None)
+        if method is None:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            with self.lock:
+                self.round_trips += 1
+                return method(self, *args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self, ignore_subscribe_messages)
+
+    # 内部实现
+    def _get_value(self, name, default=None):
+        name = _to_bytes(name)
+        expire_at = self.expires.get(name)
+        if expire_at is not None and expire_at <= time.time():
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return self.data.get(name, default)
+
+    def _set_value(self, name, value):
+        self.data[_to_bytes(name)] = value
+
+    # keys
+    def _exists(self, *names):
+        return sum(1 for name in names if self._get_value(name) is not None)
+
+    def _delete(self, *names):
+        count = 0
+        for name in names:
+            if self._get_value(name) is not None:
+                count += 1
+            self.data.pop(_to_bytes(name), None)
+            self.expires.pop(_to_bytes(name), None)
+        return count
+
+    def _expire(self, name, time_in_seconds):
+        if self._get_value(name) is None:
+            return False
+        self.expires[_to_bytes(name)] = time.time() + int(time_in_seconds)
+        return True
+
+    def _ttl(self, name):
+        # 和 redis-py 3.x 一样，key 不存在或者没有过期时间时返回 None
+        if self._get_value(name) is None or _to_bytes(name) not in self.expires:
+            return None
+        return max(int(round(self.expires[_to_bytes(name)] - time.time())), 0)
+
+    def _keys(self, pattern='*'):
+        pattern = _to_bytes(pattern).decode('utf-8')
+        return [k for k in list(self.data)
+                if self._get_value(k) is not None and fnmatch.fnmatchcase(k.decode('utf-8'), pattern)]
+
+    def _flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    # strings
+    def _get(self, name):
+        return self._get_value(name)
+
+    def _set(self, name, value, ex=None, nx=False):
+        if nx and self._get_value(name) is not None:
+            return None
+        self._set_value(name, _to_bytes(value))
+        self.expires.pop(_to_bytes(name), None)
+        if ex is not None:
+            self._expire(name, ex)
+        return True
+
+    def _incrby(self, name, amount=1):
+        value = int(self._get_value(name, b'0')) + amount
+        self._set_value(name, _to_bytes(value))
+        return value
+
+    def _incr(self, name, amount=1):
+        return self._incrby(name, amount)
+
+    def _decr(self, name, amount=1):
+        return self._incrby(name, -amount)
+
+    def _mget(self, keys, *args):
+        if isinstance(keys, (str, bytes)):
+            keys = [keys] + list(args)
+        return [self._get_value(k) for k in keys]
+
+    # sets
+    def _sadd(self, name, *values):
+        members = self._get_value(name)
+        if members is None:
+            members = set()
+            self._set_value(name, members)
+        before = len(members)
+        members.update(_to_bytes(v) for v in values)
+        return len(members) - before
+
+    def _srem(self, name, *values):
+        members = self._get_value(name, set())
+        before = len(members)
+        members.difference_update(_to_bytes(v) for v in values)
+        return before - len(members)
+
+    def _smembers(self, name):
+        return set(self._get_value(name, set()))
+
+    def _sismember(self, name, value):
+        return _to_bytes(value) in self._get_value(name, set())
+
+    def _scard(self, name):
+        return len(self._get_value(name, set()))
+
+    # hashes
+    def _hset(self, name, key=None, value=None, mapping=None):
+        fields = self._get_value(name)
+        if fields is None:
+            fields = {}
+            self._set_value(name, fields)
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        added = 0
+        for k, v in items.items():
+            added += _to_bytes(k) not in fields
+            fields[_to_bytes(k)] = _to_bytes(v)
+        return added
+
+    def _hmset(self, name, mapping):
+        self._hset(name, mapping=mapping)
+        return True
+
+    def _hincrby(self, name, key, amount=1):
+        fields = self._get_value(name)
+        if fields is None:
+            fields = {}
+            self._set_value(name, fields)
+        value = int(fields.get(_to_bytes(key), b'0')) + amount
+        fields[_to_bytes(key)] = _to_bytes(value)
+        return value
+
+    def _hget(self, name, key):
+        return self._get_value(name, {}).get(_to_bytes(key))
+
+    def _hgetall(self, name):
+        return dict(self._get_value(name, {}))
+
+    def _hmget(self, name, keys, *args):
+        if isinstance(keys, (str, bytes)):
+            keys = [keys] + list(args)
+        fields = self._get_value(name, {})
+        return [fields.get(_to_bytes(k)) for k in keys]
+
+    # sorted sets，内部保存为按 (score, member) 排序的列表
+    def _zset(self, name, create=False):
+        entries = self._get_value(name)
+        if entries is None and create:
+            entries = []
+            self._set_value(name, entries)
+        return entries if entries is not None else []
+
+    def _zadd(self, name, mapping, nx=False):
+        entries = self._zset(name, create=True)
+        scores = {member: score for score, member in entries}
+        added = 0
+        for member, score in mapping.items():
+            member = _to_bytes(member)
+            if member in scores:
+                if nx:
+                    continue
+                entries.remove((scores[member], member))
+            else:
+                added += 1
+            scores[member] = float(score)
+            bisect.insort(entries, (float(score), member))
+        return added
+
+    def _zincrby(self, name, amount, value):
+        score = (self._zscore(name, value) or 0) + float(amount)
+        self._zadd(name, {value: score})
+        return score
+
+    def _zrem(self, name, *values):
+        entries = self._zset(name)
+        values = set(_to_bytes(v) for v in values)
+        kept = [e for e in entries if e[1] not in values]
+        removed = len(entries) - len(kept)
+        entries[:] = kept
+        return removed
+
+    def _zcard(self, name):
+        return len(self._zset(name))
+
+    def _zscore(self, name, value):
+        value = _to_bytes(value)
+        for score, member in self._zset(name):
+            if member == value:
+                return score
+        return None
+
+    @staticmethod
+    def _slice(entries, start, end):
+        length = len(entries)
+        if start < 0:
+            start = max(length + start, 0)
+        if end < 0:
+            end = length + end
+        return entries[start:end + 1]
+
+    @staticmethod
+    def _format(entries, withscores):
+        if withscores:
+            return [(member, score) for score, member in entries]
+        return [member for score, member in entries]
+
+    def _zrange(self, name, start, end, desc=False, withscores=False):
+        entries = self._zset(name)
+        if desc:
+            entries = entries[::-1]
+        return self._format(self._slice(entries, start, end), withscores)
+
+    def _zrevrange(self, name, start, end, withscores=False):
+        return self._zrange(name, start, end, desc=True, withscores=withscores)
+
+    def _zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, desc=False):
+        low, low_open = _parse_bound(min)
+        high, high_open = _parse_bound(max)
+        entries = [e for e in self._zset(name)
+                   if (e[0] > low if low_open else e[0] >= low) and
+                   (e[0] < high if high_open else e[0] <= high)]
+        if desc:
+            entries = entries[::-1]
+        if start is not None and num is not None:
+            entries = entries[start:start + num if num >= 0 else None]
+        return self._format(entries, withscores)
+
+    def _zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False):
+        return self._zrangebyscore(name, min, max, start=start, num=num,
+                                   withscores=withscores, desc=True)
+
+    def _zremrangebyrank(self, name, start, end):
+        entries = self._zset(name)
+        removed = self._slice(entries, start, end)
+        for e in removed:
+            entries.remove(e)
+        return len(removed)
+
+    # pub/sub
+    def _publish(self, channel, message):
+        subscribers = self.subscribers.get(_to_bytes(channel), ())
+        for subscriber in subscribers:
+            subscriber._put('message', _to_bytes(channel), _to_bytes(message))
+        return len(subscribers)
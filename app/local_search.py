@@ -0,0 +1,369 @@
+'''
+进程内的全文搜索，实现了项目里用到的一小部分 elasticsearch-py 接口
+    ELASTICSEARCH_URL 没有配置时作为内置的搜索后端，第一次用到某个索引时通过 loader 从数据库建立
+    ELASTICSEARCH_URL 配置为 local:// 时是空的替身，主要用于测试
+每个索引是一个倒排索引 {词: {文档 id: 词频}}，multi_match 查询用 BM25 打分，和 elasticsearch 的默认相似度一致
+中文没有空格分词，连续的汉字切成相邻两个字的词（和 elasticsearch 的 cjk 分析器一样），另外保留单字，查单个字也能搜到
+数据只在当前进程里，多进程部署时一个进程写入之后，别的进程查询前从数据库重新建立整个索引（见 app.search），
+只适合写入不多的小规模部署
+'''
+from collections import Counter
+import heapq
+import html
+import math
+import re
+import threading
+from elasticsearch.exceptions import NotFoundError, RequestError
+
+_WORD = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯]+|[^\W_]+', re.UNICODE)
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯]')
+
+# BM25 参数，和 elasticsearch 默认值相同
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text, query=False):
+    '''
+    英文按单词小写，连续的汉字切成二元词，文档另外保留单字
+    查询时只有单个汉字才用单字，其余用二元词，避免单字匹配到大量无关的文档
+    '''
+    tokens = []
+    for word in _WORD.findall(text or ''):
+        if not _CJK.match(word):
+            tokens.append(word.lower())
+            continue
+        if len(word) == 1 or not query:
+            tokens.extend(word)
+        tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def highlight(text, query, pre_tag='<em>', post_tag='</em>'):
+    '''
+    把 text 里和查询匹配的词用 pre_tag/post_tag 包起来，其余部分做 HTML 转义（相当于 encoder: html）
+    没有匹配时返回 None
+    '''
+    terms = set(tokenize(query, query=True))
+    marked = [False] * len(text)
+    for match in _WORD.finditer(text):
+        word = match.group()
+        if not _CJK.match(word):
+            if word.lower() in terms:
+                marked[match.start():match.end()] = [True] * len(word)
+            continue
+        for i, char in enumerate(word):
+            if char in terms:
+                marked[match.start() + i] = True
+        for i in range(len(word) - 1):
+            if word[i:i + 2] in terms:
+                marked[match.start() + i] = marked[match.start() + i + 1] = True
+    if not any(marked):
+        return None
+    parts = []
+    start = 0
+    for i in range(1, len(text) + 1):
+        if i == len(text) or marked[i] != marked[start]:
+            chunk = html.escape(text[start:i], quote=False)
+            parts.append(pre_tag + chunk + post_tag if marked[start] else chunk)
+            start = i
+    return ''.join(parts)
+
+
+class InvertedIndex(object):
+    def __init__(self):
+        self.docs = {}
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, id):
+        return id in self.docs
+
+    def get(self, id):
+        return self.docs.get(id)
+
+    def put(self, id, doc):
+        self.remove(id)
+        tokens = Counter()
+        for value in doc.values():
+            if isinstance(value, str):
+                tokens.update(tokenize(value))
+        self.docs[id] = doc
+        self.lengths[id] = sum(tokens.values())
+        self.total_length += self.lengths[id]
+        for term, tf in tokens.items():
+            self.postings.setdefault(term, {})[id] = tf
+
+    def remove(self, id):
+        doc = self.docs.pop(id, None)
+        if doc is None:
+            return False
+        self.total_length -= self.lengths.pop(id)
+        for value in doc.values():
+            if isinstance(value, str):
+                for term in set(tokenize(value)):
+                    posting = self.postings.get(term)
+                    if posting is not None:
+                        posting.pop(id, None)
+                        if not posting:
+                            del self.postings[term]
+        return True
+
+    def search(self, query, limit):
+        ''' 返回 (命中的文档数, 分数最高的 limit 个 [(score, id)]) '''
+        terms = Counter(tokenize(query, query=True))
+        if not terms or not self.docs:
+            return 0, []
+        n = len(self.docs)
+        average = self.total_length / n or 1
+        scores = {}
+        for term, weight in terms.items():
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for id, tf in posting.items():
+                norm = tf + K1 * (1 - B + B * self.lengths[id] / average)
+                scores[id] = scores.get(id, 0) + weight * idf * tf * (K1 + 1) / norm
+        # 分数相同时 id 大的（新的）在前
+        top = heapq.nlargest(limit, scores.items(), key=lambda x: (x[1], _sort_key(x[0])))
+        return len(scores), [(score, id) for id, score in top]
+
+    def stats(self):
+        return {
+            'docs': len(self.docs),
+            'terms': len(self.postings),
+            'postings': sum(len(x) for x in self.postings.values()),
+        }
+
+
+def _sort_key(id):
+    return (0, int(id), '') if id.isdigit() else (1, 0, id)
+
+
+class LocalIndices(object):
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index):
+        return index in self.client.indexes or index in self.client.aliases
+
+    def create(self, index, body=None):
+        with self.client.lock:
+            if self.exists(index):
+                raise RequestError(400, 'resource_already_exists_exception', index)
+            self.client.indexes[index] = InvertedIndex()
+            self.client.settings[index] = dict((body or {}).get('settings', {}))
+        return {'acknowledged': True, 'index': index}
+
+    def delete(self, index):
+        with self.client.lock:
+            if index not in self.client.indexes:
+                raise NotFoundError(404, 'index_not_found_exception', index)
+            del self.client.indexes[index]
+            self.client.settings.pop(index, None)
+            for alias, target in list(self.client.aliases.items()):
+                if target == index:
+                    del self.client.aliases[alias]
+        return {'acknowledged': True}
+
+    def put_settings(self, body, index):
+        settings = self.client.settings.setdefault(self.client.resolve(index), {})
+        for key, value in body.get('index', body).items():
+            if value is None:
+                settings.pop(key, None)
+            else:
+                settings[key] = value
+        return {'acknowledged': True}
+
+    def refresh(self, index=None):
+        return {'_shards': {'failed': 0}}
+
+    def exists_alias(self, name):
+        return name in self.client.aliases
+
+    def get_alias(self, name):
+        if name not in self.client.aliases:
+            raise NotFoundError(404, 'alias_not_found', name)
+        return {self.client.aliases[name]: {'aliases': {name: {}}}}
+
+    def update_aliases(self, body):
+        # 所有动作一起生效
+        with self.client.lock:
+            aliases = dict(self.client.aliases)
+            removed = []
+            for action in body['actions']:
+                (op, args), = action.items()
+                if op == 'add':
+                    if args['index'] not in self.client.indexes:
+                        raise NotFoundError(404, 'index_not_found_exception', args['index'])
+                    aliases[args['alias']] = args['index']
+                elif op == 'remove':
+                    if aliases.get(args['alias']) == args['index']:
+                        del aliases[args['alias']]
+                elif op == 'remove_index':
+                    removed.append(args['index'])
+            for index in removed:
+                self.client.indexes.pop(index, None)
+                self.client.settings.pop(index, None)
+            self.client.aliases = {k: v for k, v in aliases.items() if v not in removed}
+        return {'acknowledged': True}
+
+    def stats(self, index):
+        stats = self.client._index(index).stats()
+        return {'_all': {'primaries': {'docs': {'count': stats['docs']}}}, 'local': stats}
+
+
+class LocalElasticsearch(object):
+    def __init__(self, loader=None):
+        '''
+        loader(index) 在查询一个还不存在的索引时调用，负责从数据库建立索引
+        有 loader 时写入不存在的索引会被跳过，等建立索引时从数据库读取
+        '''
+        # indexes 是 {index: InvertedIndex}，aliases 是 {alias: index}
+        self.indexes = {}
+        self.aliases = {}
+        self.settings = {}
+        self.requests = 0
+        self.loader = loader
+        self.loading = set()
+        # 见 sync，{index: 上次看到的重新加载版本}
+        self.versions = {}
+        self.lock = threading.RLock()
+        self.indices = LocalIndices(self)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(**kwargs)
+
+    def sync(self, index, version):
+        ''' version 和上次看到的不同时丢掉 index，下次用到时由 loader 从数据库重新建立 '''
+        version = int(version or 0)
+        with self.lock:
+            if index in self.versions and self.versions[index] != version:
+                name = self.resolve(index)
+                self.indexes.pop(name, None)
+                self.settings.pop(name, None)
+                self.aliases.pop(index, None)
+            self.versions[index] = version
+
+    def advance(self, index, version):
+        '''
+        当前进程的写入让版本号变成了 version，索引里已经有这次写入，
+        之前的版本都看到过（上一个版本是 version - 1）时不用重新加载
+        '''
+        with self.lock:
+            if self.versions.get(index) == version - 1:
+                self.versions[index] = version
+
+    def resolve(self, index):
+        return self.aliases.get(index, index)
+
+    def _index(self, index, create=False):
+        name = self.resolve(index)
+        if name not in self.indexes:
+            if self.loader is not None and index not in self.loading:
+                self.loading.add(index)
+                try:
+                    self.loader(index)
+                finally:
+                    self.loading.discard(index)
+                name = self.resolve(index)
+                if name not in self.indexes:
+                    # 没有对应的数据，当作空索引
+                    self.indexes[name] = InvertedIndex()
+                return self.indexes[name]
+            if not create:
+                raise NotFoundError(404, 'index_not_found_exception', index)
+            # 和 elasticsearch 一样写入时自动创建索引
+            self.indexes[name] = InvertedIndex()
+        return self.indexes[name]
+
+    def _writable(self, index):
+        # 有 loader 时还没有建立的索引不写入，建立的时候会从数据库读到
+        name = self.resolve(index)
+        if name in self.indexes:
+            return self.indexes[name]
+        if self.loader is not None:
+            return None
+        return self._index(index, create=True)
+
+    def index(self, index, body, id, doc_type=None):
+        self.requests += 1
+        with self.lock:
+            target = self._writable(index)
+            if target is not None:
+                target.put(str(id), dict(body))
+        return {'_id': str(id), 'result': 'created'}
+
+    def delete(self, index, id, doc_type=None):
+        self.requests += 1
+        with self.lock:
+            target = self._writable(index)
+            if target is not None and not target.remove(str(id)):
+                raise NotFoundError(404, 'not_found', id)
+        return {'_id': str(id), 'result': 'deleted'}
+
+    def bulk(self, body, refresh=None):
+        # 写入马上可以搜索到，refresh 参数只是为了和 elasticsearch 的接口一致
+        self.requests += 1
+        items = []
+        errors = False
+        i = 0
+        with self.lock:
+            while i < len(body):
+                (op, meta), = body[i].items()
+                target = self._writable(meta['_index'])
+                id = str(meta['_id'])
+                if op == 'delete':
+                    status = 200 if target is None or target.remove(id) else 404
+                    errors = errors or status == 404
+                    i += 1
+                else:
+                    if target is not None:
+                        target.put(id, dict(body[i + 1]))
+                    status = 201
+                    i += 2
+                items.append({op: {'_index': self.resolve(meta['_index']), '_id': id, 'status': status}})
+        return {'errors': errors, 'items': items}
+
+    def count(self, index, doc_type=None):
+        return {'count': len(self._index(index))}
+
+    def search(self, index, body, doc_type=None):
+        self.requests += 1
+        with self.lock:
+            target = self._index(index)
+            start = body.get('from', 0)
+            total, hits = target.search(body['query']['multi_match']['query'],
+                                        start + body.get('size', 10))
+            result = []
+            for score, id in hits[start:]:
+                hit = {'_id': id, '_score': score}
+                if body.get('_source', True) is not False:
+                    hit['_source'] = target.get(id)
+                if 'highlight' in body:
+                    hit['highlight'] = self._highlight(target.get(id), body)
+                result.append(hit)
+            return {'hits': {
+                'total': total,
+                'max_score': hits[0][0] if hits else None,
+                'hits': result,
+            }}
+
+    @staticmethod
+    def _highlight(doc, body):
+        options = body['highlight']
+        pre_tag = options.get('pre_tags', ['<em>'])[0]
+        post_tag = options.get('post_tags', ['</em>'])[0]
+        fragments = {}
+        for field, value in doc.items():
+            if isinstance(value, str):
+                text = highlight(value, body['query']['multi_match']['query'], pre_tag, post_tag)
+                if text is not None:
+                    fragments[field] = [text]
+        return fragments
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired, ValidationError, Length
 from app.models import User
@@ -12,6 +13,11 @@ class PostForm(FlaskForm):
     submit = SubmitField(_l('保存'))
 
 
+class ImportPostsForm(FlaskForm):
+    file = FileField(_l('博客数据（NDJSON）'), validators=[FileRequired(_l('请选择文件'))])
+    submit = SubmitField(_l('导入'))
+
+
 class EditProfileForm(FlaskForm):
     username = StringField(_l('用户名'), validators=[DataRequired(_l('请输入用户名'))])
     about_me = TextAreaField(_l('关于我'), validators=[Length(min=0, max=140)])
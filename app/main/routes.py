@@ -1,15 +1,19 @@
 from app.main import bp
 from app import db
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
-from app.main.forms import EditProfileForm, PostForm, MessageForm
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, Response, \
+    abort, send_from_directory
+from app.main.forms import EditProfileForm, PostForm, MessageForm, ImportPostsForm
 from flask_login import current_user, login_required
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Message, Notification, Task
+from app.pagination import keyset_paginate, paginate
+from app import counts, typeahead, notify, exports
 from datetime import datetime
 from flask_babel import _, get_locale
-from guess_language import guess_language
-from app.translate import translate
+from app.translate import translate, detect_language
 from app.main.forms import SearchForm
 from math import ceil
+import os
+import uuid
 '''
 get_locale()  返回 zh_Hans_CN
 guess_language  zh
@@ -19,6 +23,14 @@ moment 只有在zh_CN才翻译
 
 @bp.before_request
 def before_request():
+    if request.endpoint == 'main.search_suggest':
+        # 自动补全每次按键都会请求，不更新 last_seen，不写数据库
+        return
+    if request.endpoint == 'main.notifications':
+        # 通知没有变化时直接返回 304，不加载用户也不写数据库
+        response = notify.not_modified()
+        if response is not None:
+            return response
     # 获取语言设置到g
     g.locale = str(get_locale())
     if g.locale == 'zh_Hans_CN':
@@ -44,6 +56,30 @@ def _get_page_num():
     return page
 
 
+def _get_count_mode():
+    # 总数的计算方式按 endpoint 在 COUNT_MODES 里配置，见 app.counts
+    return current_app.config['COUNT_MODES'].get(request.endpoint, 'exact')
+
+
+def _get_cursor():
+    # 请求带了 cursor 参数或者配置了 CURSOR_PAGINATION 时使用游标分页，第一页的游标是空字符串
+    if 'cursor' in request.args or current_app.config['CURSOR_PAGINATION']:
+        return request.args.get('cursor', '')
+    return None
+
+
+def _get_cursor_pager(query, endpoint, **kwargs):
+    # 游标分页没有总数，也就没有页码
+    return {
+        'next_url': url_for(endpoint, cursor=query.next_cursor, **kwargs) if query.has_next else None,
+        'prev_url': url_for(endpoint, cursor=query.prev_cursor, **kwargs) if query.has_prev else None,
+        'total': None,
+        'total_exact': False,
+        'page': None,
+        'page_count': 0
+    }
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
@@ -52,11 +88,7 @@ def index():
     if form.validate_on_submit():
         # 确定语言，避免在每次加载的时候确定
         # 出错的几率大，有道的话直接用auto即可
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        if language == 'zh':
-            language = 'zh_CN'
+        language = detect_language(form.post.data)
         post = Post(body=form.post.data,
                     author=current_user, language=language)
         db.session.add(post)
@@ -64,15 +96,23 @@ def index():
         flash(_('发表成功'))
         return redirect(url_for('main.index'))
 
+    cursor = _get_cursor()
+    if cursor is not None:
+        posts = current_user.home_timeline(
+            1, current_app.config['POSTS_PER_PAGE'], cursor=cursor)
+        pager = _get_cursor_pager(posts, 'main.index')
+        return render_template('index.html', title=_('主页'), form=form, posts=posts.items, pager=pager)
+
     page = _get_page_num()
-    posts = current_user.followed_posts()\
-        .paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    posts = current_user.home_timeline(page, current_app.config['POSTS_PER_PAGE'],
+                                       count_mode=_get_count_mode())
 
     next_url, prev_url = _get_paginate_url(posts, 'main.index')
     pager = {
         'next_url': next_url,
         'prev_url': prev_url,
         'total': posts.total,
+        'total_exact': posts.exact,
         'page': page,
         'page_count': ceil(posts.total/current_app.config['POSTS_PER_PAGE'])
     }
@@ -82,15 +122,24 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
+    cursor = _get_cursor()
+    if cursor is not None:
+        posts = keyset_paginate(Post.query, Post.cursor_columns(),
+                                cursor, current_app.config['POSTS_PER_PAGE'])
+        pager = _get_cursor_pager(posts, 'main.explore')
+        return render_template('index.html', title=_('博客'), posts=posts.items, pager=pager)
+
     page = _get_page_num()
-    posts = Post.query.order_by(Post.timestamp.desc())\
-        .paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    total = counts.get_total('post', Post.query, table='post')
+    posts = paginate(Post.query.order_by(Post.timestamp.desc()),
+                     page, current_app.config['POSTS_PER_PAGE'], *total)
 
     next_url, prev_url = _get_paginate_url(posts, 'main.explore')
     pager = {
         'next_url': next_url,
         'prev_url': prev_url,
         'total': posts.total,
+        'total_exact': posts.exact,
         'page': page,
         'page_count': ceil(posts.total/current_app.config['POSTS_PER_PAGE'])
     }
@@ -103,14 +152,31 @@ def explore():
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
 
-    page = _get_page_num()
-    posts = user.posts.order_by(Post.timestamp.desc())\
-        .paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    cursor = _get_cursor()
+    if cursor is not None:
+        posts = keyset_paginate(user.posts, Post.cursor_columns(),
+                                cursor, current_app.config['POSTS_PER_PAGE'])
+        pager = _get_cursor_pager(posts, 'main.user', username=user.username)
+        next_url, prev_url = pager['next_url'], pager['prev_url']
+    else:
+        page = _get_page_num()
+        posts = paginate(user.posts.order_by(Post.timestamp.desc()),
+                         page, current_app.config['POSTS_PER_PAGE'], user.post_count)
+
+        next_url, prev_url = _get_paginate_url(
+            posts, 'main.user', username=user.username)
 
-    next_url, prev_url = _get_paginate_url(
-        posts, 'main.user', username=user.username)
+    mutuals = current_user.mutual_followers(user) if user != current_user else None
+    import_form = ImportPostsForm() if user == current_user else None
 
-    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url, format=current_app.config['DATETIME_FORMAT'])
+    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url, mutuals=mutuals, import_form=import_form, format=current_app.config['DATETIME_FORMAT'])
+
+
+@bp.route('/suggestions')
+@login_required
+def suggestions():
+    users = current_user.suggested_users(current_app.config['SUGGESTIONS_TOP_K'])
+    return render_template('suggestions.html', title=_('推荐关注'), users=users)
 
 
 @bp.route('/user/profile', methods=['GET', 'POST'])
@@ -179,6 +245,15 @@ def search():
     return render_template('search.html', title=_('搜索'), posts=posts, total=total, next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/search/suggest')
+@login_required
+def search_suggest():
+    ''' 搜索框自动补全，和搜索一样要先登录，候选词都在内存里，除了加载用户不查询数据库 '''
+    limit = min(request.args.get('limit', current_app.config['TYPEAHEAD_LIMIT'], int),
+                current_app.config['TYPEAHEAD_LIMIT'])
+    return jsonify(typeahead.suggest(request.args.get('q', ''), limit))
+
+
 @bp.route('/user/<username>/popup')
 def user_popup(username):
     user = User.query.filter_by(username=username).first_or_404()
@@ -196,8 +271,10 @@ def send_message(receiver):
                           receiver=user,
                           body=form.message.data)
         db.session.add(message)
+        # flush 时 unread_message_count 加一（SQL 表达式），再读出来就是加过之后的值
+        db.session.flush()
         # 添加用户通知
-        user.add_notification(current_app.config['UNREAD_MESSAGE_COUNT'], user.unread_messages_count())
+        user.add_notification(current_app.config['UNREAD_MESSAGE_COUNT'], user.unread_message_count)
         db.session.commit()
         flash(_('消息发送成功'))
         return redirect(url_for('main.user',username=receiver))
@@ -208,14 +285,23 @@ def send_message(receiver):
 @login_required
 def messages():
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_message_count = 0
     current_user.add_notification(current_app.config['UNREAD_MESSAGE_COUNT'], 0)
     db.session.commit()
 
+    cursor = _get_cursor()
+    if cursor is not None:
+        messages = keyset_paginate(current_user.received_messages, [Message.timestamp, Message.id],
+                                   cursor, current_app.config['POSTS_PER_PAGE'])
+        pager = _get_cursor_pager(messages, 'main.messages')
+        return render_template('messages.html', pager=pager, messages=messages.items)
+
     page = _get_page_num()
 
-    messages = current_user.received_messages\
-    .order_by(Message.timestamp.desc())\
-    .paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    total = counts.get_total('message:receiver:{}'.format(current_user.id),
+                             current_user.received_messages)
+    messages = paginate(current_user.received_messages.order_by(Message.timestamp.desc()),
+                        page, current_app.config['POSTS_PER_PAGE'], *total)
 
     next_url, prev_url = _get_paginate_url(messages, 'main.messages')
 
@@ -223,6 +309,7 @@ def messages():
         'next_url': next_url,
         'prev_url': prev_url,
         'total': messages.total,
+        'total_exact': messages.exact,
         'page': page,
         'page_count': ceil(messages.total/current_app.config['POSTS_PER_PAGE'])
     }
@@ -232,14 +319,53 @@ def messages():
 @bp.route('/notifications')
 @login_required
 def notifications():
-    notifications = current_user.notifications.filter_by(is_read=False)
-    current_user.notifications.filter(Notification.name.in_(['unread_message_count'])).update({'is_read':True},synchronize_session=False)
-    db.session.commit()
-    return jsonify([
-        {'name': x.name,
-        'data': x.get_data()
-        } for x in notifications
-    ])
+    since = request.args.get('since', type=float)
+    if since is None:
+        # 先读版本号再查询，查询期间有新通知时下次请求版本号不同
+        version = notify.version(current_user.id)
+        notifications = current_user.notifications.filter_by(is_read=False)
+        current_user.notifications.filter(Notification.name.in_(['unread_message_count'])).update({'is_read':True},synchronize_session=False)
+        db.session.commit()
+        notify.count_poll(False)
+        response = jsonify([
+            {'name': x.name,
+            'data': x.get_data()
+            } for x in notifications
+        ])
+        if version is not None:
+            response.set_etag(version)
+        return response
+
+    # 长轮询：返回 since 之后的通知，没有的话在频道上等待，不写数据库
+    wait = min(request.args.get('wait', 0, float), current_app.config['NOTIFICATION_LONG_POLL'])
+    pubsub = notify.subscribe(current_user.id) if wait > 0 else None
+    try:
+        result = [notify.message(x) for x in current_user.notifications
+                  .filter(Notification.timestamp > since).order_by(Notification.timestamp)]
+        if not result and pubsub is not None:
+            # 等待的时候不占用数据库连接
+            db.session.remove()
+            result = notify.wait(pubsub, wait)
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+    return jsonify(result)
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    pubsub = notify.subscribe(current_user.id)
+    snapshot = [notify.message(x) for x in current_user.notifications.filter_by(is_read=False)]
+    db.session.remove()
+    response = Response(notify.stream(pubsub, snapshot,
+                                      current_app.config['NOTIFICATION_STREAM_TIMEOUT'],
+                                      current_app.config['NOTIFICATION_HEARTBEAT']),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx 不缓冲，事件立即发送
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @bp.route('/export_posts')
 def export_posts():
@@ -248,4 +374,32 @@ def export_posts():
     else:
         current_user.add_task('export_posts',_('正在导出博客...'))
         db.session.commit()
-    return redirect(url_for('main.user', username=current_user.username))
\ No newline at end of file
+    return redirect(url_for('main.user', username=current_user.username))
+
+
+@bp.route('/import_posts', methods=['POST'])
+@login_required
+def import_posts():
+    form = ImportPostsForm()
+    if not form.validate_on_submit():
+        flash(_('请选择要导入的文件'))
+    elif current_user.get_task_in_progress('import_posts') is not None:
+        flash(_('已经有导入任务在运行了'))
+    else:
+        # 分块保存到磁盘，大小已经由 MAX_CONTENT_LENGTH 限制
+        os.makedirs(current_app.config['IMPORT_DIR'], exist_ok=True)
+        filename = os.path.join(current_app.config['IMPORT_DIR'], '{}.ndjson'.format(uuid.uuid4().hex))
+        form.file.data.save(filename)
+        current_user.add_task('import_posts', _('正在导入博客...'), filename)
+        db.session.commit()
+    return redirect(url_for('main.user', username=current_user.username))
+
+@bp.route('/export_posts/<task_id>')
+@login_required
+def download_export(task_id):
+    task = Task.query.filter_by(id=task_id, user_id=current_user.id, name='export_posts').first_or_404()
+    filename = exports.path(task.id)
+    if not task.complete or not os.path.exists(filename):
+        abort(404)
+    return send_from_directory(os.path.dirname(filename), os.path.basename(filename), as_attachment=True,
+                               attachment_filename='posts.ndjson.gz', mimetype='application/gzip')
@@ -5,13 +5,32 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from hashlib import md5
 import jwt
 from time import time
-from flask import current_app, url_for
-from app.search import add_to_index, remove_from_index, query_index
+from sqlalchemy import inspect
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql.expression import ClauseElement
+from flask import current_app, url_for, g, has_request_context
+from app.search import search_index, bulk as bulk_index, payload as search_payload, reindex as reindex_index, \
+    is_local as search_is_local, request_reload as search_request_reload
+from elasticsearch.exceptions import ElasticsearchException
+from app import timeline
+from app import counts
+from app import follows
+from app import suggestions
+from app import mutuals
+from app import typeahead
+from app import notify
+from app.pagination import decode_cursor, keyset_paginate, make_page, paginate, Page
 import json
 import redis
 import rq
 import base64
 import os
+import pickle
+
+
+def avatar_url(email, size=128):
+    tmp = md5(email.lower().encode('utf-8')).hexdigest()  # d=mm
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(tmp, size)
 
 
 @login.user_loader
@@ -20,15 +39,22 @@ def load_user(id):
 
 class PaginatedAPIMixin(object):
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        result = query.paginate(page, per_page, False)
+    def to_collection_dict(query, page, per_page, endpoint, total=None, **kwargs):
+        # total 是 app.counts.get_total 返回的 (total, exact)，没有时直接 COUNT
+        if total is None:
+            result = query.paginate(page, per_page, False)
+            exact = True
+        else:
+            result = paginate(query, page, per_page, *total)
+            exact = result.exact
         data = {
             'items': [item.to_dict() for item in result.items],
             '_meta': {
                 'page': page,
                 'per_page': per_page,
                 'total_pages': result.pages,
-                'total_items': result.total
+                'total_items': result.total,
+                'total_exact': exact
             },
             '_links':{
                 'self': url_for(endpoint,page=page,per_page=per_page,**kwargs),
@@ -38,61 +64,106 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @staticmethod
+    def to_cursor_collection_dict(query, columns, cursor, per_page, endpoint, **kwargs):
+        ''' 游标分页，columns 是排序键，_links 里的 next/prev 带上不透明的游标 '''
+        result = keyset_paginate(query, columns, cursor, per_page)
+        data = {
+            'items': [item.to_dict() for item in result.items],
+            '_meta': {
+                'per_page': per_page,
+                'cursor': cursor or None
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                'next': url_for(endpoint, cursor=result.next_cursor, per_page=per_page, **kwargs) if result.has_next else None,
+                'prev': url_for(endpoint, cursor=result.prev_cursor, per_page=per_page, **kwargs) if result.has_prev else None
+            }
+        }
+        return data
+
 class SearchableMixin(object):
     '''
     写好search.py后，需要在添加修改和删除的时候更新对应的索引，这里用数据库的接口实现
-    查询返回的是ids，需要返回对应的Model
+    查询返回的是ids，由 hydrate 按相关度的顺序取出对应的数据
     '''
     @classmethod
     def search(cls, query, page, per_page):
-        ids, total = query_index(cls.__tablename__, query, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+        ''' 返回 (结果列表, total)，结果由 hydrate 决定，默认是 Model 对象 '''
+        hits, total = search_index(cls.__tablename__, query, page, per_page, highlight=True)
+        return cls.hydrate(hits), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def hydrate(cls, hits):
+        ''' hits 是 [(id, 高亮)]，一次查询取出对象，在 python 里按相关度排序，已经删除的跳过 '''
+        ids = [id for id, _ in hits]
+        objects = {x.id: x for x in cls.query.filter(cls.id.in_(ids))} if ids else {}
+        return [objects[id] for id in ids if id in objects]
 
     @classmethod
-    def after_commit(cls, session):
-        for x in session._changes['add']:
+    def after_flush(cls, session, flush_context):
+        '''
+        flush 之后记下要更新的索引，这时新对象已经有 id，修改历史还在，
+        只有 __searchable__ 字段变了的修改才需要重新索引。同一个对象后面的修改覆盖前面的
+        '''
+        changes = session.info.setdefault('search_changes', {})
+        for x in session.new:
             if isinstance(x, SearchableMixin):
-                add_to_index(x.__tablename__, x)
-
-        for x in session._changes['update']:
+                changes[(x.__tablename__, x.id)] = search_payload(x)
+        for x in session.dirty:
+            if isinstance(x, SearchableMixin) and x not in session.deleted:
+                state = inspect(x)
+                if any(state.attrs[f].history.has_changes() for f in x.__searchable__):
+                    changes[(x.__tablename__, x.id)] = search_payload(x)
+        for x in session.deleted:
             if isinstance(x, SearchableMixin):
-                add_to_index(x.__tablename__, x)
+                changes[(x.__tablename__, x.id)] = None
 
-        for x in session._changes['delete']:
-            if isinstance(x, SearchableMixin):
-                remove_from_index(x.__tablename__, x)
-        session._changes = None
+    @classmethod
+    def after_commit(cls, session):
+        ''' 一次 _bulk 请求提交整个事务的修改，配置了 SEARCH_INDEX_ASYNC 时交给 rq 执行 '''
+        changes = session.info.pop('search_changes', None)
+        if not changes or not current_app.elasticsearch:
+            return
+        actions = [(index, id, doc) for (index, id), doc in changes.items()]
+        # 内置搜索的索引在每个进程的内存里，worker 写入的当前进程看不到
+        if current_app.config['SEARCH_INDEX_ASYNC'] and not search_is_local():
+            try:
+                current_app.task_queue.enqueue('app.tasks.index_documents', actions)
+                return
+            except redis.exceptions.RedisError:
+                current_app.logger.warning('task queue unavailable, indexing inline', exc_info=True)
+        try:
+            bulk_index(actions)
+        except ElasticsearchException:
+            # 数据库已经提交了，索引失败只记录，之后可以 reindex
+            current_app.logger.error('bulk index failed', exc_info=True)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
 
     @classmethod
-    def reindex(cls):
-        for x in cls.query:
-            add_to_index(cls.__tablename__, x)
+    def reindex(cls, **kwargs):
+        ''' 重建索引，参数见 app.search.reindex，内置搜索时其它进程也从数据库重新建立 '''
+        result = reindex_index(cls, **kwargs)
+        search_request_reload(cls.__tablename__)
+        return result
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
-# 多对多
+# 多对多，(follower_id, followed_id) 是主键，反向的索引用于查粉丝
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer,
-                               db.ForeignKey('user.id')),
+                               db.ForeignKey('user.id'), primary_key=True),
                      db.Column('followed_id', db.Integer,
-                               db.ForeignKey('user.id'))
+                               db.ForeignKey('user.id'), primary_key=True),
+                     db.Index('ix_followers_followed_id_follower_id',
+                              'followed_id', 'follower_id')
                      )
 
 
@@ -110,6 +181,8 @@ class Message(db.Model):
 
 class Notification(db.Model):
     __tablename__ = 'notification'
+    # 每个用户每种通知只有一行，见 User.add_notification
+    __table_args__ = (db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),)
     id = db.Column(db.Integer,primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -120,6 +193,23 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(self.payload)
 
+    @staticmethod
+    def prune(read_age, max_age, batch_size=1000):
+        '''
+        分批删除已读超过 read_age 秒、或者超过 max_age 秒没有更新的通知，返回删除了多少条
+        每批一个事务，不会长时间锁住整张表
+        '''
+        now = time()
+        stale = db.or_(db.and_(Notification.is_read.is_(True), Notification.timestamp < now - read_age),
+                       Notification.timestamp < now - max_age)
+        deleted = 0
+        while True:
+            ids = [id for id, in db.session.query(Notification.id).filter(stale).limit(batch_size)]
+            if not ids:
+                return deleted
+            deleted += Notification.query.filter(Notification.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
     def __repr__(self):
         return '<notification {}>'.format(self.name)
 
@@ -140,8 +230,30 @@ class Task(db.Model):
         return job
     
     def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
+        return Task.get_progress_many([self])[self.id]
+
+    @staticmethod
+    def get_progress_many(tasks):
+        '''
+        返回 {task.id: 进度}，所有任务的 job 在一个 redis pipeline 里读取，job 已经不存在时是 100
+        请求里读过的进度记在 g 里，同一个请求再次读取不访问 redis
+        '''
+        memo = g.setdefault('task_progress', {}) if has_request_context() else {}
+        missing = [task.id for task in tasks if task.id not in memo]
+        if missing:
+            try:
+                pipe = current_app.redis.pipeline(transaction=False)
+                for id in missing:
+                    key = rq.job.Job.key_for(id)
+                    pipe.exists(key)
+                    pipe.hget(key, 'meta')
+                result = pipe.execute()
+            except redis.exceptions.RedisError:
+                result = [0, None] * len(missing)
+            for id, exists, meta in zip(missing, result[::2], result[1::2]):
+                # meta 是 rq 默认序列化（pickle）的字典
+                memo[id] = pickle.loads(meta).get('progress', 0) if meta else (0 if exists else 100)
+        return {task.id: memo[task.id] for task in tasks}
 
 
 
@@ -176,6 +288,13 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
 
+    # 冗余的计数，follow/unfollow 和博客的增删时同步更新，避免 to_dict 里的 COUNT
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 未读私信数，收到私信时加一，打开私信页面时清零
+    unread_message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
 
     sent_messages = db.relationship(
         'Message', foreign_keys='Message.sender_id', backref='author', lazy='dynamic')
@@ -183,20 +302,41 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         'Message', foreign_keys='Message.receiver_id', backref='receiver', lazy='dynamic')
 
     def unread_messages_count(self):
+        ''' 用 COUNT 计算未读私信数，平时读 unread_message_count，这里只用来核对 '''
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
         return Message.query.filter_by(receiver=self)\
             .filter(Message.timestamp > last_read_time)\
             .count()
 
-    def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        noti = Notification(name=name,user=self,payload=json.dumps(data))
-        db.session.add(noti)
+    def add_notification(self, name, data, interval=0):
+        '''
+        每种通知只保留一行：已经有的原地更新，没有的插入，(user_id, name) 上有唯一索引
+        interval 秒之内更新过的不再写入，返回 None，进度这类频繁的通知用它合并写入
+        插入和更新是一条 upsert 语句（见 _upsert），两个事务同时插入同一种通知时后面的变成更新
+        '''
+        now = time()
+        noti = self.notifications.filter_by(name=name).first()
+        if noti is not None and now - noti.timestamp < interval:
+            return None
+        if inspect(self).persistent:
+            db.session.execute(_upsert(Notification.__table__, ['user_id', 'name'], {
+                'user_id': self.id, 'name': name, 'payload': json.dumps(data),
+                'timestamp': now, 'is_read': False}))
+            # 已经加载的对象用写入的值覆盖
+            noti = self.notifications.filter_by(name=name).populate_existing().one()
+        elif noti is None:
+            noti = Notification(name=name,user=self,payload=json.dumps(data),timestamp=now)
+            db.session.add(noti)
+        else:
+            noti.payload = json.dumps(data)
+            noti.timestamp = now
+            noti.is_read = False
+        # 提交之后推送给浏览器，见 app/notify.py
+        notify.record(db.session, self.id, noti)
         return noti
 
     def avatar(self, size=128):
-        tmp = md5(self.email.lower().encode('utf-8')).hexdigest()  # d=mm
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(tmp, size)
+        return avatar_url(self.email, size)
 
     def set_password(self,  password):
         self.password_hash = generate_password_hash(password)
@@ -207,14 +347,101 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            follows.record(db.session, self.id, user.id, True)
+            mutuals.record(db.session, self.id, user.id)
+            suggestions.record(db.session, self.id)
+            _increment(self, 'followed_count', 1)
+            _increment(user, 'follower_count', 1)
+            timeline.record(db.session, self.id, added=user.recent_posts().all())
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            follows.record(db.session, self.id, user.id, False)
+            mutuals.record(db.session, self.id, user.id)
+            suggestions.record(db.session, self.id)
+            _increment(self, 'followed_count', -1)
+            _increment(user, 'follower_count', -1)
+            timeline.record(db.session, self.id, removed=[id for id, _ in user.recent_posts()])
+
+    def follow_many(self, user_ids):
+        '''
+        批量关注，返回新关注的 id 列表。一次查询找出存在并且还没有关注的用户，
+        一条多行 INSERT 写入，粉丝数用一条 UPDATE 更新，缓存按批处理
+        '''
+        user_ids = set(user_ids) - {self.id}
+        if not user_ids:
+            return []
+        edge = db.and_(followers.c.followed_id == User.id, followers.c.follower_id == self.id)
+        new_ids = [id for id, in db.session.query(User.id).outerjoin(followers, edge)
+                   .filter(User.id.in_(user_ids), followers.c.follower_id.is_(None))
+                   .order_by(User.id)]
+        if not new_ids:
+            return []
+        db.session.execute(followers.insert().values(
+            [{'follower_id': self.id, 'followed_id': id} for id in new_ids]))
+        self._after_bulk_follow(new_ids, True)
+        timeline.record(db.session, self.id, added=Post.query.with_entities(Post.id, Post.timestamp)
+                        .filter(Post.user_id.in_(new_ids))
+                        .order_by(Post.timestamp.desc())
+                        .limit(current_app.config['TIMELINE_MAX_LENGTH']).all())
+        return new_ids
+
+    def unfollow_many(self, user_ids):
+        ''' 批量取关，返回取关的 id 列表，和 follow_many 一样一条 DELETE 删除 '''
+        user_ids = set(user_ids) - {self.id}
+        if not user_ids:
+            return []
+        old_ids = [id for id, in db.session.query(followers.c.followed_id)
+                   .filter(followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids))
+                   .order_by(followers.c.followed_id)]
+        if not old_ids:
+            return []
+        db.session.execute(followers.delete().where(db.and_(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(old_ids))))
+        self._after_bulk_follow(old_ids, False)
+        timeline.record(db.session, self.id, removed=[id for id, in Post.query.with_entities(Post.id)
+                        .filter(Post.user_id.in_(old_ids))
+                        .order_by(Post.timestamp.desc())
+                        .limit(current_app.config['TIMELINE_MAX_LENGTH'])])
+        return old_ids
+
+    def _after_bulk_follow(self, user_ids, is_follow):
+        delta = 1 if is_follow else -1
+        db.session.execute(User.__table__.update().where(User.id.in_(user_ids)).values(
+            follower_count=User.__table__.c.follower_count + delta))
+        _increment(self, 'followed_count', delta * len(user_ids))
+        for id in user_ids:
+            follows.record(db.session, self.id, id, is_follow)
+            mutuals.record(db.session, self.id, id)
+        suggestions.record(db.session, self.id)
+        # 已经加载的用户对象里的 follower_count 过时了，有未保存修改的留给 flush 处理
+        user_ids = set(user_ids)
+        for x in list(db.session.identity_map.values()):
+            if isinstance(x, User) and x.id in user_ids and \
+                    'follower_count' not in inspect(x).committed_state:
+                db.session.expire(x, ['follower_count'])
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return user.id in self.is_following_many([user.id])
+
+    def is_following_many(self, user_ids):
+        ''' 批量判断关注关系，返回 user_ids 里已经关注的 id 集合，最多一次缓存往返 '''
+        return follows.is_following_many(self.id, user_ids)
+
+    def mutual_followers(self, user, sample=3):
+        ''' 自己关注的人里也关注了 user 的，返回 (数量, 最多 sample 个用户) '''
+        count, ids = mutuals.mutual_followers(self.id, user.id, sample, self.followed_count, user.follower_count)
+        users = {x.id: x for x in User.query.filter(User.id.in_(ids))} if ids else {}
+        return count, [users[id] for id in ids if id in users]
+
+    def suggested_users(self, limit):
+        ''' 推荐关注的用户 [(user, 重合数)]，去掉离线计算之后已经关注了的 '''
+        rows = suggestions.get(self.id, limit)
+        following = self.is_following_many([id for id, _ in rows])
+        rows = [(id, n) for id, n in rows if id not in following]
+        users = {x.id: x for x in User.query.filter(User.id.in_([id for id, _ in rows]))} if rows else {}
+        return [(users[id], n) for id, n in rows if id in users]
 
     def followed_posts(self):
         followed = Post.query.join(followers, (followers.c.followed_id == Post.user_id))\
@@ -225,6 +452,66 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return followed.union(own)\
             .order_by(Post.timestamp.desc())
 
+    def recent_posts(self):
+        ''' 最近的博客 (id, timestamp)，数量和时间线缓存的长度一致 '''
+        return self.posts.with_entities(Post.id, Post.timestamp)\
+            .order_by(Post.timestamp.desc())\
+            .limit(current_app.config['TIMELINE_MAX_LENGTH'])
+
+    def rebuild_timeline(self, authors=()):
+        ''' 重建时间线，authors 是关注的大V，他们的列表没有建立或者已经过期时一起建立 '''
+        max_length = current_app.config['TIMELINE_MAX_LENGTH']
+        posts = self.followed_posts().with_entities(Post.id, Post.timestamp).limit(max_length).all()
+        timeline.rebuild(self.id, posts)
+        for author_id in timeline.cold_authors(authors):
+            timeline.rebuild_author(author_id, Post.query.with_entities(Post.id, Post.timestamp)
+                                    .filter(Post.user_id == author_id)
+                                    .order_by(Post.timestamp.desc()).limit(max_length).all())
+
+    def home_timeline(self, page, per_page, cursor=None, count_mode='exact'):
+        '''
+        首页的博客，可以直接替换 followed_posts().paginate()，返回同样的 Pagination 对象
+        传入 cursor 时使用游标分页，返回 CursorPage
+        优先从时间线缓存读取 post id，并归并关注的大V的博客
+        缓存没有建立时用 followed_posts 查询，并在第一页时建立缓存，总数按 count_mode 计算
+        '''
+        authors = timeline.celebrities()
+        if authors:
+            authors = [id for id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(authors))]
+        if cursor is not None:
+            return self._home_timeline_cursor(cursor, per_page, authors)
+
+        cached = timeline.get_page(self.id, page, per_page, authors)
+        if cached is None:
+            total = counts.get_total('timeline:{}'.format(self.id),
+                                     self.followed_posts(), count_mode)
+            posts = paginate(self.followed_posts(), page, per_page, *total)
+            if page == 1:
+                self.rebuild_timeline(authors)
+            return posts
+        ids, total = cached
+        # 缓存有长度上限，归并大V时也可能有重复，这时总数不精确
+        exact = not authors and total < current_app.config['TIMELINE_MAX_LENGTH']
+        return Page(None, page, per_page, total, Post.load(ids), exact)
+
+    def _home_timeline_cursor(self, cursor, per_page, authors):
+        direction, values = decode_cursor(cursor)
+        bound = None
+        if values is not None and len(values) == 2 and isinstance(values[0], datetime):
+            bound = (timeline.to_score(values[0]), values[1])
+        else:
+            direction = 'first'
+        cached = timeline.read(self.id, per_page + 1, authors=authors,
+                               bound=bound, ascending=direction == 'prev')
+        if cached is None:
+            if direction == 'first':
+                self.rebuild_timeline(authors)
+            return keyset_paginate(self.followed_posts(), Post.cursor_columns(), cursor, per_page)
+        rows, total = cached
+        return make_page(Post.load([id for id, score in rows]), per_page, direction,
+                         key=lambda x: [x.timestamp, x.id])
+
     def get_reset_password_token(self, expires=600):
         # 链接有效时间10分钟,单位是秒
         token = jwt.encode({'reset_password': self.id, 'exp': time()+expires},
@@ -247,7 +534,10 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return task
     
     def get_tasks_in_progress(self):
-        return self.tasks.filter_by(complete=False).all()
+        tasks = self.tasks.filter_by(complete=False).all()
+        # 页面上会显示每个任务的进度，一次读出来
+        Task.get_progress_many(tasks)
+        return tasks
     
     def get_task_in_progress(self,name):
         return self.tasks.filter_by(name=name,complete=False).first()
@@ -258,9 +548,9 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             'username': self.username,
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            'post_count': self.post_count,
+            'follower_count': self.follower_count,
+            'followed_count': self.followed_count,
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -298,6 +588,36 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return None
         return user
 
+    @staticmethod
+    def reconcile_counters(batch_size=1000):
+        '''
+        按 id 分批用 COUNT 重新计算冗余的计数，返回修正了多少个用户
+        '''
+        fixed = 0
+        max_id = db.session.query(db.func.max(User.id)).scalar() or 0
+        for start in range(1, max_id + 1, batch_size):
+            for column, subquery in User._counter_subqueries():
+                result = db.session.execute(
+                    User.__table__.update()
+                    .where(User.id.between(start, start + batch_size - 1))
+                    .where(column != subquery)
+                    .values({column: subquery}))
+                fixed += result.rowcount
+            db.session.commit()
+        return fixed
+
+    @staticmethod
+    def _counter_subqueries():
+        def count(column):
+            return db.select([db.func.count()]).where(column == User.id).as_scalar()
+        return [
+            (User.post_count, count(Post.user_id)),
+            (User.follower_count, count(followers.c.followed_id)),
+            (User.followed_count, count(followers.c.follower_id)),
+            (User.unread_message_count, db.select([db.func.count()]).where(Message.receiver_id == User.id).where(
+                Message.timestamp > db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))).as_scalar()),
+        ]
+
     def __repr__(self):
         return '<用户名：{}>'.format(self.username)
 
@@ -311,6 +631,223 @@ class Post(db.Model, SearchableMixin):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(10))
 
+    @staticmethod
+    def cursor_columns():
+        ''' 游标分页的排序键 '''
+        return [Post.timestamp, Post.id]
+
+    @classmethod
+    def hydrate(cls, hits):
+        ''' 搜索结果一次连接查询取出博客和作者用到的字段，返回 PostResult，模板里不再逐个加载作者 '''
+        ids = [id for id, _ in hits]
+        if not ids:
+            return []
+        rows = db.session.query(Post.id, Post.body, Post.timestamp, Post.language,
+                                User.id, User.username, User.email)\
+            .join(User, Post.user_id == User.id).filter(Post.id.in_(ids))
+        rows = {row[0]: row for row in rows}
+        results = []
+        for id, fragments in hits:
+            row = rows.get(id)
+            if row is not None:
+                results.append(PostResult(row[0], row[1], row[2], row[3],
+                                          PostAuthor(*row[4:]), (fragments or {}).get('body')))
+        return results
+
+    @staticmethod
+    def load(ids):
+        ''' 按 ids 的顺序取出博客，已经删除的跳过 '''
+        posts = {x.id: x for x in Post.query.filter(Post.id.in_(ids))} if ids else {}
+        return [posts[id] for id in ids if id in posts]
+
     def __repr__(self):
         return '<post {}>'.format(self.body)
 
+
+class PostAuthor(object):
+    ''' 搜索结果里的作者，只有 _post.html 用到的字段 '''
+    __slots__ = ('id', 'username', 'email')
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+    def avatar(self, size=128):
+        return avatar_url(self.email, size)
+
+
+class PostResult(object):
+    ''' 搜索结果，字段和 Post 一样可以直接用 _post.html 显示，highlight 是高亮后的 html '''
+    __slots__ = ('id', 'body', 'timestamp', 'language', 'author', 'highlight')
+
+    def __init__(self, id, body, timestamp, language, author, highlight=None):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.author = author
+        self.highlight = highlight
+
+
+def _upsert(table, keys, values):
+    '''
+    一条语句的 INSERT，和 keys 上的唯一索引冲突时用 values 更新这一行，keys 以外的列都更新
+    '''
+    update = [c for c in values if c not in keys]
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(values)
+        return stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update})
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table).values(values)
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update})
+    # SQLite 3.24 以上支持 ON CONFLICT DO UPDATE，SQLAlchemy 1.3 还没有对应的接口
+    quote = db.engine.dialect.identifier_preparer.quote
+    sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}'.format(
+        quote(table.name), ', '.join(quote(c) for c in values), ', '.join(':' + c for c in values),
+        ', '.join(quote(c) for c in keys), ', '.join('{0} = excluded.{0}'.format(quote(c)) for c in update))
+    return db.text(sql).bindparams(**values)
+
+
+def _increment(obj, attr, delta):
+    '''
+    计数加上 delta，已经保存的对象用 SQL 表达式 column = column + delta，并发更新也不会丢失
+    '''
+    state = inspect(obj)
+    current = state.dict.get(attr)
+    if isinstance(current, ClauseElement):
+        setattr(obj, attr, current + delta)
+    elif state.persistent:
+        setattr(obj, attr, getattr(type(obj), attr) + delta)
+    else:
+        setattr(obj, attr, (current or 0) + delta)
+
+
+def _increment_user(session, obj, relation, user_id, attr, delta):
+    '''
+    给 obj 关联的用户计数，只设置了外键（比如 Post(user_id=...)）或者关系没有加载时按 id 更新
+    已经加载的用户对象用 _increment，没有加载的直接执行 UPDATE，不为了计数去查询用户
+    '''
+    user = inspect(obj).dict.get(relation)
+    if user is None and user_id is not None:
+        user = session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        _increment(user, attr, delta)
+    elif user_id is not None:
+        session.execute(User.__table__.update().where(User.id == user_id).values(
+            {attr: getattr(User.__table__.c, attr) + delta}))
+
+
+def _update_counters(session, flush_context, instances):
+    with session.no_autoflush:
+        for x, delta in [(x, 1) for x in session.new] + [(x, -1) for x in session.deleted]:
+            if isinstance(x, Post):
+                _increment_user(session, x, 'author', x.user_id, 'post_count', delta)
+            elif isinstance(x, Message) and delta > 0:
+                _increment_user(session, x, 'receiver', x.receiver_id, 'unread_message_count', 1)
+
+
+def _collect_count_deltas(session, flush_context):
+    for x, delta in [(x, 1) for x in session.new] + [(x, -1) for x in session.deleted]:
+        if isinstance(x, Post):
+            counts.record(session, 'post', delta)
+        elif isinstance(x, Message):
+            counts.record(session, 'message', delta)
+            counts.record(session, 'message:receiver:{}'.format(x.receiver_id), delta)
+        elif isinstance(x, User):
+            counts.record(session, 'user', delta)
+
+
+def _follower_count(session, user_id):
+    # 已经加载的用户直接用对象上的冗余字段，没有加载或者已经过期时查询
+    user = session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        count = inspect(user).dict.get('follower_count')
+        if isinstance(count, int):
+            return count
+    return session.execute(db.select([User.follower_count]).where(User.id == user_id)).scalar() or 0
+
+
+def _follower_ids(session, user_id):
+    return [row[0] for row in session.execute(
+        db.select([followers.c.follower_id]).where(followers.c.followed_id == user_id))]
+
+
+def _collect_new_posts(session, flush_context):
+    '''
+    flush 之后 post 已经有了 id，在事务里把粉丝查出来，提交后再推送到时间线
+    粉丝数超过 TIMELINE_FANOUT_ASYNC_THRESHOLD 的不在请求里查询，提交后交给 rq（见 fan_out_post）
+    '''
+    pending = session.info.setdefault('timeline_posts', [])
+    threshold = current_app.config['TIMELINE_CELEBRITY_THRESHOLD']
+    async_threshold = current_app.config['TIMELINE_FANOUT_ASYNC_THRESHOLD']
+    follower_counts = {}
+    for x in session.new:
+        if isinstance(x, Post):
+            if x.user_id not in follower_counts:
+                follower_counts[x.user_id] = _follower_count(session, x.user_id)
+            follower_count = follower_counts[x.user_id]
+            if follower_count >= threshold:
+                pending.append((x.id, x.timestamp, x.user_id, None, False))
+            elif follower_count > async_threshold:
+                pending.append((x.id, x.timestamp, x.user_id, None, True))
+            else:
+                pending.append((x.id, x.timestamp, x.user_id, _follower_ids(session, x.user_id), False))
+
+
+def fan_out_post(post_id, timestamp, author_id):
+    ''' 查询粉丝并推送到他们的时间线，在 rq worker 里执行（app.tasks.push_post） '''
+    follower_ids = None
+    if _follower_count(db.session, author_id) < current_app.config['TIMELINE_CELEBRITY_THRESHOLD']:
+        follower_ids = _follower_ids(db.session, author_id)
+    timeline.push(post_id, timestamp, author_id, follower_ids)
+
+
+def _push_new_posts(session):
+    for post_id, timestamp, author_id, follower_ids, deferred in session.info.pop('timeline_posts', []):
+        if deferred:
+            try:
+                current_app.task_queue.enqueue('app.tasks.push_post', post_id, timestamp, author_id)
+                continue
+            except redis.exceptions.RedisError:
+                current_app.logger.warning('task queue unavailable, pushing inline', exc_info=True)
+            fan_out_post(post_id, timestamp, author_id)
+        else:
+            timeline.push(post_id, timestamp, author_id, follower_ids)
+
+
+def _discard_new_posts(session):
+    session.info.pop('timeline_posts', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_new_posts)
+db.event.listen(db.session, 'after_commit', _push_new_posts)
+db.event.listen(db.session, 'after_rollback', _discard_new_posts)
+
+db.event.listen(db.session, 'after_commit', timeline.apply)
+db.event.listen(db.session, 'after_rollback', timeline.discard)
+
+db.event.listen(db.session, 'after_commit', follows.apply)
+db.event.listen(db.session, 'after_rollback', follows.discard)
+
+db.event.listen(db.session, 'after_commit', mutuals.apply)
+db.event.listen(db.session, 'after_rollback', mutuals.discard)
+
+db.event.listen(db.session, 'after_flush', typeahead.collect)
+db.event.listen(db.session, 'after_commit', typeahead.apply)
+db.event.listen(db.session, 'after_rollback', typeahead.discard)
+
+db.event.listen(db.session, 'after_commit', notify.apply)
+db.event.listen(db.session, 'after_rollback', notify.discard)
+
+db.event.listen(db.session, 'after_commit', suggestions.apply)
+db.event.listen(db.session, 'after_rollback', suggestions.discard)
+
+db.event.listen(db.session, 'before_flush', _update_counters)
+db.event.listen(db.session, 'after_flush', _collect_count_deltas)
+db.event.listen(db.session, 'after_commit', counts.apply)
+db.event.listen(db.session, 'after_rollback', counts.discard)
+
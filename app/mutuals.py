@@ -0,0 +1,201 @@
+'''
+共同关注：“你关注的人里有谁也关注了TA”
+每个用户缓存两份排好序的 id 数组，followed:<id> 是关注的人，followers:<id> 是粉丝，
+求交集时两个有序数组线性归并，一边明显小很多时改成对大的一边二分查找，不需要每次渲染都做自连接
+FOLLOW_CACHE 为 redis 时数组打包成 bytes 存在 follow_ids:<kind>:<id> 里，local 时保存在进程内（LRU）
+follow/unfollow 提交或者回滚之后让两边用户的数组失效，下次读取时从数据库重新加载
+只缓存 MUTUALS_MAX_CACHED_IDS 个 id 以内的数组，失效之后重新加载的代价有上限；
+有一边超过的（比如大V的粉丝）改用自连接，从小的一边按索引查找，不加载整个数组
+'''
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+from flask import current_app
+import redis
+from app import db
+
+# 固定 8 字节，不同机器上的进程读到的一样
+_TYPECODE = 'q'
+
+
+class RedisIdCache(object):
+    def __init__(self, client, ttl):
+        self.redis = client
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(kind, user_id):
+        return 'follow_ids:{}:{}'.format(kind, user_id)
+
+    def get_many(self, keys):
+        ''' keys 是 (kind, user_id) 列表，没有缓存的返回 None '''
+        result = []
+        for data in self.redis.mget([self._key(*x) for x in keys]):
+            if data is None:
+                result.append(None)
+            else:
+                ids = array(_TYPECODE)
+                ids.frombytes(data)
+                result.append(ids)
+        return result
+
+    def set_many(self, items):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, ids in items:
+            pipe.set(self._key(*key), ids.tobytes(), ex=self.ttl)
+        pipe.execute()
+
+    def invalidate(self, keys):
+        if keys:
+            self.redis.delete(*[self._key(*x) for x in keys])
+
+
+class LocalIdCache(object):
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self.lock:
+            result = []
+            for key in keys:
+                ids = self.items.get(key)
+                if ids is not None:
+                    self.items.move_to_end(key)
+                result.append(ids)
+            return result
+
+    def set_many(self, items):
+        with self.lock:
+            for key, ids in items:
+                self.items[key] = ids
+                self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+
+def create_cache(app):
+    if app.config['FOLLOW_CACHE'] == 'local':
+        return LocalIdCache(app.config['FOLLOW_CACHE_LOCAL_USERS'])
+    return RedisIdCache(app.redis, app.config['FOLLOW_CACHE_TTL'])
+
+
+def _log_error():
+    current_app.logger.warning('mutuals cache unavailable', exc_info=True)
+
+
+def _query_ids(kind, user_id):
+    from app.models import followers
+    if kind == 'followed':
+        column, owner = followers.c.followed_id, followers.c.follower_id
+    else:
+        column, owner = followers.c.follower_id, followers.c.followed_id
+    # 主键和反向索引都是以 owner 开头，直接按顺序读出来
+    query = db.session.query(column).filter(owner == user_id).order_by(column)
+    return array(_TYPECODE, [id for id, in query])
+
+
+def get_ids(keys):
+    ''' 返回每个 (kind, user_id) 的有序 id 数组，kind 是 followed 或者 followers '''
+    cache = current_app.id_cache
+    try:
+        result = cache.get_many(keys)
+    except redis.exceptions.RedisError:
+        _log_error()
+        return [_query_ids(*key) for key in keys]
+    missing = [(key, _query_ids(*key)) for key, ids in zip(keys, result) if ids is None]
+    if missing:
+        try:
+            cache.set_many(missing)
+        except redis.exceptions.RedisError:
+            _log_error()
+        loaded = dict(missing)
+        result = [loaded[key] if ids is None else ids for key, ids in zip(keys, result)]
+    return result
+
+
+def intersect(a, b, sample=0):
+    ''' 两个有序数组的交集，返回 (交集大小, 最多 sample 个交集里的 id) '''
+    if len(a) > len(b):
+        a, b = b, a
+    count = 0
+    found = []
+    if not a:
+        return count, found
+    # 小的一边每个元素二分查找是 m*log(n)，比线性归并的 m+n 还小时用二分
+    if len(a) * len(b).bit_length() < len(a) + len(b):
+        lo = 0
+        for x in a:
+            lo = bisect_left(b, x, lo)
+            if lo == len(b):
+                break
+            if b[lo] == x:
+                count += 1
+                if len(found) < sample:
+                    found.append(x)
+        return count, found
+    i = j = 0
+    while i < len(a) and j < len(b):
+        x, y = a[i], b[j]
+        if x < y:
+            i += 1
+        elif x > y:
+            j += 1
+        else:
+            count += 1
+            if len(found) < sample:
+                found.append(x)
+            i += 1
+            j += 1
+    return count, found
+
+
+def _query_mutuals(viewer_id, user_id, sample):
+    from app.models import followers
+    a = followers.alias('a')
+    b = followers.alias('b')
+    query = db.session.query(a.c.followed_id).join(
+        b, db.and_(b.c.follower_id == a.c.followed_id, b.c.followed_id == user_id)).filter(
+        a.c.follower_id == viewer_id)
+    found = [id for id, in query.order_by(a.c.followed_id).limit(sample)] if sample else []
+    return query.count(), found
+
+
+def mutual_followers(viewer_id, user_id, sample=0, followed_count=None, follower_count=None):
+    '''
+    viewer 关注的人里也关注了 user 的，返回 (数量, 最多 sample 个 id)
+    followed_count 和 follower_count 是 viewer 关注的人数和 user 的粉丝数，超过 MUTUALS_MAX_CACHED_IDS 时不用缓存
+    '''
+    max_ids = current_app.config['MUTUALS_MAX_CACHED_IDS']
+    # 计数可能是还没有 flush 的 SQL 表达式，这时按小的处理
+    if any(isinstance(x, int) and x > max_ids for x in (followed_count, follower_count)):
+        return _query_mutuals(viewer_id, user_id, sample)
+    followed, fans = get_ids([('followed', viewer_id), ('followers', user_id)])
+    return intersect(followed, fans, sample)
+
+
+def record(session, user_id, target_id):
+    changes = session.info.setdefault('mutual_changes', set())
+    changes.add(('followed', user_id))
+    changes.add(('followers', target_id))
+
+
+def apply(session):
+    keys = session.info.pop('mutual_changes', None)
+    if not keys:
+        return
+    try:
+        current_app.id_cache.invalidate(keys)
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+# 事务里可能加载了包含未提交关注的数组，回滚时同样失效
+discard = apply
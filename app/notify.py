@@ -0,0 +1,163 @@
+'''
+通知推送：User.add_notification 记下的通知在事务提交之后发布到 redis 的 notifications:<user_id> 频道，
+浏览器通过 /notifications/stream（Server-Sent Events）订阅，不再每隔几秒轮询一次数据库
+不支持 EventSource 的浏览器用 /notifications?since=<timestamp>&wait=<秒> 长轮询，没有新通知时在频道上等待
+rq worker 里的任务进度（_set_task_progress）也是 add_notification，同样会推送
+REDIS_URL 为 local:// 时只有同一个进程里的提交能推送到浏览器
+每个 SSE 连接会一直占用一个线程，部署时 web 进程需要用多线程或者 gevent 的 worker
+
+还在轮询 /notifications 的客户端可以带 If-None-Match：每个用户在 redis 里有一个通知版本号
+notifications:version:<user_id>，提交了新通知时加一，版本没变时直接返回 304，不查询数据库也不提交，
+notifications:polls 里记录了 304（hits）和完整响应（misses）的次数，flask notifications stats 查看命中率
+'''
+import json
+import time
+from flask import current_app, request, session as user_session
+import redis
+
+POLLS = 'notifications:polls'
+
+
+def channel(user_id):
+    return 'notifications:{}'.format(user_id)
+
+
+def _log_error():
+    current_app.logger.warning('notifications unavailable', exc_info=True)
+
+
+def message(notification):
+    return {'name': notification.name, 'data': notification.get_data(),
+            'timestamp': notification.timestamp}
+
+
+def _version_key(user_id):
+    return 'notifications:version:{}'.format(user_id)
+
+
+def _initial_version():
+    # redis 里没有版本号时（第一次或者数据被清空）从当前的毫秒数开始，不会和以前发出去的 ETag 重复
+    return int(time.time() * 1000)
+
+
+def version(user_id):
+    ''' 当前的通知版本号，redis 不可用时返回 None '''
+    try:
+        key = _version_key(user_id)
+        value = current_app.redis.get(key)
+        if value is None:
+            current_app.redis.set(key, _initial_version(), nx=True)
+            value = current_app.redis.get(key)
+        return value.decode('utf-8')
+    except redis.exceptions.RedisError:
+        _log_error()
+        return None
+
+
+def not_modified():
+    '''
+    在 before_request 里调用，请求带的 ETag 和当前版本一样时返回 304 响应，否则返回 None
+    用户 id 直接从 session 读取，不加载用户
+    '''
+    user_id = user_session.get('_user_id')
+    if user_id is None or not request.if_none_match:
+        return None
+    current = version(user_id)
+    if current is None or not request.if_none_match.contains(current):
+        return None
+    count_poll(True)
+    response = current_app.response_class(status=304)
+    response.set_etag(current)
+    return response
+
+
+def count_poll(hit):
+    try:
+        current_app.redis.hincrby(POLLS, 'hits' if hit else 'misses', 1)
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def poll_stats():
+    ''' 返回 (304 的次数, 完整响应的次数) '''
+    stats = current_app.redis.hgetall(POLLS)
+    return int(stats.get(b'hits', 0)), int(stats.get(b'misses', 0))
+
+
+def record(session, user_id, notification):
+    session.info.setdefault('notifications', []).append((user_id, message(notification)))
+
+
+def apply(session):
+    pending = session.info.pop('notifications', None)
+    if not pending:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id, data in pending:
+            pipe.publish(channel(user_id), json.dumps(data))
+        for user_id in set(user_id for user_id, _ in pending):
+            pipe.set(_version_key(user_id), _initial_version(), nx=True)
+            pipe.incr(_version_key(user_id))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def discard(session):
+    session.info.pop('notifications', None)
+
+
+def subscribe(user_id):
+    ''' 先订阅再查询数据库，查询和订阅之间发布的通知也不会漏掉 '''
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(user_id))
+    return pubsub
+
+
+def wait(pubsub, timeout):
+    ''' 等待最多 timeout 秒，返回收到的通知，收到第一条之后把已经到达的一起取出来 '''
+    deadline = time.time() + timeout
+    result = []
+    while not result:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        item = pubsub.get_message(timeout=remaining)
+        while item is not None:
+            result.append(json.loads(item['data']))
+            item = pubsub.get_message()
+    return result
+
+
+def _event(data):
+    return 'data: {}\n\n'.format(json.dumps(data))
+
+
+def stream(pubsub, snapshot, timeout, heartbeat):
+    '''
+    SSE 的响应内容，先发送连接时未读的通知，然后转发频道上的消息
+    没有消息时每 heartbeat 秒发送一行注释，代理不会因为空闲断开连接；
+    timeout 秒后结束，浏览器的 EventSource 会自动重新连接
+    生成器里不访问数据库和应用上下文
+    '''
+    try:
+        yield 'retry: 3000\n\n'
+        for data in snapshot:
+            yield _event(data)
+        sent = time.time()
+        deadline = sent + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # 订阅确认之类的消息也会返回 None，所以按上次发送的时间决定是否发送心跳
+            item = pubsub.get_message(timeout=min(heartbeat, remaining))
+            if item is not None:
+                yield 'data: {}\n\n'.format(item['data'].decode('utf-8'))
+                sent = time.time()
+            elif time.time() - sent >= heartbeat:
+                yield ': keepalive\n\n'
+                sent = time.time()
+    finally:
+        pubsub.close()
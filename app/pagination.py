@@ -0,0 +1,112 @@
+'''
+分页
+paginate 和 query.paginate 一样按页码分页，但是总数由调用方提供（见 app.counts）
+
+游标分页（keyset pagination）
+按 (timestamp, id) 这样的唯一排序键倒序，下一页用 WHERE (timestamp, id) < 游标 代替 OFFSET，
+不需要 COUNT，翻到多深代价都一样。游标对客户端是不透明的字符串
+'''
+import base64
+import json
+from datetime import datetime
+from flask_sqlalchemy import Pagination
+
+from app import db
+
+
+class Page(Pagination):
+    ''' 总数由调用方提供的 Pagination，exact 表示总数是否精确 '''
+
+    def __init__(self, query, page, per_page, total, items, exact=True):
+        super(Page, self).__init__(query, page, per_page, total, items)
+        self.exact = exact
+
+
+def paginate(query, page, per_page, total, exact=True):
+    ''' 和 query.paginate 一样，但是不再 COUNT，总数见 app.counts '''
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    return Page(query, page, per_page, total, items, exact)
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    raise TypeError(value)
+
+
+def _object_hook(value):
+    if 'dt' in value:
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value['dt'] else '%Y-%m-%dT%H:%M:%S'
+        return datetime.strptime(value['dt'], fmt)
+    return value
+
+
+def encode_cursor(direction, values):
+    data = json.dumps([direction, list(values)], default=_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    返回 (direction, values)，direction 是 next（更早）或者 prev（更新）
+    没有游标或者游标无效时返回第一页 ('first', None)，和 page 参数无效时的处理一致
+    '''
+    if not cursor:
+        return 'first', None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(data.decode('utf-8'), object_hook=_object_hook)
+    except (ValueError, TypeError):
+        return 'first', None
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        return 'first', None
+    return direction, values
+
+
+class CursorPage(object):
+    def __init__(self, items, has_next, has_prev, key):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+        self.next_cursor = encode_cursor('next', key(items[-1])) if self.has_next else None
+        self.prev_cursor = encode_cursor('prev', key(items[0])) if self.has_prev else None
+
+
+def make_page(rows, per_page, direction, key):
+    '''
+    rows 是按查询方向取出来的最多 per_page + 1 条记录，多出来的一条说明后面还有数据
+    key(item) 返回游标需要的排序键
+    '''
+    more = len(rows) > per_page
+    rows = list(rows[:per_page])
+    if direction == 'prev':
+        rows.reverse()
+        return CursorPage(rows, True, more, key)
+    return CursorPage(rows, more, direction == 'next', key)
+
+
+def _beyond(columns, values, ascending):
+    # (a, b) < (x, y) 展开成 a < x OR (a = x AND b < y)，各个数据库都能走索引
+    column, value = columns[0], values[0]
+    condition = column > value if ascending else column < value
+    if len(columns) == 1:
+        return condition
+    return db.or_(condition, db.and_(column == value, _beyond(columns[1:], values[1:], ascending)))
+
+
+def keyset_paginate(query, columns, cursor, per_page):
+    '''
+    columns 是排序键，比如 [Post.timestamp, Post.id]，按倒序分页
+    返回 CursorPage，items/has_next/has_prev 和 paginate 的结果用法一样
+    '''
+    direction, values = decode_cursor(cursor)
+    if values is None or len(values) != len(columns):
+        direction, values = 'first', None
+    ascending = direction == 'prev'
+    query = query.order_by(None)
+    if values is not None:
+        query = query.filter(_beyond(columns, values, ascending))
+    query = query.order_by(*[c.asc() if ascending else c.desc() for c in columns])
+    rows = query.limit(per_page + 1).all()
+    return make_page(rows, per_page, direction,
+                     key=lambda x: [getattr(x, c.key) for c in columns])
@@ -0,0 +1,96 @@
+'''
+后台任务的进度报告
+每次写入进度要保存 job.meta（redis）、更新 task_progress 通知并提交（数据库），代价比较大，
+ProgressReporter 把频繁的进度合并：比上次报告增加了 step 个百分点，或者距离上次报告超过 interval 秒才写入，
+100% 一定写入。用法：
+
+    with ProgressReporter(total) as progress:
+        for post in progress.iter(posts):
+            ...
+
+进入时报告 0，退出时（包括出错）报告 100 并把任务标记为完成。不在 rq worker 里运行时（没有 job）什么也不写
+'''
+import time
+from flask import current_app
+from rq import get_current_job
+from app import db
+
+
+class ProgressReporter(object):
+    def __init__(self, total=None, step=None, interval=None, job=None):
+        config = current_app.config
+        self.job = job if job is not None else get_current_job()
+        self.total = total
+        self.step = config['TASK_PROGRESS_STEP'] if step is None else step
+        self.interval = config['TASK_PROGRESS_INTERVAL'] if interval is None else interval
+        self.done = 0
+        self.meta = {}
+        # 最近一次设置的和最近一次写入的进度
+        self.percent = None
+        self.reported = None
+        self.reported_at = 0
+        self.writes = 0
+
+    def __enter__(self):
+        self.flush(0)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # 任务出错时不要把做了一半的修改和进度一起提交
+            db.session.rollback()
+        self.flush(100)
+        return False
+
+    def set(self, percent, **meta):
+        ''' 设置进度百分比，meta 里的值一起写进 job.meta，按时间和增量合并写入 '''
+        self.percent = percent
+        self.meta.update(meta)
+        if self.reported is None or percent >= 100 or percent - self.reported >= self.step or \
+                time.time() - self.reported_at >= self.interval:
+            self.flush()
+
+    def update(self, done, **meta):
+        ''' 按 total 计算百分比，最多到 99，100 留给 with 结束或者 flush(100) '''
+        self.done = done
+        self.set(min(done * 100 // self.total, 99) if self.total else 0, **meta)
+
+    def advance(self, count=1, **meta):
+        self.update(self.done + count, **meta)
+
+    def iter(self, iterable):
+        ''' 遍历 iterable，每取出一个进度加一，total 没有指定时用 len(iterable) '''
+        if self.total is None and hasattr(iterable, '__len__'):
+            self.total = len(iterable)
+        for item in iterable:
+            yield item
+            self.advance()
+
+    def flush(self, percent=None):
+        ''' 马上写入，已经写过同样的进度并且 meta 没有变化时跳过 '''
+        if percent is not None:
+            self.percent = percent
+        if self.percent is None or (self.percent == self.reported and not self.meta):
+            return
+        self._write(self.percent)
+        self.reported = self.percent
+        self.reported_at = time.time()
+        self.meta = {}
+
+    def _write(self, percent):
+        # job.meta 一次 save_meta，通知和任务状态一次提交
+        self.writes += 1
+        if self.job is None:
+            return
+        from app.models import Task
+        self.job.meta['progress'] = percent
+        self.job.meta.update(self.meta)
+        self.job.save_meta()
+        task = Task.query.get(self.job.get_id())
+        if task is None:
+            return
+        noti = task.user.add_notification('task_progress', {'task_id': task.id, 'progress': percent})
+        if percent >= 100:
+            task.complete = True
+            noti.is_read = True
+        db.session.commit()
@@ -1,14 +1,143 @@
+'''
+elasticsearch 索引的读写
+SearchableMixin 的 __tablename__ 用作别名，reindex 建一个带版本号的新索引，建好之后原子地切换别名，
+查询和写入一直通过别名进行，不会看到建了一半的索引
+
+查询结果缓存在进程内（QueryCache，LRU + TTL），键里带着索引的版本号 search:generation:<index>，
+索引写入之后版本号加一，旧的缓存不会再被读到，等 LRU 或者 TTL 淘汰
+SEARCH_CACHE_PREFETCH_PAGES 大于 1 时一次查询取出连续几页，后面的页直接从缓存返回
+
+内置搜索（app.local_search）的索引在每个进程的内存里，别的进程（其它 web 进程、rq worker、flask 命令）看不到：
+提交后的索引更新不交给 rq，reindex 不用多进程；每次写入之后调用 request_reload，
+各个进程查询之前比较 search:reload:<index>，有变化时丢掉进程内的索引，从数据库重新建立，
+写入的进程自己已经有这次修改，不用重新建立
+'''
+from collections import OrderedDict
+from datetime import datetime
+import multiprocessing
+import threading
+import time
 from flask import current_app
+import redis
+from app import db
+from app.local_search import LocalElasticsearch
+
+
+class QueryCache(object):
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def create_cache(app):
+    if not app.config['SEARCH_CACHE_MAX_ENTRIES']:
+        return None
+    return QueryCache(app.config['SEARCH_CACHE_MAX_ENTRIES'], app.config['SEARCH_CACHE_TTL'])
+
+
+def _generation_key(index):
+    return 'search:generation:{}'.format(index)
+
+
+def _reload_key(index):
+    return 'search:reload:{}'.format(index)
+
+
+def is_local():
+    ''' 是不是内置的进程内搜索 '''
+    return isinstance(current_app.elasticsearch, LocalElasticsearch)
+
+
+def _reloadable():
+    # 只有从数据库加载的内置索引可以丢掉重建，local:// 的索引只在内存里
+    return is_local() and current_app.elasticsearch.loader is not None
+
+
+def _generation(index):
+    ''' 索引的版本号，内置搜索同时检查别的进程是否要求重新加载，一次往返 '''
+    reloadable = _reloadable()
+    keys = [_generation_key(index)] + ([_reload_key(index)] if reloadable else [])
+    try:
+        values = current_app.redis.mget(keys)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('search cache unavailable', exc_info=True)
+        return None
+    if reloadable:
+        current_app.elasticsearch.sync(index, values[1])
+    return int(values[0] or 0)
+
+
+def request_reload(*indices, applied=False):
+    '''
+    内置搜索：数据改了，让别的进程下次查询之前从数据库重新建立这些索引
+    applied 为 True 表示当前进程的索引已经写入了这些修改，当前进程不用重新建立
+    '''
+    if not _reloadable():
+        return
+    indices = list(set(indices))
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for index in indices:
+            pipe.incr(_reload_key(index))
+            pipe.incr(_generation_key(index))
+        versions = pipe.execute()[::2]
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('search cache unavailable', exc_info=True)
+        return
+    if applied:
+        for index, version in zip(indices, versions):
+            current_app.elasticsearch.advance(index, version)
+
+
+def bump_generation(*indices):
+    ''' 索引有了修改，让这些索引的查询缓存失效 '''
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for index in set(indices):
+            pipe.incr(_generation_key(index))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('search cache unavailable', exc_info=True)
+
+
+def load_index(index):
+    ''' 内置搜索后端（app.local_search）第一次用到 index 时从数据库建立 '''
+    from app.models import SearchableMixin
+    for model in SearchableMixin.__subclasses__():
+        if model.__tablename__ == index:
+            reindex(model)
+
+
+def payload(model):
+    return {field: getattr(model, field) for field in model.__searchable__}
 
 
 def add_to_index(index, model):
     if not current_app.elasticsearch:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-        current_app.elasticsearch.index(
-            index=index, doc_type=index, id=model.id, body=payload)
+    current_app.elasticsearch.index(
+        index=index, doc_type=index, id=model.id, body=payload(model))
 
 
 def remove_from_index(index, model):
@@ -17,12 +146,224 @@ def remove_from_index(index, model):
     current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
 
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+def bulk(actions, doc_type=None, wait=False):
+    '''
+    一次 _bulk 请求提交多个修改，actions 是 (index, id, payload) 列表，payload 为 None 表示删除
+    doc_type 默认和 index 相同，写入带版本号的索引时传别名
+    wait 为 True 时等到修改可以被搜索到再返回，只在 rq worker 里用，web 请求不等 refresh
+    '''
+    if not current_app.elasticsearch or not actions:
         return
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page-1)*per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
+    body = []
+    for index, id, doc in actions:
+        meta = {'_index': index, '_type': doc_type or index, '_id': id}
+        if doc is None:
+            body.append({'delete': meta})
+        else:
+            body.append({'index': meta})
+            body.append(doc)
+    if doc_type is None:
+        # wait 时 refresh 之后才更新版本号；不等的话 refresh 之前的查询可能把旧结果缓存在新版本号下面，
+        # 最多留 SEARCH_CACHE_TTL 秒
+        if wait:
+            result = current_app.elasticsearch.bulk(body=body, refresh='wait_for')
+        else:
+            result = current_app.elasticsearch.bulk(body=body)
+        indices = [index for index, _, _ in actions]
+        if _reloadable():
+            # 内置搜索只写入了当前进程的索引，别的 web 进程要重新建立
+            request_reload(*indices, applied=True)
+        else:
+            bump_generation(*indices)
+    else:
+        # 写入带版本号的新索引时还没有切换别名，不影响查询，建好之后统一 refresh
+        result = current_app.elasticsearch.bulk(body=body)
+    if result.get('errors'):
+        # 删除不存在的文档也会报 not_found，不算错误
+        failed = [item for item in result['items']
+                  for op, info in item.items() if info.get('status', 200) >= 300 and
+                  not (op == 'delete' and info.get('status') == 404)]
+        if failed:
+            current_app.logger.warning('bulk index failed: %s', failed[:10])
+
+
+def _search(index, query, start, size, highlight):
+    body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+            'from': start, 'size': size, '_source': False}
+    if highlight:
+        # number_of_fragments 为 0 时返回整个字段，博客很短不需要截取片段
+        body['highlight'] = {'fields': {'*': {'number_of_fragments': 0}}, 'encoder': 'html',
+                             'pre_tags': ['<mark>'], 'post_tags': ['</mark>']}
+    search = current_app.elasticsearch.search(index=index, doc_type=index, body=body)
+    hits = []
+    for hit in search['hits']['hits']:
+        fragments = None
+        if highlight:
+            fragments = {field: ''.join(texts) for field, texts in hit.get('highlight', {}).items()}
+        hits.append((int(hit['_id']), fragments))
+    return hits, search['hits']['total']
+
+
+def normalize(query):
+    # 分析器本来就不区分大小写和多余的空格，归一化之后缓存的命中率更高
+    return ' '.join(query.lower().split())
+
+
+def search_index(index, query, page, per_page, highlight=False):
+    '''
+    返回 ([(id, 高亮)], total)，按相关度排序，结果经过 QueryCache 缓存
+    highlight 为 True 时高亮是 {字段: html}，匹配的词用 <mark> 包起来，其余部分已经转义，否则是 None
+    '''
+    if not current_app.elasticsearch:
+        return [], 0
+    cache = current_app.search_cache
+    generation = _generation(index) if cache is not None or _reloadable() else None
+    if generation is None or cache is None:
+        return _search(index, query, (page - 1) * per_page, per_page, highlight)
+
+    query = normalize(query)
+
+    def key(page):
+        return index, generation, query, page, per_page, highlight
+
+    result = cache.get(key(page))
+    if result is not None:
+        return result
+    pages = max(current_app.config['SEARCH_CACHE_PREFETCH_PAGES'], 1)
+    first = (page - 1) // pages * pages + 1
+    hits, total = _search(index, query, (first - 1) * per_page, pages * per_page, highlight)
+    for i in range(pages):
+        cache.set(key(first + i), (hits[i * per_page:(i + 1) * per_page], total))
+    start = (page - first) * per_page
+    return hits[start:start + per_page], total
+
+
+def query_index(index, query, page, per_page):
+    hits, total = search_index(index, query, page, per_page)
+    return [id for id, _ in hits], total
+
+
+def _chunks(model, chunk_size, after=0):
+    # 按 id 范围切块，空洞多的表块里的行会少一些，但不需要扫描整张表
+    low, high = db.session.query(db.func.min(model.id), db.func.max(model.id)).filter(
+        model.id > after).one()
+    if low is None:
+        return [], after
+    return [(start, start + chunk_size) for start in range(low, high + 1, chunk_size)], high
+
+
+def index_chunk(model, index, start, end, batch_size=500):
+    ''' 把 start <= id < end 的行写入 index，只读取 __searchable__ 字段，每 batch_size 条一个 _bulk 请求 '''
+    columns = [getattr(model, field) for field in model.__searchable__]
+    query = db.session.query(model.id, *columns).filter(
+        model.id >= start, model.id < end).order_by(model.id).yield_per(batch_size)
+    count = 0
+    actions = []
+    for row in query:
+        actions.append((index, row[0], dict(zip(model.__searchable__, row[1:]))))
+        if len(actions) == batch_size:
+            bulk(actions, model.__tablename__)
+            count += len(actions)
+            actions = []
+    bulk(actions, model.__tablename__)
+    return count + len(actions)
+
+
+_worker_app = None
+
+
+def _init_worker(config_class):
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app(config_class)
+    # 子进程的线程 id 和父进程一样，scoped session 会拿到继承来的 session 和连接，
+    # 先丢掉，之后在 _worker_app 里用自己的连接
+    db.session.remove()
+    db.get_engine(_worker_app).dispose()
+
+
+def _run_chunk(args):
+    with _worker_app.app_context():
+        try:
+            return index_chunk(*args)
+        finally:
+            db.session.remove()
+
+
+def _swap_alias(alias, index):
+    es = current_app.elasticsearch
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    old = []
+    replaced = True
+    if es.indices.exists_alias(name=alias):
+        old = list(es.indices.get_alias(name=alias))
+        actions += [{'remove': {'index': x, 'alias': alias}} for x in old]
+    elif es.indices.exists(index=alias):
+        # 以前直接用表名建的索引，删除和加别名一起生效
+        actions.append({'remove_index': {'index': alias}})
+    else:
+        replaced = False
+    es.indices.update_aliases(body={'actions': actions})
+    if replaced:
+        bump_generation(alias)
+    return old
+
+
+def reindex(model, workers=1, chunk_size=10000, batch_size=500, config_class=None,
+            progress=None, keep_old=False):
+    '''
+    重建 model 的索引，返回 (新索引名, 文档数)
+    数据按 id 范围分块，workers 大于 1 时用多个进程并行写入，每个进程用 config_class 创建自己的 app
+    progress(百分比, 已完成的文档数, 每秒文档数) 在每块完成时调用
+    建索引期间新增的行在切换别名之前补上，期间的修改和删除已经写入旧索引，需要时可以再 reindex
+    '''
+    es = current_app.elasticsearch
+    if not es:
+        return None, 0
+    alias = model.__tablename__
+    index = '{}-{}'.format(alias, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+    # 建索引期间不刷新，完成后恢复
+    es.indices.create(index=index, body={'settings': {'refresh_interval': '-1'}})
+
+    started = time.time()
+    done = 0
+    if workers > 1 and is_local():
+        # 子进程写入的是它们自己内存里的索引
+        current_app.logger.warning('built-in search backend, reindexing with 1 worker')
+        workers = 1
+    chunks, last_id = _chunks(model, chunk_size)
+    jobs = [(model, index, start, end, batch_size) for start, end in chunks]
+    if workers > 1 and len(jobs) > 1:
+        from config import Config
+        # 结束 _chunks 开始的事务，关掉连接池里的连接，子进程不会和父进程共用一个数据库连接
+        db.session.commit()
+        db.engine.dispose()
+        pool = multiprocessing.Pool(workers, _init_worker, (config_class or Config,))
+        results = pool.imap_unordered(_run_chunk, jobs)
+    else:
+        pool = None
+        results = (index_chunk(*job) for job in jobs)
+    try:
+        for i, count in enumerate(results, 1):
+            done += count
+            if progress:
+                progress(i * 100 // len(jobs) if i < len(jobs) else 99, done,
+                         done / max(time.time() - started, 1e-6))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    catch_up, _ = _chunks(model, chunk_size, after=last_id)
+    for start, end in catch_up:
+        done += index_chunk(model, index, start, end, batch_size)
+
+    es.indices.put_settings(index=index, body={'index': {'refresh_interval': None}})
+    es.indices.refresh(index=index)
+    old = _swap_alias(alias, index)
+    if not keep_old:
+        for x in old:
+            es.indices.delete(index=x)
+    if progress:
+        progress(100, done, done / max(time.time() - started, 1e-6))
+    return index, done
@@ -0,0 +1,148 @@
+'''
+“你可能想关注”推荐，按二度关系（关注的人关注了谁）的重合数排序
+离线任务（app.tasks.compute_suggestions）把 followers 表导出成 CSR 邻接数组：
+    indptr[u]:indptr[u + 1] 是 indices 里用户 u 关注的人，按 id 排好序
+每个用户的二度候选用 numpy 一次取出来计数，去掉自己和已经关注的人，取前 SUGGESTIONS_TOP_K 个
+结果保存在 redis 的 sorted set suggestions:<user_id> 里，分数是重合数，页面直接读取
+
+增量计算：follow/unfollow 提交后把关注者记到 suggestions:dirty，
+下次任务只重算这些用户和他们的粉丝（粉丝的二度关系也变了）
+'''
+from array import array
+from flask import current_app
+import numpy as np
+import redis
+from app import db
+
+DIRTY = 'suggestions:dirty'
+# 做过一次全量计算的标记，没有时增量任务改为全量
+BUILT = 'suggestions:built'
+
+
+def _key(user_id):
+    return 'suggestions:{}'.format(user_id)
+
+
+def _log_error():
+    current_app.logger.warning('suggestions unavailable', exc_info=True)
+
+
+def load_graph(batch_size=10000):
+    '''
+    导出 followers 表，返回 (indptr, indices, sources)
+    按 (follower_id, followed_id) 顺序读取，正好是主键顺序，不需要额外排序
+    '''
+    from app.models import followers, User
+    # array 的 'l' 和 numpy 的默认整数在 Windows 上是 32 位，固定用 64 位，和 frombuffer 的 dtype 一致
+    sources = array('q')
+    targets = array('q')
+    query = db.session.query(followers.c.follower_id, followers.c.followed_id).order_by(
+        followers.c.follower_id, followers.c.followed_id).yield_per(batch_size)
+    for follower_id, followed_id in query:
+        sources.append(follower_id)
+        targets.append(followed_id)
+    sources = np.frombuffer(sources, dtype=np.int64) if sources else np.zeros(0, np.int64)
+    indices = np.frombuffer(targets, dtype=np.int64) if targets else np.zeros(0, np.int64)
+    max_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    indptr = np.searchsorted(sources, np.arange(max_id + 2))
+    return indptr, indices, sources
+
+
+def _gather(indptr, indices, rows):
+    # 把多行的邻居拼成一个数组，不用 python 循环
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    total = lengths.sum()
+    if not total:
+        return indices[:0]
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(total)]
+
+
+def top_candidates(indptr, indices, user_id, top_k):
+    ''' 返回 [(candidate_id, 重合数)]，按重合数从大到小，相同时 id 小的在前 '''
+    followed = indices[indptr[user_id]:indptr[user_id + 1]]
+    if not len(followed):
+        return []
+    candidates, overlap = np.unique(_gather(indptr, indices, followed), return_counts=True)
+    keep = candidates != user_id
+    # followed 已经排好序，直接二分判断
+    keep &= ~np.isin(candidates, followed, assume_unique=True)
+    candidates, overlap = candidates[keep], overlap[keep]
+    if len(candidates) > top_k:
+        part = np.argpartition(-overlap, top_k - 1)[:top_k]
+        candidates, overlap = candidates[part], overlap[part]
+    order = np.lexsort((candidates, -overlap))
+    return [(int(c), int(n)) for c, n in zip(candidates[order], overlap[order])]
+
+
+def _affected(indices, sources, user_ids):
+    # 用户自己和他们的粉丝
+    user_ids = np.array(sorted(user_ids), dtype=np.int64)
+    fans = sources[np.isin(indices, user_ids)]
+    return np.union1d(user_ids, fans)
+
+
+def refresh(full=False, batch_size=500):
+    '''
+    重新计算推荐，full 为 False 时只算 suggestions:dirty 里的用户，返回计算的用户数
+    '''
+    client = current_app.redis
+    top_k = current_app.config['SUGGESTIONS_TOP_K']
+    dirty = {int(x) for x in client.smembers(DIRTY)}
+    if not full and not client.exists(BUILT):
+        full = True
+    if not full and not dirty:
+        return 0
+
+    indptr, indices, sources = load_graph()
+    if full:
+        user_ids = np.arange(1, len(indptr) - 1)
+    else:
+        user_ids = _affected(indices, sources, dirty)
+        user_ids = user_ids[user_ids < len(indptr) - 1]
+
+    for start in range(0, len(user_ids), batch_size):
+        pipe = client.pipeline(transaction=False)
+        for user_id in user_ids[start:start + batch_size]:
+            user_id = int(user_id)
+            rows = top_candidates(indptr, indices, user_id, top_k)
+            pipe.delete(_key(user_id))
+            if rows:
+                pipe.zadd(_key(user_id), dict(rows))
+        pipe.execute()
+
+    # 计算期间新加入的用户留到下一次
+    if dirty:
+        client.srem(DIRTY, *dirty)
+    client.set(BUILT, 1)
+    return len(user_ids)
+
+
+def get(user_id, limit):
+    ''' 返回 [(candidate_id, 重合数)]，还没有计算过或者 redis 不可用时返回空列表 '''
+    try:
+        rows = current_app.redis.zrevrange(_key(user_id), 0, limit - 1, withscores=True)
+    except redis.exceptions.RedisError:
+        _log_error()
+        return []
+    # 重合数相同时 redis 按成员的字符串倒序，这里改成 id 小的在前，和计算时一致
+    return sorted(((int(id), int(score)) for id, score in rows), key=lambda x: (-x[1], x[0]))
+
+
+def record(session, user_id):
+    session.info.setdefault('suggestion_changes', set()).add(user_id)
+
+
+def apply(session):
+    user_ids = session.info.pop('suggestion_changes', None)
+    if not user_ids:
+        return
+    try:
+        current_app.redis.sadd(DIRTY, *user_ids)
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def discard(session):
+    session.info.pop('suggestion_changes', None)
@@ -1,61 +1,146 @@
-import time
-from rq import get_current_job
-from app import create_app, db
-from app.models import Task, User, Post
+'''
+rq 任务。导入这个模块不创建 app，第一次执行任务时 bootstrap() 用 create_worker_app 创建并推入 app 上下文
+rq worker 每个任务 fork 一个子进程，子进程里才导入任务模块的话每个任务都要重新导入、创建一次 app；
+用 worker.py 启动时在父进程里先 bootstrap()，fork 出来的子进程直接复用
+'''
+import functools
+import os
 import sys
-import time
+from rq import get_current_job
+from app import create_worker_app, suggestions, typeahead
+from app.search import bulk
+from app.models import User, Notification, fan_out_post
+from app import exports, imports
+from app.progress import ProgressReporter
 from app.email import send_email
-import json
-from flask import render_template
+from flask import render_template, url_for
+from config import Config
 
 
-app = create_app()
-app.app_context().push()
+app = None
 
 
-def _set_task_progress(progress):
-    job = get_current_job()
-    if job:
-        job.meta['progress'] = progress
-        job.save_meta()
+def bootstrap(config_class=Config):
+    ''' 创建 worker 用的 app 并推入上下文，已经创建过时直接返回 '''
+    global app
+    if app is None:
+        app = create_worker_app(config_class)
+        app.app_context().push()
+    return app
 
-        task = Task.query.get(job.get_id())
-        noti = task.user.add_notification('task_progress',{'task_id':task.id,'progress':progress})
-        if progress >= 100:
-            task.complete = True
-            noti.is_read = True
 
-        db.session.commit()
+def task(func):
+    ''' 任务运行前确保 app 已经创建 '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bootstrap()
+        return func(*args, **kwargs)
+    return wrapper
 
+
+@task
 def export_posts(user_id):
     # rq不是flask，所以不会自动处理异常
     try:
-        user = User.query.get(user_id)
-        _set_task_progress(0)
-        posts = user.posts.order_by(Post.timestamp.asc())
-        posts_count = posts.count()
-        data = []
-        i = 0
-        for post in posts:
-            data.append(dict(body=post.body,timestamp=post.timestamp.isoformat()+'Z'))
-            time.sleep(3)
-            i += 1
-            _set_task_progress(i*100 // posts_count)
-
-        # send_email('[Microblog] Your blog posts',
-        #         app.config['ADMINS'][0],
-        #         [user.email],
-        #         render_template('email/export_posts.txt',user=user),
-        #         render_template('email/export_posts.html',user=user),
-        #         [('posts.json', 'application/json',json.dumps(data,indent=4))],
-        #         True)
-        send_email('[Microblog] Your blog posts',
-        app.config['ADMINS'][0],
-        [user.email],
-        render_template('email/export_posts.txt',user=user, data=json.dumps(data,indent=4)),
-        render_template('email/export_posts.html',user=user, data=json.dumps(data,indent=4)),
-        None, True)
+        task_id = get_current_job().get_id()
+        # 先进入 ProgressReporter，读取用户出错时也会报告 100 并把任务标记为完成
+        with ProgressReporter() as progress:
+            user = User.query.get(user_id)
+            progress.total = user.post_count
+            filename = exports.path(task_id)
+            count = exports.export_posts(user.id, filename, progress.update)
+
+            # 小文件作为附件，同时总是带上下载链接，不再把整个导出内容放进邮件正文
+            attachments = None
+            if os.path.getsize(filename) <= app.config['EXPORT_ATTACHMENT_MAX_SIZE']:
+                with open(filename, 'rb') as f:
+                    attachments = [('posts.ndjson.gz', 'application/gzip', f.read())]
+            # worker app 的 SERVER_NAME 来自 BASE_URL，见 create_worker_app
+            url = url_for('main.download_export', task_id=task_id, _external=True)
+            send_email('[Microblog] Your blog posts',
+                       app.config['ADMINS'][0],
+                       [user.email],
+                       render_template('email/export_posts.txt', user=user, count=count, url=url),
+                       render_template('email/export_posts.html', user=user, count=count, url=url),
+                       attachments, True)
+
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+@task
+def import_posts(user_id, filename):
+    ''' 导入上传的 NDJSON 文件（见 app/imports.py），导入完成后删除文件 '''
+    try:
+        with ProgressReporter() as progress:
+            progress.total = os.path.getsize(filename)
+            user = User.query.get(user_id)
+            count, skipped = imports.import_posts(user, filename, progress.update)
+            # 和结束时的 100% 一起写进 job.meta
+            progress.meta.update(imported=count, skipped=skipped)
+        app.logger.info('%d posts imported for user %d, %d lines skipped', count, user_id, skipped)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+@task
+def compute_suggestions(full=False):
+    ''' 重新计算推荐关注，full 为 False 时只算关注关系有变化的用户 '''
+    try:
+        count = suggestions.refresh(full)
+        app.logger.info('suggestions computed for %d users', count)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+@task
+def index_documents(actions):
+    ''' SearchableMixin 提交后的索引更新，actions 见 app.search.bulk，失败时让 rq 记录下来 '''
+    bulk(actions, wait=True)
+
+
+@task
+def push_post(post_id, timestamp, author_id):
+    ''' 粉丝多的作者发表的博客推送到粉丝的时间线，见 app.models.fan_out_post '''
+    fan_out_post(post_id, timestamp, author_id)
+
+
+@task
+def reindex(user_id, model_name, workers=1, chunk_size=10000):
+    ''' 重建搜索索引，进度和每秒写入的文档数记录在 job.meta 里 '''
+    try:
+        import app.models as models
+        model = getattr(models, model_name)
+        with ProgressReporter() as progress:
 
+            def report(percent, done, rate):
+                progress.set(percent, documents=done, throughput=round(rate))
+
+            index, count = model.reindex(workers=workers, chunk_size=chunk_size, progress=report)
+        app.logger.info('reindexed %d documents into %s', count, index)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+@task
+def build_typeahead():
+    ''' 从数据库重建搜索框自动补全的候选词 '''
+    try:
+        users, terms = typeahead.build()
+        app.logger.info('typeahead built with %d users and %d terms', users, terms)
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+@task
+def prune_notifications():
+    ''' 删除已读或者很久没有更新的通知，可以用 rq-scheduler 或者 cron 定期执行 '''
+    try:
+        count = Notification.prune(app.config['NOTIFICATION_READ_RETENTION'],
+                                   app.config['NOTIFICATION_RETENTION'])
+        app.logger.info('%d notifications pruned', count)
     except:
-        _set_task_progress(100)
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
\ No newline at end of file
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
@@ -0,0 +1,305 @@
+'''
+首页时间线缓存（推拉结合）
+每个用户在 redis 里有一个 sorted set: timeline:<user_id>，成员是 post id，分数是发表时间
+发表博客时把 id 推到所有粉丝的时间线里，关注/取关时补充或者删除对应作者的博客
+timeline:<user_id>:warm 标记缓存已经从数据库建立，没有这个标记时读取回退到 SQL
+只写入已经建立的时间线，写入和读取都会把过期时间延长到 TIMELINE_TTL，一直没有访问的时间线过期后从数据库重建
+关注/取关的修改先记在 session 里，提交之后再写入，回滚时让相关用户的时间线失效
+
+粉丝数超过 TIMELINE_CELEBRITY_THRESHOLD 的作者（大V）不推送，只写入自己的 timeline:author:<id>，
+读取的时候把关注的大V的列表和推送的时间线做多路归并。作者的列表和时间线一样有 warm 标记和过期时间，
+读取时才从数据库建立（rebuild_author），没有建立的列表不写入
+'''
+import calendar
+import heapq
+from flask import current_app
+import redis
+
+
+def _key(user_id):
+    return 'timeline:{}'.format(user_id)
+
+
+def _warm_key(user_id):
+    return 'timeline:{}:warm'.format(user_id)
+
+
+def _author_key(user_id):
+    return 'timeline:author:{}'.format(user_id)
+
+
+def _author_warm_key(user_id):
+    return 'timeline:author:{}:warm'.format(user_id)
+
+
+CELEBRITIES = 'timeline:celebrities'
+
+
+def to_score(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+def _trim(pipe, key):
+    max_length = current_app.config['TIMELINE_MAX_LENGTH']
+    pipe.zremrangebyrank(key, 0, -(max_length + 1))
+
+
+def _log_error():
+    current_app.logger.warning('timeline cache unavailable', exc_info=True)
+
+
+def _warm(user_ids, author_id=None):
+    '''
+    返回 user_ids 里时间线已经建立的 id 集合，传了 author_id 时返回 (集合, 作者的列表是否已经建立)
+    '''
+    user_ids = list(user_ids)
+    pipe = current_app.redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(_warm_key(user_id))
+    if author_id is not None:
+        pipe.exists(_author_warm_key(author_id))
+    result = pipe.execute()
+    warm = {u for u, found in zip(user_ids, result) if found}
+    if author_id is None:
+        return warm
+    return warm, bool(result[-1])
+
+
+def _write(pipe, user_id, posts, key=None):
+    key = key or _key(user_id)
+    pipe.zadd(key, posts)
+    _trim(pipe, key)
+    # warm 标记可能刚好过期，写入的 key 总是带上过期时间，不会一直留在 redis 里
+    pipe.expire(key, current_app.config['TIMELINE_TTL'])
+
+
+def push(post_id, timestamp, author_id, follower_ids):
+    '''
+    发表博客，写入作者自己的列表和时间线，follower_ids 为 None 表示作者是大V，不推送给粉丝
+    '''
+    try:
+        score = to_score(timestamp)
+        warm, author_warm = _warm([author_id] + list(follower_ids or ()), author_id)
+        pipe = current_app.redis.pipeline(transaction=False)
+        if follower_ids is None:
+            pipe.sadd(CELEBRITIES, author_id)
+        else:
+            pipe.srem(CELEBRITIES, author_id)
+        if author_warm:
+            _write(pipe, author_id, {post_id: score}, _author_key(author_id))
+        for user_id in warm:
+            _write(pipe, user_id, {post_id: score})
+        demoted = pipe.execute()[0]
+        if follower_ids is not None and demoted:
+            # 粉丝数降到阈值以下，之前没有推送的博客补推一次，作者的列表没有建立时让粉丝的时间线重建
+            if not author_warm:
+                invalidate(warm - {author_id})
+                return
+            posts = current_app.redis.zrevrange(_author_key(author_id), 0, -1, withscores=True)
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id in warm - {author_id}:
+                _write(pipe, user_id, dict(posts))
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def push_many(author_id, posts, follower_ids):
+    '''
+    批量导入的博客一次写入，posts 是 (id, timestamp) 列表，follower_ids 和 push 一样
+    导入的多是旧博客，大V身份的变化留给下一次 push 处理
+    '''
+    if not posts:
+        return
+    try:
+        scores = {id: to_score(ts) for id, ts in posts}
+        warm, author_warm = _warm([author_id] + list(follower_ids or ()), author_id)
+        pipe = current_app.redis.pipeline(transaction=False)
+        if author_warm:
+            _write(pipe, author_id, scores, _author_key(author_id))
+        for user_id in warm:
+            _write(pipe, user_id, scores)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def celebrities():
+    ''' 所有大V的 id '''
+    try:
+        return {int(x) for x in current_app.redis.smembers(CELEBRITIES)}
+    except redis.exceptions.RedisError:
+        _log_error()
+        return set()
+
+
+def add(user_id, posts):
+    ''' 关注时补充被关注者的博客，posts 是 (id, timestamp) 列表，缓存未建立时不处理 '''
+    if not posts:
+        return
+    try:
+        if not _warm([user_id]):
+            return
+        pipe = current_app.redis.pipeline(transaction=False)
+        _write(pipe, user_id, {id: to_score(ts) for id, ts in posts})
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def remove(user_id, post_ids):
+    ''' 取关时删除对应作者的博客 '''
+    if not post_ids:
+        return
+    try:
+        current_app.redis.zrem(_key(user_id), *post_ids)
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def invalidate(user_ids):
+    if not user_ids:
+        return
+    try:
+        current_app.redis.delete(*[k for x in user_ids for k in (_key(x), _warm_key(x))])
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def record(session, user_id, added=(), removed=()):
+    ''' 关注时要补充的博客 (id, timestamp) 和取关时要删除的博客 id，提交之后写入 '''
+    session.info.setdefault('timeline_changes', []).append((user_id, list(added), list(removed)))
+
+
+def apply(session):
+    for user_id, added, removed in session.info.pop('timeline_changes', []):
+        add(user_id, added)
+        remove(user_id, removed)
+
+
+def discard(session):
+    # 事务里重建的时间线可能包含回滚掉的关注，直接失效
+    changes = session.info.pop('timeline_changes', None)
+    if changes:
+        invalidate({x[0] for x in changes})
+
+
+def rebuild(user_id, posts):
+    ''' 用数据库查询的结果重新建立时间线 '''
+    try:
+        ttl = current_app.config['TIMELINE_TTL']
+        pipe = current_app.redis.pipeline()
+        pipe.delete(_key(user_id))
+        if posts:
+            pipe.zadd(_key(user_id), {id: to_score(ts) for id, ts in posts})
+            pipe.expire(_key(user_id), ttl)
+        pipe.set(_warm_key(user_id), 1, ex=ttl)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def cold_authors(author_ids):
+    ''' author_ids 里列表还没有建立的作者 '''
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for author_id in author_ids:
+            pipe.exists(_author_warm_key(author_id))
+        return [a for a, found in zip(author_ids, pipe.execute()) if not found]
+    except redis.exceptions.RedisError:
+        _log_error()
+        return []
+
+
+def rebuild_author(author_id, posts):
+    ''' 用数据库查询的结果建立作者的列表 '''
+    try:
+        ttl = current_app.config['TIMELINE_TTL']
+        pipe = current_app.redis.pipeline()
+        pipe.delete(_author_key(author_id))
+        if posts:
+            pipe.zadd(_author_key(author_id), {id: to_score(ts) for id, ts in posts})
+            pipe.expire(_author_key(author_id), ttl)
+        pipe.set(_author_warm_key(author_id), 1, ex=ttl)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def read(user_id, limit, offset=0, authors=(), bound=None, ascending=False):
+    '''
+    读取时间线，返回 ([(id, score)], total)，缓存或者大V的列表未建立、超出了缓存长度时返回 None
+    authors 是关注的大V，他们的列表已经按时间排好序，和推送的时间线一起用堆做多路归并
+    bound 是游标 (score, id)，只返回排在它后面的博客，ascending 表示往更新的方向读
+    '''
+    max_length = current_app.config['TIMELINE_MAX_LENGTH']
+    if offset + limit > max_length + 1:
+        # 缓存只保留最近的一部分，更早的页交给数据库
+        return None
+    keys = [_key(user_id)] + [_author_key(x) for x in authors]
+    # 只有一个来源时直接按位置取，需要归并时每个来源都要从头取
+    start = offset if len(keys) == 1 else 0
+    count = offset + limit - start
+    ttl = current_app.config['TIMELINE_TTL']
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        # EXPIRE 在 key 不存在时返回 0，同时判断缓存是否建立和延长过期时间
+        pipe.expire(_warm_key(user_id), ttl)
+        for author_id in authors:
+            pipe.expire(_author_warm_key(author_id), ttl)
+        for key in keys:
+            if bound is None:
+                fetch = pipe.zrange if ascending else pipe.zrevrange
+                fetch(key, start, start + count - 1, withscores=True)
+            else:
+                # 和游标同一时间的博客单独取出来按 id 比较
+                exclusive = '({!r}'.format(bound[0])
+                if ascending:
+                    pipe.zrangebyscore(key, exclusive, '+inf', start=0, num=count, withscores=True)
+                else:
+                    pipe.zrevrangebyscore(key, exclusive, '-inf', start=0, num=count, withscores=True)
+                pipe.zrangebyscore(key, bound[0], bound[0], withscores=True)
+            pipe.zcard(key)
+        for key in keys:
+            pipe.expire(key, ttl)
+        result = pipe.execute()[:-len(keys)]
+    except redis.exceptions.RedisError:
+        _log_error()
+        return None
+    if not all(result[:1 + len(authors)]):
+        return None
+    result = result[len(authors):]
+
+    sources = []
+    totals = []
+    step = 2 if bound is None else 3
+    for i in range(1, len(result), step):
+        rows = [(int(m), s) for m, s in result[i]]
+        if bound is not None:
+            rows += [(int(m), s) for m, s in result[i + 1]
+                     if (int(m) > bound[1] if ascending else int(m) < bound[1])]
+        rows.sort(key=lambda x: (x[1], x[0]), reverse=not ascending)
+        sources.append(rows)
+        totals.append(result[i + step - 1])
+
+    merged = heapq.merge(*sources, key=lambda x: (x[1], x[0]), reverse=not ascending)
+    rows = []
+    seen = set()
+    for id, score in merged:
+        if id not in seen:
+            seen.add(id)
+            rows.append((id, score))
+        if len(rows) == count:
+            break
+    if not ascending and len(rows) < count and max(totals) >= max_length:
+        return None
+    return rows[offset - start:], sum(totals)
+
+
+def get_page(user_id, page, per_page, authors=()):
+    ''' 按页读取，返回 (ids, total) '''
+    result = read(user_id, per_page, (page - 1) * per_page, authors)
+    if result is None:
+        return None
+    rows, total = result
+    return [id for id, score in rows], total
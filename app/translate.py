@@ -3,6 +3,7 @@ import requests
 from flask_babel import _
 from flask import current_app
 from hashlib import md5
+from guess_language import guess_language
 
 
 def translate(text, source_language, dest_language):
@@ -23,3 +24,13 @@ def translate(text, source_language, dest_language):
         return data['translation'][0], data['speakUrl']
     except:
         return _('错误：翻译服务返回错误'), None
+
+
+def detect_language(text):
+    ''' 博客的语言，保存在 Post.language 里，识别不了时是空字符串 '''
+    language = guess_language(text)
+    if language == 'UNKNOWN' or len(language) > 5:
+        language = ''
+    if language == 'zh':
+        language = 'zh_CN'
+    return language
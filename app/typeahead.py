@@ -0,0 +1,245 @@
+'''
+搜索框自动补全（/search/suggest），不查询数据库和 elasticsearch
+候选词保存在 redis 的两个 sorted set 里：
+    typeahead:users  用户名，分数是粉丝数，typeahead:usernames 保存 id 对应的用户名，改名时删除旧的
+    typeahead:terms  博客里的词（和搜索一样的分词），分数是出现的次数
+flask typeahead build（或者 rq 任务 app.tasks.build_typeahead）从数据库重建，最多保留 TYPEAHEAD_MAX_TERMS 个词，
+User/Post 提交之后增量更新。每个进程把候选词读进内存里的 PrefixIndex：排好序的数组，二分查找前缀，
+短前缀的结果建立时就算好了。每 TYPEAHEAD_REFRESH 秒重新读取一次，看到其它进程的更新
+'''
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import threading
+import time
+from flask import current_app
+import redis
+from sqlalchemy import inspect
+from app import db
+from app.local_search import tokenize
+
+USERS = 'typeahead:users'
+USERNAMES = 'typeahead:usernames'
+TERMS = 'typeahead:terms'
+
+# 这个长度以内的前缀预先算好结果，更长的前缀匹配的范围很小，直接扫描
+_PRECOMPUTED_PREFIX = 2
+
+
+class PrefixIndex(object):
+    def __init__(self, entries, limit):
+        ''' entries 是 [(词, 分数)]，按小写匹配，返回原来的词 '''
+        self.labels = {}
+        best = {}
+        for label, score in entries:
+            key = label.lower()
+            if score >= best.get(key, -1):
+                best[key] = score
+                self.labels[key] = label
+        entries = sorted(best.items())
+        self.keys = [key for key, _ in entries]
+        self.scores = [score for _, score in entries]
+        self.limit = limit
+        self.top = {}
+        for length in range(1, _PRECOMPUTED_PREFIX + 1):
+            groups = {}
+            for key, score in entries:
+                if len(key) >= length:
+                    groups.setdefault(key[:length], []).append((score, key))
+            for prefix, items in groups.items():
+                self.top[prefix] = [key for score, key in heapq.nlargest(
+                    limit, items, key=lambda x: (x[0], _reverse(x[1])))]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, prefix, limit=None):
+        ''' 以 prefix 开头的词，按分数从高到低，分数相同时按字母顺序 '''
+        limit = min(limit or self.limit, self.limit)
+        prefix = prefix.lower()
+        if prefix in self.top:
+            keys = self.top[prefix][:limit]
+        else:
+            keys = self._scan(prefix, limit)
+        return [self.labels[key] for key in keys]
+
+    def _scan(self, prefix, limit):
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + '\U0010ffff', start)
+        items = zip(self.scores[start:end], self.keys[start:end])
+        return [key for score, key in heapq.nlargest(
+            limit, items, key=lambda x: (x[0], _reverse(x[1])))]
+
+    def add(self, label, score):
+        # 单个词的增量更新，预先算好的短前缀结果也要更新
+        key = label.lower()
+        self.labels[key] = label
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            self.scores[i] = score
+        else:
+            self.keys.insert(i, key)
+            self.scores.insert(i, score)
+        for length in range(1, min(len(key), _PRECOMPUTED_PREFIX) + 1):
+            top = [x for x in self.top.get(key[:length], []) if x != key] + [key]
+            top.sort(key=lambda x: (-self._score(x), x))
+            self.top[key[:length]] = top[:self.limit]
+
+    def _score(self, key):
+        return self.scores[bisect_left(self.keys, key)]
+
+
+def _reverse(key):
+    # nlargest 里分数相同时让字母顺序小的排在前面
+    return [-ord(c) for c in key]
+
+
+class Typeahead(object):
+    def __init__(self, client, limit, refresh):
+        self.redis = client
+        self.limit = limit
+        self.refresh = refresh
+        self.indexes = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        max_terms = current_app.config['TYPEAHEAD_MAX_TERMS']
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrevrange(USERS, 0, max_terms - 1, withscores=True)
+        pipe.zrevrange(TERMS, 0, max_terms - 1, withscores=True)
+        users, terms = pipe.execute()
+        return {
+            'users': PrefixIndex([(k.decode('utf-8'), s) for k, s in users], self.limit),
+            'terms': PrefixIndex([(k.decode('utf-8'), s) for k, s in terms], self.limit),
+        }
+
+    def get_indexes(self):
+        if self.indexes is None or time.time() - self.loaded > self.refresh:
+            indexes = self._load()
+            with self.lock:
+                self.indexes = indexes
+                self.loaded = time.time()
+        return self.indexes
+
+    def suggest(self, prefix, limit):
+        prefix = prefix.strip()
+        if not prefix:
+            return {'users': [], 'terms': []}
+        indexes = self.get_indexes()
+        # add 在锁里分别修改 keys 和 scores，查询也要拿锁，不会读到改了一半的数组
+        with self.lock:
+            return {name: index.search(prefix, limit) for name, index in indexes.items()}
+
+    def add(self, users, terms):
+        ''' users 是 {id: (用户名, 粉丝数)}，terms 是 {词: 增加的次数} '''
+        ids = list(users)
+        old = self.redis.hmget(USERNAMES, ids) if ids else []
+        removed = [x.decode('utf-8') for id, x in zip(ids, old)
+                   if x is not None and x.decode('utf-8') != users[id][0]]
+        pipe = self.redis.pipeline(transaction=False)
+        if removed:
+            pipe.zrem(USERS, *removed)
+        for id, (username, score) in users.items():
+            pipe.zadd(USERS, {username: score})
+            pipe.hset(USERNAMES, id, username)
+        for term, count in terms.items():
+            pipe.zincrby(TERMS, count, term)
+        # 超过上限两倍时去掉分数最低的，集合不会无限增长
+        max_terms = current_app.config['TYPEAHEAD_MAX_TERMS']
+        pipe.zremrangebyrank(USERS, 0, -(max_terms * 2 + 1))
+        pipe.zremrangebyrank(TERMS, 0, -(max_terms * 2 + 1))
+        result = pipe.execute()
+        if removed:
+            # 改名比较少见，直接让当前进程下次请求时重新读取
+            self.indexes = None
+        if self.indexes is not None:
+            with self.lock:
+                for username, score in users.values():
+                    self.indexes['users'].add(username, score)
+                for term, score in zip(terms, result[len(users) * 2:]):
+                    self.indexes['terms'].add(term, score)
+
+
+def create_typeahead(app):
+    return Typeahead(app.redis, app.config['TYPEAHEAD_LIMIT'], app.config['TYPEAHEAD_REFRESH'])
+
+
+def _log_error():
+    current_app.logger.warning('typeahead unavailable', exc_info=True)
+
+
+def suggest(prefix, limit=None):
+    try:
+        return current_app.typeahead.suggest(prefix, limit)
+    except redis.exceptions.RedisError:
+        _log_error()
+        return {'users': [], 'terms': []}
+
+
+def _terms(text):
+    # 单个汉字和一个字母的词补全没有意义
+    return [x for x in tokenize(text) if len(x) > 1]
+
+
+def build(batch_size=1000):
+    ''' 从数据库重建候选词，返回 (用户数, 词数) '''
+    from app.models import User, Post
+    max_terms = current_app.config['TYPEAHEAD_MAX_TERMS']
+    client = current_app.redis
+    users = db.session.query(User.id, User.username, User.follower_count)\
+        .order_by(User.follower_count.desc()).limit(max_terms).all()
+
+    # 只统计最近的博客，词表大小和最近的热度都有限制
+    terms = Counter()
+    query = db.session.query(Post.body).order_by(Post.id.desc())\
+        .limit(current_app.config['TYPEAHEAD_POST_SAMPLE']).yield_per(batch_size)
+    for body, in query:
+        terms.update(set(_terms(body)))
+        if len(terms) > max_terms * 4:
+            # 词太多时丢掉出现次数少的，内存不会无限增长
+            terms = Counter(dict(terms.most_common(max_terms * 2)))
+    terms = dict(terms.most_common(max_terms))
+
+    pipe = client.pipeline()
+    pipe.delete(USERS, USERNAMES, TERMS)
+    if users:
+        pipe.zadd(USERS, {username: score for id, username, score in users})
+        # hset 的 mapping 参数要 redis-py 3.5，requirements 里是 3.0
+        pipe.hmset(USERNAMES, {id: username for id, username, score in users})
+    if terms:
+        pipe.zadd(TERMS, terms)
+    pipe.execute()
+    current_app.typeahead.indexes = None
+    return len(users), len(terms)
+
+
+def collect(session, flush_context):
+    ''' flush 之后记下新用户、改了名字的用户和新博客的词，提交之后写入 '''
+    from app.models import User, Post
+    pending = session.info.setdefault('typeahead', {'users': {}, 'terms': Counter()})
+    for x in session.new:
+        if isinstance(x, User):
+            pending['users'][x.id] = (x.username, 0)
+        elif isinstance(x, Post):
+            pending['terms'].update(set(_terms(x.body)))
+    for x in session.dirty:
+        if isinstance(x, User) and inspect(x).attrs.username.history.has_changes():
+            # follower_count 可能是还没有刷新的 SQL 表达式
+            follower_count = inspect(x).dict.get('follower_count')
+            pending['users'][x.id] = (x.username, follower_count if isinstance(follower_count, int) else 0)
+
+
+def apply(session):
+    pending = session.info.pop('typeahead', None)
+    if not pending:
+        return
+    try:
+        if pending['users'] or pending['terms']:
+            current_app.typeahead.add(pending['users'], pending['terms'])
+    except redis.exceptions.RedisError:
+        _log_error()
+
+
+def discard(session):
+    session.info.pop('typeahead', None)
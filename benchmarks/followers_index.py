@@ -0,0 +1,111 @@
+'''
+followers 表加主键和反向索引前后的对比
+在 SQLite 里生成 N 个用户和 M 条关注关系，输出 followed_posts、is_following、get_followers
+三个查询的耗时和 EXPLAIN QUERY PLAN
+
+用法: python benchmarks/followers_index.py --users 10000 --edges 200000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+from app.models import User, Post, followers  # noqa: E402
+from config import TestConfig  # noqa: E402
+
+
+def seed(users, edges, posts_per_user):
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+         'password_hash': 'x'} for i in range(1, users + 1)])
+    db.session.execute(Post.__table__.insert(), [
+        {'body': 'post', 'user_id': i, 'timestamp': now - timedelta(seconds=random.randint(0, 10 ** 6))}
+        for i in range(1, users + 1) for _ in range(posts_per_user)])
+    pairs = set()
+    while len(pairs) < edges:
+        a, b = random.randint(1, users), random.randint(1, users)
+        if a != b:
+            pairs.add((a, b))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in pairs])
+    db.session.commit()
+    return sorted(pairs)
+
+
+def drop_keys():
+    # 还原成没有主键和索引的旧表
+    for sql in ['CREATE TABLE followers_old AS SELECT follower_id, followed_id FROM followers',
+                'DROP TABLE followers',
+                'ALTER TABLE followers_old RENAME TO followers']:
+        db.session.execute(sql)
+    db.session.commit()
+
+
+def queries(user_id, other_id):
+    user = User.query.get(user_id)
+    return [
+        ('followed_posts', user.followed_posts().limit(10)),
+        ('is_following', db.session.query(db.func.count()).select_from(followers).filter(
+            followers.c.follower_id == user_id, followers.c.followed_id == other_id)),
+        ('get_followers', user.followers.limit(10)),
+    ]
+
+
+def measure(pairs, rounds):
+    results = {}
+    plans = {}
+    for _ in range(rounds):
+        user_id, other_id = random.choice(pairs)
+        for name, query in queries(user_id, other_id):
+            if name not in plans:
+                statement = query.statement.compile(
+                    dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+                plans[name] = db.session.execute('EXPLAIN QUERY PLAN ' + str(statement)).fetchall()
+            start = time.perf_counter()
+            query.all()
+            results[name] = results.get(name, 0) + time.perf_counter() - start
+    return {name: total / rounds * 1000 for name, total in results.items()}, plans
+
+
+def report(title, timings, plans):
+    print('== {} =='.format(title))
+    for name, ms in timings.items():
+        print('{:<16}{:>10.3f} ms'.format(name, ms))
+        for row in plans[name]:
+            print('    ' + ' | '.join(str(x) for x in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--edges', type=int, default=100000)
+    parser.add_argument('--posts', type=int, default=5, help='每个用户的博客数')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        pairs = seed(args.users, args.edges, args.posts)
+        after = measure(pairs, args.rounds)
+        drop_keys()
+        before = measure(pairs, args.rounds)
+        report('before: no primary key / index', *before)
+        report('after: primary key + (followed_id, follower_id) index', *after)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+导入博客：按批多行 INSERT 和 ORM 每条 add 再提交的对比
+生成 N 行 NDJSON，分别用 app.imports.import_posts 和逐条 db.session.add(Post) + commit 写入，
+后者每条提交时还会经过 flush 事件（计数、时间线）和 after_commit 的搜索索引
+
+用法: python benchmarks/import_posts.py --rows 20000 --batch-size 500
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db, imports  # noqa: E402
+from app.models import User, Post  # noqa: E402
+from app.translate import detect_language  # noqa: E402
+from config import TestConfig  # noqa: E402
+
+WORDS = 'the quick brown fox jumps over lazy dog while python and flask serve many happy users'.split()
+
+
+def write_posts(filename, rows):
+    start = datetime(2019, 1, 1)
+    with open(filename, 'w', encoding='utf-8') as f:
+        for i in range(rows):
+            body = ' '.join(WORDS[(i + j) % len(WORDS)] for j in range(8))
+            f.write(json.dumps({'body': body, 'timestamp': (start + timedelta(minutes=i)).isoformat() + 'Z'}))
+            f.write('\n')
+
+
+def orm_import(user, filename):
+    count = 0
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            row = imports.parse(line)
+            if row is None:
+                continue
+            body, timestamp = row
+            db.session.add(Post(body=body, timestamp=timestamp, author=user, language=detect_language(body)))
+            db.session.commit()
+            count += 1
+    return count
+
+
+def measure(func, user, filename):
+    start = time.perf_counter()
+    count = func(user, filename)
+    if isinstance(count, tuple):
+        count = count[0]
+    return count, count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'bench.db')
+    filename = os.path.join(tmp, 'posts.ndjson')
+    write_posts(filename, args.rows)
+
+    class BenchConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        IMPORT_BATCH_SIZE = args.batch_size
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i), password_hash='x')
+                 for i in range(2)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        orm_count, orm_rate = measure(orm_import, users[0], filename)
+        bulk_count, bulk_rate = measure(imports.import_posts, users[1], filename)
+        assert orm_count == bulk_count == args.rows, 'row counts differ'
+
+        print('{:<24}{:>12.0f} rows/s'.format('orm add per row', orm_rate))
+        print('{:<24}{:>12.0f} rows/s'.format('batched insert', bulk_rate))
+    os.remove(path)
+    os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
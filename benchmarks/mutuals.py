@@ -0,0 +1,89 @@
+'''
+共同关注：SQL 自连接和缓存的有序数组求交集的对比
+在 SQLite 里生成 N 个用户和 M 条关注关系，被关注的用户按幂律分布（少数用户粉丝很多），
+随机取 (viewer, owner) 计算 viewer 关注的人里有多少关注了 owner，以及前几个的 id
+
+用法: python benchmarks/mutuals.py --users 10000 --edges 200000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db, mutuals  # noqa: E402
+from app.models import User, followers  # noqa: E402
+from config import TestConfig  # noqa: E402
+
+
+def seed(users, edges):
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+         'password_hash': 'x'} for i in range(1, users + 1)])
+    pairs = set()
+    while len(pairs) < edges:
+        a = random.randint(1, users)
+        b = min(int(random.paretovariate(1.2)), users)
+        if a != b:
+            pairs.add((a, b))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in pairs])
+    db.session.commit()
+    return sorted(pairs)
+
+
+def sql_mutuals(viewer_id, user_id, sample):
+    a = followers.alias('a')
+    b = followers.alias('b')
+    query = db.session.query(a.c.followed_id).join(b, a.c.followed_id == b.c.follower_id).filter(
+        a.c.follower_id == viewer_id, b.c.followed_id == user_id)
+    return query.count(), [id for id, in query.order_by(a.c.followed_id).limit(sample)]
+
+
+def cached_mutuals(viewer_id, user_id, sample):
+    return mutuals.mutual_followers(viewer_id, user_id, sample)
+
+
+def measure(func, cases, sample):
+    start = time.perf_counter()
+    results = [func(viewer_id, user_id, sample) for viewer_id, user_id in cases]
+    return (time.perf_counter() - start) / len(cases) * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--edges', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=500)
+    parser.add_argument('--sample', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        seed(args.users, args.edges)
+        # owner 多数是粉丝多的用户，和个人主页的访问分布接近
+        cases = [(random.randint(1, args.users), min(int(random.paretovariate(1.2)), args.users))
+                 for _ in range(args.rounds)]
+
+        sql_ms, expected = measure(sql_mutuals, cases, args.sample)
+        cold_ms, _ = measure(cached_mutuals, cases, args.sample)
+        warm_ms, results = measure(cached_mutuals, cases, args.sample)
+        assert results == expected, 'results differ'
+
+        print('{:<24}{:>10.3f} ms'.format('sql self-join', sql_ms))
+        print('{:<24}{:>10.3f} ms'.format('arrays, cold cache', cold_ms))
+        print('{:<24}{:>10.3f} ms'.format('arrays, warm cache', warm_ms))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+内置搜索（app.local_search）和 elasticsearch 的对比：建索引时间、索引大小、查询延迟
+随机生成中英文混合的博客，内置搜索的大小用 tracemalloc 统计建索引时分配的内存，
+elasticsearch 的大小是 indices.stats 里主分片的 store.size_in_bytes
+
+用法: python benchmarks/search_backend.py --posts 100000 [--es http://localhost:9200]
+'''
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.local_search import LocalElasticsearch  # noqa: E402
+
+WORDS = ['python', 'flask', 'redis', 'search', 'index', 'query', 'cache', 'timeline',
+         'follow', 'post', 'message', 'database', 'worker', 'task', 'profile', 'hello']
+# U+4E00 开始的 1000 个汉字
+HANZI = [chr(0x4e00 + i) for i in range(1000)]
+
+
+def make_post():
+    words = random.sample(WORDS, 3)
+    hanzi = ''.join(random.choice(HANZI) for _ in range(random.randint(10, 40)))
+    return ' '.join(words) + ' ' + hanzi
+
+
+def make_query(posts):
+    if random.random() < 0.5:
+        return random.choice(WORDS)
+    # 从博客里取两个相邻的汉字，保证有结果
+    text = random.choice(posts)[1].split()[-1]
+    start = random.randint(0, len(text) - 2)
+    return text[start:start + 2]
+
+
+def bulk_body(index, posts):
+    body = []
+    for id, text in posts:
+        body.append({'index': {'_index': index, '_type': index, '_id': id}})
+        body.append({'body': text})
+    return body
+
+
+def run(es, index, posts, queries, batch_size=1000):
+    start = time.perf_counter()
+    for i in range(0, len(posts), batch_size):
+        es.bulk(body=bulk_body(index, posts[i:i + batch_size]))
+    build = time.perf_counter() - start
+    es.indices.refresh(index=index)
+
+    start = time.perf_counter()
+    for q in queries:
+        es.search(index=index, doc_type=index, body={
+            'query': {'multi_match': {'query': q, 'fields': ['*']}}, 'from': 0, 'size': 10})
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    return build, latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--es', help='elasticsearch 地址，不提供时只测内置搜索')
+    args = parser.parse_args()
+
+    random.seed(1)
+    posts = [(i, make_post()) for i in range(1, args.posts + 1)]
+    queries = [make_query(posts) for _ in range(args.queries)]
+
+    # 大小单独建一次统计，tracemalloc 会拖慢计时
+    tracemalloc.start()
+    local = LocalElasticsearch()
+    local.indices.create(index='bench')
+    run(local, 'bench', posts, queries[:1])
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    local = LocalElasticsearch()
+    local.indices.create(index='bench')
+    build, latency = run(local, 'bench', posts, queries)
+    print('{:<16}build {:>8.2f} s  size {:>8.1f} MB  query {:>8.3f} ms'.format(
+        'builtin', build, size / 2 ** 20, latency))
+    print('{:<16}{}'.format('', local.indices.stats(index='bench')['local']))
+
+    if args.es:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch([args.es])
+        index = 'microblog-bench'
+        if es.indices.exists(index=index):
+            es.indices.delete(index=index)
+        es.indices.create(index=index, body={'settings': {'analysis': {
+            'analyzer': {'default': {'type': 'cjk'}}}}})
+        build, latency = run(es, index, posts, queries)
+        es.indices.forcemerge(index=index, max_num_segments=1)
+        stats = es.indices.stats(index=index)['_all']['primaries']['store']['size_in_bytes']
+        print('{:<16}build {:>8.2f} s  size {:>8.1f} MB  query {:>8.3f} ms'.format(
+            'elasticsearch', build, stats / 2 ** 20, latency))
+        es.indices.delete(index=index)
+
+
+if __name__ == '__main__':
+    main()
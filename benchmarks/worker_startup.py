@@ -0,0 +1,74 @@
+'''
+rq worker 任务启动延迟：从 fork 子进程到可以开始执行任务函数的时间
+rq worker 每个任务 fork 一个子进程，父进程没有导入任务模块时，子进程要先导入 app.tasks：
+
+    full app      原来的 app.tasks，导入时 create_app() 创建完整的 app（所有扩展和蓝图）
+    worker app    导入 app.tasks 后 bootstrap()，只初始化任务用到的部分
+    preloaded     worker.py 的做法，父进程已经 bootstrap()，子进程直接复用
+
+只支持有 os.fork 的系统。用法: python benchmarks/worker_startup.py --rounds 10
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 和 rq worker 的父进程一样，只导入 rq 和 redis
+import rq  # noqa: E402,F401
+import redis  # noqa: E402,F401
+from config import TestConfig  # noqa: E402
+
+
+def full_app():
+    from app import create_app
+    import app.models  # noqa: F401
+    create_app(TestConfig).app_context().push()
+
+
+def worker_app():
+    from app import tasks
+    tasks.bootstrap(TestConfig)
+
+
+def fork_latency(prepare):
+    ''' fork 一个子进程执行 prepare，返回从 fork 到子进程准备好的毫秒数 '''
+    read, write = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        prepare()
+        os.write(write, b'1')
+        os._exit(0)
+    os.close(write)
+    os.read(read, 1)
+    elapsed = (time.perf_counter() - start) * 1000
+    os.close(read)
+    os.waitpid(pid, 0)
+    return elapsed
+
+
+def measure(prepare, rounds):
+    return statistics.median(fork_latency(prepare) for _ in range(rounds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    # 先测父进程没有导入 app 的情况，预加载之后就测不了了
+    results = [('full app', measure(full_app, args.rounds)),
+               ('worker app', measure(worker_app, args.rounds))]
+    worker_app()
+    results.append(('preloaded', measure(worker_app, args.rounds)))
+
+    for name, ms in results:
+        print('{:<24}{:>10.1f} ms'.format(name, ms))
+
+
+if __name__ == '__main__':
+    main()
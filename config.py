@@ -21,9 +21,40 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     # 分页每页数量
     POSTS_PER_PAGE = 5
+    # 页面默认使用游标分页，否则只有带了 cursor 参数的请求才使用
+    CURSOR_PAGINATION = os.environ.get('CURSOR_PAGINATION') is not None
+    # 分页总数的计算方式，exact/cached/counter/estimate，见 app/counts.py，没有配置的 endpoint 直接 COUNT
+    COUNT_MODES = {
+        'main.index': 'cached',
+        'main.explore': 'estimate',
+        'main.messages': 'counter',
+        'api.get_users': 'estimate',
+    }
+    COUNT_CACHE_TTL = 60
+    COUNT_COUNTER_TTL = 24 * 3600
 
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
 
+    # 首页时间线缓存，每个用户最多缓存多少条，缓存多久没有访问就失效（秒）
+    TIMELINE_MAX_LENGTH = 800
+    TIMELINE_TTL = 7 * 24 * 3600
+    # 粉丝数达到这个值的用户发博客不推送给粉丝，粉丝读取首页时再拉取
+    TIMELINE_CELEBRITY_THRESHOLD = 10000
+    # 粉丝数超过这个值时推送交给 rq worker，发博客的请求不用等所有粉丝的时间线写完
+    TIMELINE_FANOUT_ASYNC_THRESHOLD = 500
+
+    # 关注关系缓存，redis 或者 local（单机，进程内），local 最多缓存多少个用户
+    FOLLOW_CACHE = os.environ.get('FOLLOW_CACHE') or 'redis'
+    FOLLOW_CACHE_TTL = 24 * 3600
+    FOLLOW_CACHE_LOCAL_USERS = 10000
+    # 共同关注缓存的 id 数组最多多少个 id，粉丝更多的用户查询时用自连接
+    MUTUALS_MAX_CACHED_IDS = 10000
+    # 批量关注/取关接口一次最多处理的用户数
+    BULK_FOLLOW_MAX = 1000
+
+    # 推荐关注，每个用户保存多少个候选，由 app.tasks.compute_suggestions 离线计算
+    SUGGESTIONS_TOP_K = 50
+
     # mail 如果启用邮件发送 则export MAIL_SERVER=xxx 否则视为不启用
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = os.environ.get('MAIL_PORT') or 25
@@ -43,6 +74,43 @@ class Config(object):
     YOUDAO_APP_KEY = os.environ.get('YOUDAO_APP_KEY')
     YOUDAO_APP_SECRET_KEY = os.environ.get('YOUDAO_APP_SECRET_KEY')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 提交后的索引更新交给 rq worker，请求不再等待 elasticsearch
+    SEARCH_INDEX_ASYNC = os.environ.get('SEARCH_INDEX_ASYNC') is not None
+    # 搜索结果缓存（每个进程），最多缓存多少个查询的页，缓存多少秒，0 表示不缓存
+    SEARCH_CACHE_MAX_ENTRIES = 1000
+    SEARCH_CACHE_TTL = 30
+    # 一次查询取出多少页的结果放进缓存，翻页时不再查询
+    SEARCH_CACHE_PREFETCH_PAGES = 1
+    # 搜索框自动补全，每类最多返回几个，进程内的前缀索引多久从 redis 重新读取（秒），
+    # 最多保留多少个用户名和词，统计最近多少篇博客里的词
+    TYPEAHEAD_LIMIT = 8
+    TYPEAHEAD_REFRESH = 60
+    TYPEAHEAD_MAX_TERMS = 50000
+    TYPEAHEAD_POST_SAMPLE = 100000
+    # 通知推送（app/notify.py），SSE 连接保持多少秒后让浏览器重连，空闲时多少秒发送一次心跳，
+    # 长轮询最多等待多少秒
+    NOTIFICATION_STREAM_TIMEOUT = 300
+    NOTIFICATION_HEARTBEAT = 15
+    NOTIFICATION_LONG_POLL = 25
+    # 已读的通知保留多少秒，多少秒没有更新的通知删除
+    NOTIFICATION_READ_RETENTION = 7 * 24 * 3600
+    NOTIFICATION_RETENTION = 30 * 24 * 3600
+    # 后台任务的进度（app/progress.py）每增加几个百分点或者隔几秒才写入一次
+    TASK_PROGRESS_STEP = 5
+    TASK_PROGRESS_INTERVAL = 5
+    # 导出博客（app/exports.py）：文件目录，每次查询读取多少条，压缩后不超过多少字节时作为邮件附件
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(basedir, 'exports')
+    EXPORT_CHUNK_SIZE = 1000
+    EXPORT_ATTACHMENT_MAX_SIZE = 1024 * 1024
+    # 导入博客（app/imports.py）：上传文件保存的目录，上传文件的大小上限，每批（一条 INSERT、一个事务）写入多少条，
+    # 每行 4 个参数，SQLite 一条语句最多 999 个参数
+    IMPORT_DIR = os.environ.get('IMPORT_DIR') or os.path.join(basedir, 'imports')
+    IMPORT_MAX_SIZE = 64 * 1024 * 1024
+    # 请求体的大小上限，最大的上传是导入博客，超过的请求 werkzeug 在读取请求体之前返回 413
+    MAX_CONTENT_LENGTH = IMPORT_MAX_SIZE
+    IMPORT_BATCH_SIZE = 200
+    # 后台任务发送的邮件里链接的地址
+    BASE_URL = os.environ.get('BASE_URL') or 'http://localhost:5000'
 
     # 常量
     UNREAD_MESSAGE_COUNT = 'unread_message_count'
@@ -51,3 +119,5 @@ class Config(object):
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # 测试使用进程内的 redis 替身
+    REDIS_URL = 'local://'
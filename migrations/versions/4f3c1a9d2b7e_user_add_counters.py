@@ -0,0 +1,56 @@
+"""user add counters
+
+Revision ID: 4f3c1a9d2b7e
+Revises: ba33a5b17842
+Create Date: 2026-10-18 17:30:12.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f3c1a9d2b7e'
+down_revision = 'ba33a5b17842'
+branch_labels = None
+depends_on = None
+
+# 回填时每批处理的用户数
+BATCH_SIZE = 1000
+
+user = sa.table('user',
+                sa.column('id', sa.Integer),
+                sa.column('post_count', sa.Integer),
+                sa.column('follower_count', sa.Integer),
+                sa.column('followed_count', sa.Integer))
+post = sa.table('post', sa.column('user_id', sa.Integer))
+followers = sa.table('followers',
+                     sa.column('follower_id', sa.Integer),
+                     sa.column('followed_id', sa.Integer))
+
+
+def _count(column):
+    return sa.select([sa.func.count()]).where(column == user.c.id).as_scalar()
+
+
+def upgrade():
+    op.add_column('user', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+
+    # 按 id 分批回填，每次只锁一小段用户
+    conn = op.get_bind()
+    max_id = conn.execute(sa.select([sa.func.max(user.c.id)])).scalar() or 0
+    for start in range(1, max_id + 1, BATCH_SIZE):
+        conn.execute(user.update()
+                     .where(user.c.id.between(start, start + BATCH_SIZE - 1))
+                     .values(post_count=_count(post.c.user_id),
+                             follower_count=_count(followers.c.followed_id),
+                             followed_count=_count(followers.c.follower_id)))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
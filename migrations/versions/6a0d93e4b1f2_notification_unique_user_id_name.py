@@ -0,0 +1,46 @@
+"""notification unique (user_id, name)
+
+Revision ID: 6a0d93e4b1f2
+Revises: c51e7a2f9d08
+Create Date: 2026-10-18 22:14:09.502871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a0d93e4b1f2'
+down_revision = 'c51e7a2f9d08'
+branch_labels = None
+depends_on = None
+
+# 每批删除的重复通知数
+BATCH_SIZE = 1000
+
+notification = sa.table('notification',
+                        sa.column('id', sa.Integer),
+                        sa.column('user_id', sa.Integer),
+                        sa.column('name', sa.String))
+
+
+def upgrade():
+    # 以前是先删除再插入，并发时可能留下重复的行，每个 (user_id, name) 只保留 id 最大（最新）的一行
+    conn = op.get_bind()
+    duplicated = conn.execute(
+        sa.select([notification.c.user_id, notification.c.name, sa.func.max(notification.c.id)])
+        .group_by(notification.c.user_id, notification.c.name)
+        .having(sa.func.count() > 1)).fetchall()
+    ids = []
+    for user_id, name, keep in duplicated:
+        ids.extend(id for id, in conn.execute(
+            sa.select([notification.c.id]).where(notification.c.user_id == user_id)
+            .where(notification.c.name == name).where(notification.c.id != keep)))
+    for start in range(0, len(ids), BATCH_SIZE):
+        conn.execute(notification.delete().where(notification.c.id.in_(ids[start:start + BATCH_SIZE])))
+
+    op.create_index('ix_notification_user_id_name', 'notification', ['user_id', 'name'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_notification_user_id_name', table_name='notification')
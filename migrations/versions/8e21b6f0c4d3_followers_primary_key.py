@@ -0,0 +1,144 @@
+"""followers primary key
+
+Revision ID: 8e21b6f0c4d3
+Revises: 4f3c1a9d2b7e
+Create Date: 2026-10-18 18:05:47.902114
+
+MySQL 用 InnoDB 在线 DDL。PostgreSQL 也是在线的：结束 alembic 的迁移事务（alembic 1.0 没有
+autocommit_block），去重每批单独提交，NOT NULL 先用 NOT VALID 的 CHECK 约束验证（PostgreSQL 12 起
+SET NOT NULL 不再扫表），主键和反向索引用 CREATE INDEX CONCURRENTLY 建好再挂上。
+CONCURRENTLY 失败（比如建索引期间又插入了重复的关系）会留下无效的索引，重新执行迁移时先删掉。
+其它数据库（sqlite）用 batch 模式重建表，需要停机
+"""
+from contextlib import contextmanager
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e21b6f0c4d3'
+down_revision = '4f3c1a9d2b7e'
+branch_labels = None
+depends_on = None
+
+# 去重时每批处理的 follower_id 范围
+BATCH_SIZE = 1000
+
+followers = sa.table('followers',
+                     sa.column('follower_id', sa.Integer),
+                     sa.column('followed_id', sa.Integer))
+user = sa.table('user',
+                sa.column('id', sa.Integer),
+                sa.column('follower_count', sa.Integer),
+                sa.column('followed_count', sa.Integer))
+
+
+def _decrement(conn, follower_id, followed_id, count):
+    # 删除关系的同时修正 user 上的冗余计数
+    if follower_id is not None:
+        conn.execute(user.update().where(user.c.id == follower_id)
+                     .values(followed_count=user.c.followed_count - count))
+    if followed_id is not None:
+        conn.execute(user.update().where(user.c.id == followed_id)
+                     .values(follower_count=user.c.follower_count - count))
+
+
+@contextmanager
+def _no_transaction():
+    yield
+
+
+@contextmanager
+def _postgresql_transaction(conn):
+    # 迁移事务已经结束，psycopg2 不会再自动 BEGIN，每批自己开始和提交
+    conn.execute('BEGIN')
+    try:
+        yield
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _dedupe(conn, batch=_no_transaction):
+    ''' batch() 包住每一批，PostgreSQL 上每批是一个单独提交的事务 '''
+    # 主键不能有空值
+    has_null = sa.or_(followers.c.follower_id.is_(None), followers.c.followed_id.is_(None))
+    with batch():
+        for follower_id, followed_id, count in conn.execute(
+                sa.select([followers.c.follower_id, followers.c.followed_id, sa.func.count()])
+                .where(has_null)
+                .group_by(followers.c.follower_id, followers.c.followed_id)).fetchall():
+            _decrement(conn, follower_id, followed_id, count)
+        conn.execute(followers.delete().where(has_null))
+
+    # 按 follower_id 分批找出重复的关系，删掉之后只插回一条
+    max_id = conn.execute(sa.select([sa.func.max(followers.c.follower_id)])).scalar() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        with batch():
+            duplicates = conn.execute(
+                sa.select([followers.c.follower_id, followers.c.followed_id, sa.func.count()])
+                .where(followers.c.follower_id.between(start, start + BATCH_SIZE - 1))
+                .group_by(followers.c.follower_id, followers.c.followed_id)
+                .having(sa.func.count() > 1)).fetchall()
+            for follower_id, followed_id, count in duplicates:
+                conn.execute(followers.delete().where(sa.and_(
+                    followers.c.follower_id == follower_id, followers.c.followed_id == followed_id)))
+                conn.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+                _decrement(conn, follower_id, followed_id, count - 1)
+
+
+def _upgrade_postgresql(conn):
+    # 结束 alembic 的迁移事务，之后每条语句自动提交
+    conn.execute('COMMIT')
+    _dedupe(conn, lambda: _postgresql_transaction(conn))
+    for column in ['follower_id', 'followed_id']:
+        check = 'ck_followers_{}_not_null'.format(column)
+        conn.execute('ALTER TABLE followers DROP CONSTRAINT IF EXISTS {}'.format(check))
+        # NOT VALID 只锁一下表，VALIDATE 扫表时不阻塞读写，SET NOT NULL 用验证过的约束，不再扫表
+        conn.execute('ALTER TABLE followers ADD CONSTRAINT {} CHECK ({} IS NOT NULL) NOT VALID'
+                     .format(check, column))
+        conn.execute('ALTER TABLE followers VALIDATE CONSTRAINT {}'.format(check))
+        conn.execute('ALTER TABLE followers ALTER COLUMN {} SET NOT NULL'.format(column))
+        conn.execute('ALTER TABLE followers DROP CONSTRAINT {}'.format(check))
+    for name, columns, unique in [('pk_followers', 'follower_id, followed_id', 'UNIQUE '),
+                                  ('ix_followers_followed_id_follower_id', 'followed_id, follower_id', '')]:
+        conn.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+        conn.execute('CREATE {}INDEX CONCURRENTLY {} ON followers ({})'.format(unique, name, columns))
+    conn.execute('ALTER TABLE followers ADD CONSTRAINT pk_followers PRIMARY KEY USING INDEX pk_followers')
+    # 还给 alembic 一个事务，用来更新 alembic_version
+    conn.execute('BEGIN')
+
+
+def upgrade():
+    conn = op.get_bind()
+    if conn.dialect.name == 'postgresql':
+        _upgrade_postgresql(conn)
+        return
+
+    _dedupe(conn)
+    if conn.dialect.name == 'mysql':
+        # InnoDB 在线 DDL，建主键和索引的过程中表仍然可以读写
+        op.execute('ALTER TABLE followers '
+                   'MODIFY follower_id INTEGER NOT NULL, '
+                   'MODIFY followed_id INTEGER NOT NULL, '
+                   'ADD PRIMARY KEY (follower_id, followed_id), '
+                   'ADD INDEX ix_followers_followed_id_follower_id (followed_id, follower_id), '
+                   'ALGORITHM=INPLACE, LOCK=NONE')
+        return
+
+    # sqlite 不能直接加主键，batch 模式会重建表
+    with op.batch_alter_table('followers') as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+    op.create_index('ix_followers_followed_id_follower_id', 'followers',
+                    ['followed_id', 'follower_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    with op.batch_alter_table('followers') as batch_op:
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
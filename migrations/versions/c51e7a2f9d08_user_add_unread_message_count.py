@@ -0,0 +1,46 @@
+"""user add unread_message_count
+
+Revision ID: c51e7a2f9d08
+Revises: 8e21b6f0c4d3
+Create Date: 2026-10-18 21:05:41.736120
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c51e7a2f9d08'
+down_revision = '8e21b6f0c4d3'
+branch_labels = None
+depends_on = None
+
+# 回填时每批处理的用户数
+BATCH_SIZE = 1000
+
+user = sa.table('user',
+                sa.column('id', sa.Integer),
+                sa.column('last_message_read_time', sa.DateTime),
+                sa.column('unread_message_count', sa.Integer))
+message = sa.table('message',
+                   sa.column('receiver_id', sa.Integer),
+                   sa.column('timestamp', sa.DateTime))
+
+
+def upgrade():
+    op.add_column('user', sa.Column('unread_message_count', sa.Integer(), server_default='0', nullable=False))
+
+    unread = sa.select([sa.func.count()]).where(message.c.receiver_id == user.c.id).where(
+        message.c.timestamp > sa.func.coalesce(user.c.last_message_read_time, datetime(1900, 1, 1))).as_scalar()
+    conn = op.get_bind()
+    max_id = conn.execute(sa.select([sa.func.max(user.c.id)])).scalar() or 0
+    for start in range(1, max_id + 1, BATCH_SIZE):
+        conn.execute(user.update()
+                     .where(user.c.id.between(start, start + BATCH_SIZE - 1))
+                     .values(unread_message_count=unread))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('unread_message_count')
@@ -1,7 +1,25 @@
-from app import create_app,db
-from app.models import User,Post
+from app import create_app,create_worker_app,db
+from app.models import User,Post,Message,Notification,Task,fan_out_post
+from app.pagination import keyset_paginate
+from app import counts, suggestions, typeahead, notify, exports, imports, search, tasks
+from app.progress import ProgressReporter
+from app.translate import detect_language
+from app.follows import LocalFollowCache
+from app.mutuals import LocalIdCache, intersect
+from app.local_search import LocalElasticsearch
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
+import rq
 from datetime import datetime,timedelta
+from flask import url_for
+from sqlalchemy.orm import Query
 from config import TestConfig
 
 
@@ -110,6 +128,1040 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f2, [p2, p3])
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
+
+    def test_home_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        for u in [u1, u2, u3]:
+            u.set_password('123')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1, timestamp=now)
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        db.session.add_all([p1, p2])
+        u1.follow(u2)
+        db.session.commit()
+
+        # 第一次读取缓存还没有建立，走数据库并建立缓存
+        self.assertEqual(u1.home_timeline(1, 10).items, [p2, p1])
+        self.assertEqual(u1.home_timeline(1, 10).items, [p2, p1])
+
+        # 新博客推送到粉丝的时间线
+        p3 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add(p3)
+        db.session.commit()
+        page = u1.home_timeline(1, 2)
+        self.assertEqual(page.items, [p3, p2])
+        self.assertEqual(page.total, 3)
+        self.assertTrue(page.has_next)
+
+        # 关注补充，取关删除
+        p4 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add(p4)
+        db.session.commit()
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline(1, 10).items, [p4, p3, p2, p1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline(1, 10).items, [p4, p1])
+        self.assertEqual(u1.home_timeline(1, 10).items,
+                         u1.followed_posts().all())
+
+        # 回滚的关注不会留在时间线里
+        u1.follow(u2)
+        db.session.rollback()
+        self.assertFalse(u1.is_following(u2))
+        self.assertEqual(u1.home_timeline(1, 10).items, [p4, p1])
+
+        # 没有读取过时间线的粉丝不推送，写入的时间线都有过期时间
+        u2.follow(u3)
+        db.session.commit()
+        db.session.add(Post(body="post from mary", author=u3, timestamp=now + timedelta(seconds=4)))
+        db.session.commit()
+        self.assertEqual(self.app.redis.exists('timeline:{}'.format(u2.id)), 0)
+        self.assertEqual(len(u1.home_timeline(1, 10).items), 3)
+        self.assertGreater(self.app.redis.ttl('timeline:{}'.format(u1.id)), 0)
+
+        # 粉丝多的作者在提交后交给 rq 推送，请求里不查询粉丝
+        self.app.config['TIMELINE_FANOUT_ASYNC_THRESHOLD'] = 1
+        p5 = Post(body="post from mary", author=u3, timestamp=now + timedelta(seconds=5))
+        db.session.add(p5)
+        with mock.patch.object(self.app.task_queue, 'enqueue') as enqueue:
+            db.session.commit()
+        enqueue.assert_called_once_with('app.tasks.push_post', p5.id, p5.timestamp, u3.id)
+        self.assertIsNone(self.app.redis.zscore('timeline:{}'.format(u1.id), p5.id))
+        fan_out_post(*enqueue.call_args[0][1:])
+        self.assertEqual(u1.home_timeline(1, 10).items[0], p5)
+
+    def test_celebrity_timeline(self):
+        self.app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        u4 = User(username='david', email='david@example.com')
+        for u in [u1, u2, u3, u4]:
+            u.set_password('123')
+        db.session.add_all([u1, u2, u3, u4])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u4.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline(1, 10).items, [])
+
+        # susan 有两个粉丝，是大V，博客不推送，读取时归并
+        now = datetime.utcnow()
+        p1 = Post(body="post from susan", author=u2, timestamp=now)
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=1))
+        p3 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        for p in [p1, p2, p3]:
+            db.session.add(p)
+            db.session.commit()
+        pushed = self.app.redis.zrevrange('timeline:{}'.format(u1.id), 0, -1)
+        self.assertEqual(pushed, [str(p2.id).encode()])
+        # 大V的列表读取时才从数据库建立，和时间线一样有过期时间
+        self.assertEqual(self.app.redis.exists('timeline:author:{}'.format(u2.id)), 0)
+        self.assertEqual(u1.home_timeline(1, 10).items, [p3, p2, p1])
+        self.assertEqual(u1.home_timeline(2, 2).items, [p1])
+        self.assertGreater(self.app.redis.ttl('timeline:author:{}'.format(u2.id)), 0)
+        # 没有读取过的作者不写入列表
+        db.session.add(Post(body="post from david", author=u4, timestamp=now))
+        db.session.commit()
+        self.assertEqual(self.app.redis.exists('timeline:author:{}'.format(u4.id)), 0)
+        # 列表过期之后回退到数据库并重新建立
+        self.app.redis.delete('timeline:author:{}'.format(u2.id), 'timeline:author:{}:warm'.format(u2.id))
+        self.assertEqual(u1.home_timeline(1, 10).items, [p3, p2, p1])
+        self.assertEqual(self.app.redis.zcard('timeline:author:{}'.format(u2.id)), 2)
+        self.assertEqual(u1.home_timeline(2, 2).items, [p1])
+
+        # 粉丝数降到阈值以下，补推之前的博客
+        u4.unfollow(u2)
+        p4 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add(p4)
+        db.session.commit()
+        pushed = self.app.redis.zrevrange('timeline:{}'.format(u1.id), 0, -1)
+        self.assertEqual(len(pushed), 4)
+        self.assertEqual(u1.home_timeline(1, 10).items, u1.followed_posts().all())
+
+    def test_cursor_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('123')
+        u2.set_password('123')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        now = datetime.utcnow()
+        # 两两同一时间，按 id 区分先后
+        posts = [Post(body=str(i), author=[u1, u2][i % 2],
+                      timestamp=now + timedelta(seconds=i // 2)) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = posts[::-1]
+
+        for pages in [
+                lambda c: keyset_paginate(u1.followed_posts(), Post.cursor_columns(), c, 3),
+                lambda c: u1.home_timeline(1, 3, cursor=c)]:
+            result = []
+            page = pages('')
+            self.assertFalse(page.has_prev)
+            result.extend(page.items)
+            while page.has_next:
+                page = pages(page.next_cursor)
+                result.extend(page.items)
+            self.assertEqual(result, expected)
+            page = pages(page.prev_cursor)
+            self.assertEqual(page.items, expected[3:6])
+            self.assertTrue(page.has_prev)
+
+    def test_counts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('123')
+        u2.set_password('123')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.assertEqual(counts.get_total('post', Post.query, 'counter'), (0, True))
+        db.session.add_all([Post(body='a', author=u1), Post(body='b', author=u1)])
+        db.session.commit()
+        # 计数器由写入增量维护，不再 COUNT
+        self.assertEqual(counts.get_total('post', None, 'counter'), (2, True))
+        db.session.add(Post(body='c', author=u2))
+        db.session.rollback()
+        self.assertEqual(counts.get_total('post', None, 'counter'), (2, True))
+
+        # 计数器刚好过期时的增量不会留下只有增量、没有过期时间的计数器
+        self.app.redis.delete('count:counter:post')
+        db.session.add(Post(body='c', author=u2))
+        db.session.commit()
+        self.assertEqual(self.app.redis.exists('count:counter:post'), 0)
+        self.app.redis.set('count:counter:post', 1)
+        self.assertEqual(counts.get_total('post', Post.query, 'counter'), (3, True))
+        self.assertGreater(self.app.redis.ttl('count:counter:post'), 0)
+
+        # 初始化时 COUNT 之后、SET 之前提交的增量会丢，这次不算精确，也不留下计数器
+        class RacingQuery(object):
+            def order_by(self, *args):
+                return self
+
+            def count(self):
+                total = Post.query.count()
+                db.session.add(Post(body='d', author=u2))
+                db.session.commit()
+                return total
+
+        self.app.redis.delete('count:counter:post')
+        self.assertEqual(counts.get_total('post', RacingQuery(), 'counter'), (3, False))
+        self.assertEqual(self.app.redis.exists('count:counter:post'), 0)
+        self.assertEqual(counts.get_total('post', Post.query, 'counter'), (4, True))
+
+        self.assertEqual(counts.get_total('user', User.query, 'cached'), (2, True))
+        self.assertEqual(counts.get_total('user', User.query, 'cached'), (2, False))
+        self.assertEqual(counts.get_total('user', User.query, 'estimate', 'user'), (2, False))
+
+        # 游标分页不需要总数，不调用 get_total
+        token = u1.get_token()
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + token}
+        with mock.patch.object(counts, 'get_total', side_effect=AssertionError) as get_total:
+            r = self.app.test_client().get('/api/users?cursor=&per_page=1', headers=headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.get_json()['items']), 1)
+        get_total.assert_not_called()
+        r = self.app.test_client().get('/api/users?per_page=1', headers=headers)
+        self.assertEqual(r.get_json()['_meta']['total_items'], 2)
+
+    def test_user_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        for u in [u1, u2, u3]:
+            u.set_password('123')
+        db.session.add_all([u1, u2, u3])
+        db.session.add_all([Post(body='a', author=u1), Post(body='b', author=u1)])
+        u1.follow(u2)
+        u1.follow(u3)
+        u3.follow(u2)
+        db.session.commit()
+        with self.app.test_request_context():
+            self.assertEqual(u1.to_dict()['post_count'], 2)
+        self.assertEqual((u1.followed_count, u1.follower_count), (2, 0))
+        self.assertEqual((u2.followed_count, u2.follower_count), (0, 2))
+
+        u1.unfollow(u2)
+        db.session.delete(u1.posts.first())
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.followed_count, u2.follower_count), (1, 1, 1))
+
+        # 只设置了 user_id 的博客也计数，用户已经加载和没有加载两种情况
+        db.session.add(Post(body='c', user_id=u1.id))
+        db.session.commit()
+        self.assertEqual(u1.post_count, 2)
+        u3_id = u3.id
+        db.session.expunge_all()
+        db.session.add(Post(body='d', user_id=u3_id))
+        db.session.commit()
+        post = Post.query.filter_by(body='d').one()
+        db.session.expunge_all()
+        db.session.delete(Post.query.get(post.id))
+        db.session.add(Post(body='e', user_id=u3_id))
+        db.session.commit()
+        u1, u2, u3 = [User.query.filter_by(username=x).one() for x in ['john', 'susan', 'mary']]
+        self.assertEqual(u3.post_count, 1)
+        self.assertEqual(User.reconcile_counters(), 0)
+
+        # 计数出现偏差时重新计算
+        u2.follower_count = 10
+        u3.post_count = 5
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(batch_size=2), 2)
+        self.assertEqual((u2.follower_count, u3.post_count), (1, 1))
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_unread_message_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        for u in [u1, u2]:
+            u.set_password('123')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Message(body='a', author=u1, receiver=u2),
+                            Message(body='b', author=u1, receiver=u2)])
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count, 2)
+        self.assertEqual(u1.unread_message_count, 0)
+
+        # 发送私信时通知里的数量来自计数，打开私信页面后清零
+        self.app.secret_key = 'test'
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        client.post('/send_message/susan', data={'message': 'c'})
+        u2 = User.query.get(u2.id)
+        self.assertEqual(u2.unread_message_count, 3)
+        self.assertEqual(u2.notifications.filter_by(name='unread_message_count').first().get_data(), 3)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        client.get('/messages')
+        u2 = User.query.get(u2.id)
+        self.assertEqual(u2.unread_message_count, 0)
+
+        # 计数出现偏差时按 last_message_read_time 重新计算
+        u2.unread_message_count = 7
+        u2.last_message_read_time = datetime(2000, 1, 1)
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(), 1)
+        self.assertEqual(u2.unread_message_count, 3)
+
+    def test_follow_cache(self):
+        users = [User(username='u{}'.format(i), email='u{}@qq.com'.format(i)) for i in range(5)]
+        for u in users:
+            u.set_password('123')
+        db.session.add_all(users)
+        db.session.commit()
+        u0 = users[0]
+        ids = [u.id for u in users[1:]]
+        redis_cache = self.app.follow_cache
+
+        for cache in [redis_cache, LocalFollowCache(10)]:
+            self.app.follow_cache = cache
+            u0.follow(users[1])
+            u0.follow(users[2])
+            # 提交之前也能看到
+            self.assertTrue(u0.is_following(users[1]))
+            db.session.commit()
+            self.assertEqual(u0.is_following_many(ids), {ids[0], ids[1]})
+
+            # 缓存建立后一次往返，不查询数据库
+            round_trips = self.app.redis.round_trips
+            self.assertEqual(u0.is_following_many(ids), {ids[0], ids[1]})
+            self.assertLessEqual(self.app.redis.round_trips - round_trips, 1)
+
+            u0.unfollow(users[1])
+            u0.follow(users[3])
+            db.session.commit()
+            self.assertEqual(u0.is_following_many(ids), {ids[1], ids[2]})
+
+            u0.follow(users[4])
+            db.session.rollback()
+            self.assertEqual(u0.is_following_many(ids), {ids[1], ids[2]})
+
+            u0.unfollow(users[2])
+            u0.unfollow(users[3])
+            db.session.commit()
+            self.assertEqual(u0.is_following_many(ids), set())
+
+        # 缓存刚好过期时的关注不会留下没有标记的集合，没有标记的集合也不会被当作缓存
+        self.app.follow_cache = redis_cache
+        key = 'following:{}'.format(u0.id)
+        self.app.redis.delete(key)
+        redis_cache.update([(u0.id, ids[0], True)])
+        self.assertEqual(self.app.redis.exists(key), 0)
+        self.app.redis.sadd(key, ids[1])
+        self.assertIsNone(redis_cache.get_many(u0.id, ids))
+
+    def test_suggestions(self):
+        users = [User(username='u{}'.format(i), email='u{}@qq.com'.format(i)) for i in range(6)]
+        for u in users:
+            u.set_password('123')
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3, u4, u5 = users
+        u0.follow(u1)
+        u0.follow(u2)
+        u1.follow(u3)
+        u2.follow(u3)
+        u1.follow(u4)
+        u2.follow(u0)
+        db.session.commit()
+
+        self.assertEqual(suggestions.refresh(), 6)
+        # u3 被两个关注的人关注，排在 u4 前面；自己不在推荐里
+        self.assertEqual([(x.id, n) for x, n in u0.suggested_users(10)], [(u3.id, 2), (u4.id, 1)])
+        self.assertEqual(suggestions.refresh(), 0)
+
+        # 增量计算 u1 和 u1 的粉丝 u0
+        u1.follow(u5)
+        db.session.commit()
+        self.assertEqual(suggestions.refresh(), 2)
+        self.assertEqual([(x.id, n) for x, n in u0.suggested_users(10)],
+                         [(u3.id, 2), (u4.id, 1), (u5.id, 1)])
+
+        # 已经关注的不再推荐
+        u0.follow(u3)
+        db.session.commit()
+        self.assertEqual([x.id for x, n in u0.suggested_users(10)], [u4.id, u5.id])
+
+    def test_mutuals(self):
+        self.assertEqual(intersect([1, 3, 5, 7], [2, 3, 4, 7, 9], 1), (2, [3]))
+        # 一边很小时走二分查找
+        self.assertEqual(intersect([500], list(range(1000)), 5), (1, [500]))
+        self.assertEqual(intersect([], [1, 2]), (0, []))
+
+        users = [User(username='u{}'.format(i), email='u{}@qq.com'.format(i)) for i in range(5)]
+        for u in users:
+            u.set_password('123')
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3, u4 = users
+
+        for cache in [self.app.id_cache, LocalIdCache(10)]:
+            self.app.id_cache = cache
+            u0.follow(u1)
+            u0.follow(u2)
+            u0.follow(u3)
+            u1.follow(u4)
+            db.session.commit()
+            self.assertEqual(u0.mutual_followers(u4), (1, [u1]))
+            # 缓存的数组在关注之后失效
+            u2.follow(u4)
+            u3.follow(u4)
+            db.session.commit()
+            count, sample = u0.mutual_followers(u4, 2)
+            self.assertEqual((count, sample), (3, [u1, u2]))
+            u0.unfollow(u2)
+            db.session.commit()
+            self.assertEqual(u0.mutual_followers(u4, 5), (2, [u1, u3]))
+
+            for a, b in [(u0, u1), (u0, u3), (u1, u4), (u2, u4), (u3, u4)]:
+                a.unfollow(b)
+            db.session.commit()
+            self.assertEqual(u0.mutual_followers(u4), (0, []))
+
+        # 粉丝太多的用户不缓存数组，用自连接，结果一样
+        u0.follow(u1)
+        u0.follow(u2)
+        for u in [u1, u2, u3]:
+            u.follow(u4)
+        db.session.commit()
+        self.app.config['MUTUALS_MAX_CACHED_IDS'] = 2
+        self.app.id_cache = LocalIdCache(10)
+        self.assertEqual(u0.mutual_followers(u4, 1), (2, [u1]))
+        self.assertEqual(self.app.id_cache.items.get(('followers', u4.id)), None)
+
+    def test_follow_many(self):
+        users = [User(username='u{}'.format(i), email='u{}@qq.com'.format(i)) for i in range(5)]
+        for u in users:
+            u.set_password('123')
+        db.session.add_all(users)
+        db.session.commit()
+        u0 = users[0]
+        ids = [u.id for u in users[1:]]
+        u0.follow(users[1])
+        db.session.commit()
+        self.assertTrue(u0.is_following(users[1]))
+        db.session.add_all([Post(body='from u3', author=users[3]), Post(body='from u4', author=users[4])])
+        db.session.commit()
+        self.assertEqual(u0.home_timeline(1, 10).items, [])
+
+        # 已经关注的、不存在的用户和自己都跳过
+        self.assertEqual(u0.follow_many(ids[:3] + [u0.id, 999]), ids[1:3])
+        db.session.commit()
+        self.assertEqual(u0.is_following_many(ids), set(ids[:3]))
+        self.assertEqual(u0.followed_count, 3)
+        self.assertEqual([u.follower_count for u in users[1:]], [1, 1, 1, 0])
+        self.assertEqual(u0.mutual_followers(users[1]), (0, []))
+
+        self.assertEqual([p.body for p in u0.home_timeline(1, 10).items], ['from u3'])
+
+        self.assertEqual(u0.unfollow_many([ids[0], ids[3]]), [ids[0]])
+        db.session.rollback()
+        self.assertEqual(u0.is_following_many(ids), set(ids[:3]))
+        # 回滚的批量关注也不会留在时间线里
+        self.assertEqual(u0.unfollow_many([ids[2]]), [ids[2]])
+        db.session.rollback()
+        self.assertEqual([p.body for p in u0.home_timeline(1, 10).items], ['from u3'])
+        self.assertEqual(u0.follow_many([ids[3]]), [ids[3]])
+        db.session.rollback()
+        self.assertEqual([p.body for p in u0.home_timeline(1, 10).items], ['from u3'])
+        self.assertEqual(u0.unfollow_many(ids), ids[:3])
+        db.session.commit()
+        self.assertEqual(u0.is_following_many(ids), set())
+        self.assertEqual(u0.followed_count, 0)
+        self.assertEqual([u.follower_count for u in users[1:]], [0, 0, 0, 0])
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_search_changes(self):
+        class Recorder(object):
+            def __init__(self):
+                self.requests = []
+                self.refresh = []
+
+            def bulk(self, body, refresh=None):
+                self.requests.append(body)
+                self.refresh.append(refresh)
+                return {'errors': False, 'items': []}
+
+        es = self.app.elasticsearch = Recorder()
+        u = User(username='john', email='john@qq.com')
+        u.set_password('123')
+        p1 = Post(body='one', author=u)
+        p2 = Post(body='two', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        # 一次提交一个请求，包含两篇博客
+        self.assertEqual(len(es.requests), 1)
+        self.assertEqual(es.requests[0][1::2], [{'body': 'one'}, {'body': 'two'}])
+        # web 请求里的写入不等 refresh，rq worker 里等到可以搜索到再让查询缓存失效
+        self.assertEqual(es.refresh, [None])
+        search.bulk([('post', p1.id, {'body': 'one'})], wait=True)
+        self.assertEqual(es.refresh, [None, 'wait_for'])
+        es.requests.pop()
+
+        # 没有改 __searchable__ 字段的不重新索引
+        p1.language = 'en'
+        db.session.commit()
+        self.assertEqual(len(es.requests), 1)
+
+        p1.body = 'one!'
+        db.session.flush()
+        p1.body = 'one!!'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(es.requests[1], [
+            {'index': {'_index': 'post', '_type': 'post', '_id': p1.id}}, {'body': 'one!!'},
+            {'delete': {'_index': 'post', '_type': 'post', '_id': p2.id}}])
+
+        p1.body = 'rollback'
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(len(es.requests), 2)
+
+    def test_reindex(self):
+        es = self.app.elasticsearch = LocalElasticsearch()
+        u = User(username='john', email='john@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.add_all([Post(body='hello {}'.format(i), author=u) for i in range(5)])
+        db.session.commit()
+        # 提交时直接写入了以表名命名的索引
+        self.assertEqual(len(es.indexes['post']), 5)
+
+        reports = []
+        index, count = Post.reindex(chunk_size=2, batch_size=2,
+                                    progress=lambda *args: reports.append(args))
+        self.assertEqual(count, 5)
+        self.assertEqual([x[0] for x in reports], [33, 66, 99, 100])
+        # 旧索引删掉了，表名变成指向新索引的别名
+        self.assertEqual(list(es.indexes), [index])
+        self.assertEqual(es.aliases, {'post': index})
+        self.assertNotIn('refresh_interval', es.settings[index])
+
+        posts, total = Post.search('hello', 1, 10)
+        self.assertEqual(total, 5)
+        db.session.add(Post(body='hello again', author=u))
+        db.session.commit()
+        self.assertEqual(len(es.indexes[index]), 6)
+
+        new_index, count = Post.reindex()
+        self.assertEqual(count, 6)
+        self.assertEqual(list(es.indexes), [new_index])
+        self.assertEqual(Post.search('again', 1, 10)[1], 1)
+
+    def test_reindex_workers(self):
+        # 多进程 reindex，子进程要用自己的数据库连接，内存数据库没法共享，用文件
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+
+        app = create_app(FileConfig)
+        with app.app_context():
+            try:
+                db.create_all()
+                u = User(username='john', email='john@qq.com')
+                u.set_password('123')
+                db.session.add(u)
+                db.session.add_all([Post(body='hello {}'.format(i), author=u) for i in range(7)])
+                db.session.commit()
+                # 子进程不能用父进程的 engine（和它继承来的连接）执行查询
+                parent = os.getpid()
+                shared = multiprocessing.Value('i', 0)
+
+                def execute(*args):
+                    if os.getpid() != parent:
+                        shared.value += 1
+                db.event.listen(db.engine, 'before_cursor_execute', execute)
+                with mock.patch('app.search.is_local', return_value=False):
+                    index, count = Post.reindex(workers=2, chunk_size=2, config_class=FileConfig)
+                self.assertEqual(count, 7)
+                self.assertEqual(shared.value, 0)
+                # 父进程的 session 还能继续用
+                self.assertEqual(u.posts.count(), 7)
+                self.assertEqual(app.elasticsearch.aliases, {'post': index})
+            finally:
+                db.session.remove()
+                db.drop_all()
+                os.remove(path)
+
+    def test_builtin_search(self):
+        u = User(username='john', email='john@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        bodies = ['我喜欢机器学习', '今天天气很好', '学习 Python 和机器学习', 'Python is fun']
+        db.session.add_all([Post(body=x, author=u) for x in bodies])
+        db.session.commit()
+        es = self.app.elasticsearch
+        # 第一次查询时从数据库建立索引
+        self.assertEqual(es.indexes, {})
+        posts, total = Post.search('机器学习', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual({x.body for x in posts}, {bodies[0], bodies[2]})
+        self.assertEqual(Post.search('python', 1, 10)[1], 2)
+        self.assertEqual(Post.search('天', 1, 10)[1], 1)
+        self.assertEqual(Post.search('不存在', 1, 10)[1], 0)
+
+        # 提交之后增量更新
+        p = Post.query.filter_by(body=bodies[1]).first()
+        p.body = '今天学习机器学习'
+        db.session.add(Post(body='机器学习入门', author=u))
+        db.session.commit()
+        posts, total = Post.search('机器学习', 1, 2)
+        self.assertEqual(total, 4)
+        self.assertEqual(len(posts), 2)
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(Post.search('机器学习', 1, 10)[1], 3)
+        self.assertEqual(Post.search('天气', 1, 10)[1], 0)
+
+    def test_search_hydration(self):
+        u = User(username='john', email='john@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.add_all([Post(body='<b>python</b> 机器学习', author=u),
+                            Post(body='python python', author=u),
+                            Post(body='java', author=u)])
+        db.session.commit()
+        posts, total = Post.search('python 学习', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual([x.body for x in posts], ['<b>python</b> 机器学习', 'python python'])
+        self.assertEqual(posts[0].author.username, 'john')
+        self.assertEqual(posts[0].author.avatar(36), u.avatar(36))
+        # 高亮的部分以外都做了转义
+        self.assertEqual(posts[0].highlight,
+                         '&lt;b&gt;<mark>python</mark>&lt;/b&gt; 机器<mark>学习</mark>')
+        self.assertEqual(posts[1].highlight, '<mark>python</mark> <mark>python</mark>')
+        self.assertEqual(Post.search('python', 2, 10), ([], 2))
+
+    def test_local_search_reload(self):
+        u = User(username='john', email='john@qq.com')
+        u.set_password('123')
+        db.session.add_all([u] + [Post(body='python {}'.format(i), author=u) for i in range(5)])
+        db.session.commit()
+        self.assertEqual(Post.search('python', 1, 10)[1], 5)
+
+        # rq worker 进程有自己的内置索引，多进程重建也只用一个进程
+        web = self.app.elasticsearch
+        self.app.elasticsearch = LocalElasticsearch(loader=web.loader)
+        self.app.config['SEARCH_INDEX_ASYNC'] = True
+        try:
+            db.session.add(Post(body='python again', author=u))
+            db.session.commit()
+            index, count = Post.reindex(workers=4, chunk_size=2)
+            self.assertEqual(count, 6)
+        finally:
+            self.app.elasticsearch = web
+        # web 进程的索引从数据库重新建立
+        self.assertEqual(Post.search('python', 1, 10)[1], 6)
+
+        # 内置搜索时提交后的索引更新不交给 rq
+        db.session.add(Post(body='python inline', author=u))
+        db.session.commit()
+        self.assertEqual(Post.search('python', 1, 10)[1], 7)
+
+        # 另一个 web 进程写入之后，当前进程从数据库重新建立，写入的进程自己不用
+        other = self.app.elasticsearch = LocalElasticsearch(loader=web.loader)
+        try:
+            # 每页条数不同，不命中查询缓存，从数据库建立这个进程的索引
+            self.assertEqual(Post.search('python', 1, 20)[1], 7)
+            loaded = other.indexes[other.resolve('post')]
+            db.session.add(Post(body='python elsewhere', author=u))
+            db.session.commit()
+            self.assertEqual(Post.search('python', 1, 20)[1], 8)
+            self.assertIs(other.indexes[other.resolve('post')], loaded)
+        finally:
+            self.app.elasticsearch = web
+        self.assertEqual(Post.search('python', 1, 10)[1], 8)
+
+    def test_search_cache(self):
+        u = User(username='john', email='john@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.add_all([Post(body='python {}'.format(i), author=u) for i in range(7)])
+        db.session.commit()
+        es = self.app.elasticsearch
+        Post.search('python', 1, 2)
+
+        # 同一个查询（忽略大小写和空格）不再请求搜索后端
+        requests = es.requests
+        posts, total = Post.search('  Python ', 1, 2)
+        self.assertEqual((len(posts), total), (2, 7))
+        self.assertEqual(es.requests, requests)
+
+        # 写入之后版本号变了，重新查询
+        db.session.add(Post(body='python again', author=u))
+        db.session.commit()
+        requests = es.requests
+        self.assertEqual(Post.search('python', 1, 2)[1], 8)
+        self.assertEqual(es.requests, requests + 1)
+
+        # 一次取三页，第二、三页从缓存返回
+        self.app.config['SEARCH_CACHE_PREFETCH_PAGES'] = 3
+        pages = []
+        requests = es.requests
+        for page in range(1, 5):
+            posts, total = Post.search('python', page, 2)
+            pages.append([x.id for x in posts])
+        self.assertEqual(es.requests, requests + 2)
+        self.assertEqual(sorted(sum(pages, [])), list(range(1, 9)))
+
+    def test_typeahead(self):
+        users = [User(username=x, email='{}@qq.com'.format(x)) for x in ['Alice', 'alan', 'bob']]
+        for u in users:
+            u.set_password('123')
+        db.session.add_all(users)
+        db.session.add_all([Post(body='python flask', author=users[0]),
+                            Post(body='python 机器学习', author=users[0])])
+        db.session.commit()
+        users[2].follow(users[1])
+        db.session.commit()
+        self.assertEqual(typeahead.build(), (3, 5))
+
+        # 不区分大小写，粉丝多的排在前面，返回原来的用户名
+        self.assertEqual(typeahead.suggest('AL'), {'users': ['alan', 'Alice'], 'terms': []})
+        self.assertEqual(typeahead.suggest('p')['terms'], ['python'])
+        self.assertEqual(typeahead.suggest('机器')['terms'], ['机器'])
+        self.assertEqual(typeahead.suggest('  '), {'users': [], 'terms': []})
+
+        # 和搜索一样要先登录
+        self.app.secret_key = 'test'
+        client = self.app.test_client()
+        self.assertEqual(client.get('/search/suggest?q=al').status_code, 302)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(users[2].id)
+        self.assertEqual(client.get('/search/suggest?q=al').get_json()['users'], ['alan', 'Alice'])
+
+        # 提交之后增量更新
+        u = User(username='albert', email='albert@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.add(Post(body='flask plugin', author=u))
+        users[0].username = 'alicia'
+        db.session.commit()
+        self.assertEqual(typeahead.suggest('al')['users'], ['alan', 'albert', 'alicia'])
+        self.assertEqual(typeahead.suggest('fl')['terms'], ['flask'])
+        self.assertEqual(typeahead.suggest('p')['terms'], ['python', 'plugin'])
+        self.assertEqual(typeahead.suggest('p', limit=1)['terms'], ['python'])
+
+        # 其它进程读取 redis 里的数据看到同样的结果
+        self.app.typeahead.indexes = None
+        self.assertEqual(typeahead.suggest('al')['users'], ['alan', 'albert', 'alicia'])
+
+    def test_notification_push(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.commit()
+        pubsub = notify.subscribe(u.id)
+
+        # 提交之后才发布，回滚的不发布
+        u.add_notification('unread_message_count', 3)
+        self.assertEqual(notify.wait(pubsub, 0.01), [])
+        db.session.commit()
+        messages = notify.wait(pubsub, 1)
+        self.assertEqual([(x['name'], x['data']) for x in messages], [('unread_message_count', 3)])
+        u.add_notification('unread_message_count', 4)
+        db.session.rollback()
+        self.assertEqual(notify.wait(pubsub, 0.01), [])
+        pubsub.close()
+
+        self.app.secret_key = 'test'
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        # 长轮询：since 之后没有新通知时等待
+        since = messages[0]['timestamp']
+        self.assertEqual(client.get('/notifications?since=0').get_json(), messages)
+        self.assertEqual(client.get('/notifications?since={}&wait=0.05'.format(since)).get_json(), [])
+
+        # SSE：先发送未读的通知，然后转发提交之后发布的通知
+        self.app.config['NOTIFICATION_STREAM_TIMEOUT'] = 1
+        response = client.get('/notifications/stream')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = iter(response.response)
+        self.assertEqual(next(events), b'retry: 3000\n\n')
+        self.assertIn(b'"data": 3', next(events))
+        u = User.query.get(u.id)
+        u.add_notification('task_progress', {'task_id': 'x', 'progress': 50})
+        db.session.commit()
+        self.assertIn(b'"progress": 50', next(events))
+        response.close()
+
+    def test_notification_etag(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.commit()
+        self.app.secret_key = 'test'
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        response = client.get('/notifications')
+        etag = response.headers['ETag']
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        response = client.get('/notifications', headers={'If-None-Match': etag})
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(statements, [])
+
+        # 有新通知之后版本号变化
+        u = User.query.get(u.id)
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        response = client.get('/notifications', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(notify.poll_stats(), (1, 2))
+
+    def test_notification_upsert(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.commit()
+        first = u.add_notification('task_progress', {'progress': 0})
+        db.session.commit()
+        first.is_read = True
+        db.session.commit()
+
+        # 原地更新同一行，重新变成未读
+        noti = u.add_notification('task_progress', {'progress': 10})
+        db.session.commit()
+        self.assertEqual(noti.id, first.id)
+        self.assertFalse(noti.is_read)
+        self.assertEqual(Notification.query.count(), 1)
+
+        # interval 之内的更新合并掉
+        self.assertIsNone(u.add_notification('task_progress', {'progress': 20}, interval=60))
+        db.session.commit()
+        self.assertEqual(noti.get_data(), {'progress': 10})
+        noti.timestamp -= 120
+        db.session.commit()
+        self.assertIsNotNone(u.add_notification('task_progress', {'progress': 30}, interval=60))
+        db.session.commit()
+        self.assertEqual(noti.get_data(), {'progress': 30})
+
+        # 查询之后另一个事务先插入了同一种通知，插入冲突时改为更新，不会因为唯一索引失败
+        def first_after_race(query):
+            db.session.execute(Notification.__table__.insert().values(
+                user_id=u.id, name='unread_message_count', payload='1', timestamp=time.time() - 120))
+            return None
+        with mock.patch.object(Query, 'first', first_after_race):
+            raced = u.add_notification('unread_message_count', 2, interval=60)
+        db.session.commit()
+        self.assertEqual(raced.get_data(), 2)
+        self.assertEqual(u.notifications.filter_by(name='unread_message_count').count(), 1)
+
+        # 已读的和很久没有更新的分批删除
+        u.add_notification('unread_message_count', 1)
+        u.add_notification('old', 1)
+        db.session.commit()
+        noti.is_read = True
+        noti.timestamp -= 100
+        u.notifications.filter_by(name='old').first().timestamp -= 1000
+        db.session.commit()
+        self.assertEqual(Notification.prune(50, 500, batch_size=1), 2)
+        self.assertEqual([x.name for x in Notification.query], ['unread_message_count'])
+
+    def test_export_posts(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        now = datetime.utcnow()
+        # 同一时间的博客按 id 排序，分块的边界上也不会重复或者遗漏
+        db.session.add_all([Post(body='post {}'.format(i), author=u, timestamp=now + timedelta(seconds=i // 2))
+                            for i in range(7)])
+        db.session.commit()
+        self.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        self.app.config['EXPORT_CHUNK_SIZE'] = 2
+
+        reported = []
+        filename = exports.path('t1')
+        self.assertEqual(exports.export_posts(u.id, filename, reported.append), 7)
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            self.assertEqual([json.loads(line)['body'] for line in f], ['post {}'.format(i) for i in range(7)])
+        self.assertEqual(reported, list(range(1, 8)))
+        self.assertFalse(os.path.exists(filename + '.tmp'))
+
+        # 只有自己完成的导出任务可以下载
+        db.session.add(Task(id='t1', name='export_posts', user=u, complete=True))
+        db.session.commit()
+        self.app.secret_key = 'test'
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        response = client.get('/export_posts/t1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(gzip.decompress(response.data).count(b'\n'), 7)
+        response.close()
+        self.assertEqual(client.get('/export_posts/t2').status_code, 404)
+        os.remove(filename)
+
+        # 任务一开始就出错（用户已经删除）也要标记为完成，页面上的进度不会一直转
+        db.session.add(Task(id='t3', name='export_posts', user=u))
+        db.session.commit()
+        job = rq.job.Job.create('app.tasks.export_posts', id='t3', connection=self.app.redis)
+        with mock.patch.object(tasks, 'app', self.app), \
+                mock.patch('app.tasks.get_current_job', return_value=job), \
+                mock.patch('app.progress.get_current_job', return_value=job):
+            tasks.export_posts(999)
+        self.assertEqual(job.meta['progress'], 100)
+        self.assertTrue(Task.query.get('t3').complete)
+
+    def test_progress_reporter(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.add(Task(id='t1', name='export_posts', user=u))
+        db.session.commit()
+        job = rq.job.Job.create('app.tasks.export_posts', id='t1', connection=self.app.redis)
+
+        # 按增量合并：200 个元素只写入 0、每 10%、以及结束时的 100
+        with ProgressReporter(step=10, interval=3600, job=job) as progress:
+            for _ in progress.iter(range(200)):
+                pass
+        self.assertEqual(progress.writes, 11)
+        self.assertEqual(job.meta['progress'], 100)
+        self.assertIsNotNone(self.app.redis.hget(job.key, 'meta'))
+        task = Task.query.get('t1')
+        self.assertTrue(task.complete)
+        noti = u.notifications.filter_by(name='task_progress').first()
+        self.assertEqual(noti.get_data(), {'task_id': 't1', 'progress': 100})
+        self.assertTrue(noti.is_read)
+
+        # 按时间合并，meta 和进度一起写入，出错时也写入 100 并回滚任务里的修改
+        progress = ProgressReporter(total=1000, step=100, interval=0, job=job)
+        with self.assertRaises(ValueError):
+            with progress:
+                progress.update(1, documents=1)
+                u.about_me = 'changed'
+                raise ValueError()
+        self.assertEqual(progress.writes, 3)
+        self.assertEqual((job.meta['progress'], job.meta['documents']), (100, 1))
+        self.assertIsNone(User.query.get(u.id).about_me)
+
+    def test_task_progress_many(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add(u)
+        db.session.add_all([Task(id='t{}'.format(i), name='export_posts', user=u) for i in range(4)])
+        db.session.commit()
+        for i, progress in [(0, 30), (1, 60)]:
+            job = rq.job.Job.create('app.tasks.export_posts', id='t{}'.format(i), connection=self.app.redis)
+            job.meta['progress'] = progress
+            job.save_meta()
+        # t2 的 job 还没有进度，t3 的 job 已经不存在
+        self.app.redis.hset(rq.job.Job.key_for('t2'), 'status', 'queued')
+
+        with self.app.test_request_context():
+            before = self.app.redis.round_trips
+            tasks = u.get_tasks_in_progress()
+            self.assertEqual([task.get_progress() for task in tasks], [30, 60, 0, 100])
+            self.assertEqual(self.app.redis.round_trips - before, 1)
+            # 同一个请求里不再读取
+            self.assertEqual(Task.get_progress_many(tasks[:2]), {'t0': 30, 't1': 60})
+            self.assertEqual(self.app.redis.round_trips - before, 1)
+        # 新的请求重新读取
+        with self.app.app_context(), self.app.test_request_context():
+            self.assertEqual(Task.query.get('t1').get_progress(), 60)
+            self.assertEqual(self.app.redis.round_trips - before, 2)
+
+    def test_import_posts(self):
+        u = User(username='u1', email='u1@qq.com')
+        u.set_password('123')
+        db.session.add_all([u, Post(body='hello', author=u)])
+        db.session.commit()
+        self.assertEqual(Post.search('python', 1, 10)[1], 0)
+        self.assertEqual(counts.get_total('post', Post.query, 'counter'), (1, True))
+        self.app.config['IMPORT_BATCH_SIZE'] = 2
+        lines = [json.dumps({'body': 'python post {}'.format(i), 'timestamp': '2019-01-0{}T08:00:00.5Z'.format(i + 1)})
+                 for i in range(5)]
+        lines[2:2] = ['', 'not json', json.dumps({'body': 'x' * 141}), json.dumps({'body': '学习 python'})]
+        path = os.path.join(tempfile.mkdtemp(), 'posts.ndjson.gz')
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+
+        reported = []
+        self.assertEqual(imports.import_posts(u, path, reported.append), (6, 2))
+        self.assertEqual(len(reported), 3)
+        self.assertEqual(reported[-1], os.path.getsize(path))
+        os.remove(path)
+
+        u = User.query.get(u.id)
+        self.assertEqual(u.post_count, 7)
+        self.assertEqual(counts.get_total('post', Post.query, 'counter'), (7, True))
+        post = u.posts.filter_by(body='python post 0').one()
+        self.assertEqual(post.timestamp, datetime(2019, 1, 1, 8, 0, 0, 500000))
+        self.assertEqual(post.language, detect_language(post.body))
+        # 每批写入搜索索引
+        self.assertEqual(Post.search('python', 1, 10)[1], 6)
+
+        # 太大的上传在读取请求体之前就拒绝
+        self.assertEqual(self.app.config['MAX_CONTENT_LENGTH'], self.app.config['IMPORT_MAX_SIZE'])
+        self.app.config['MAX_CONTENT_LENGTH'] = 100
+        self.app.config['IMPORT_DIR'] = tempfile.mkdtemp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.secret_key = 'test'
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        response = client.post('/import_posts', data={'file': (io.BytesIO(b'x' * 200), 'posts.ndjson')},
+                               content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(os.listdir(self.app.config['IMPORT_DIR']), [])
+
+        # 同一个作者在导入期间发表的博客不算导入的
+        def detect(body):
+            db.session.execute(Post.__table__.insert().values(body='from web', user_id=u.id))
+            return 'en'
+        with mock.patch('app.imports.detect_language', side_effect=detect):
+            inserted = imports.insert_batch(u.id, [('imported', datetime.utcnow())])
+        self.assertEqual([body for _, body, _ in inserted], ['imported'])
+        self.assertEqual(Post.query.get(inserted[0][0]).body, 'imported')
+
+    def test_worker_app(self):
+        class WorkerConfig(TestConfig):
+            BASE_URL = 'https://example.com'
+
+        app = create_worker_app(WorkerConfig)
+        # 只注册了 main 蓝图，导出邮件里的链接照样能生成
+        self.assertEqual(list(app.blueprints), ['main'])
+        self.assertNotIn('login_manager', dir(app))
+        with app.app_context():
+            db.create_all()
+            self.assertEqual(User.query.count(), 0)
+            # 没有请求，按 BASE_URL 生成链接
+            self.assertEqual(url_for('main.download_export', task_id='t1', _external=True),
+                             'https://example.com/export_posts/t1')
+            db.session.remove()
+            db.drop_all()
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 
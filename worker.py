@@ -0,0 +1,28 @@
+'''
+rq worker 的入口，代替 rq worker microblog-tasks
+父进程先导入 app.tasks 并创建 worker 用的 app（见 app.tasks.bootstrap），每个任务 fork 出来的子进程直接复用，
+不用每个任务都重新导入模块、创建 app
+
+用法: python worker.py [--burst] [队列名 ...]
+'''
+import argparse
+from rq import Worker
+from app import db, tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('queues', nargs='*', default=['microblog-tasks'])
+    parser.add_argument('--burst', action='store_true', help='队列空了就退出')
+    args = parser.parse_args()
+
+    app = tasks.bootstrap()
+    # 连接池不能在父子进程之间共用，fork 之前关掉父进程的连接，子进程用到时再连
+    db.session.remove()
+    db.engine.dispose()
+    worker = Worker(args.queues, connection=app.redis)
+    worker.work(burst=args.burst)
+
+
+if __name__ == '__main__':
+    main()